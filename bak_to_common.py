@@ -2,10 +2,21 @@
 Common functions for the bak_to_*.py modules.
 """
 
+import hashlib
+import os
+import shutil
+
 from datetime import datetime
 from typing import List
 
 
+#  Size of the blocks read when comparing files.
+COMPARE_BLOCK_SIZE = 1024 * 1024
+
+#  Size of the blocks read when hashing a file.
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
 def ask_to_continue(prompt, choices):
     assert 0 < len(choices)
     assert all([x == x.lower() for x in choices])
@@ -17,6 +28,69 @@ def ask_to_continue(prompt, choices):
     return answer
 
 
+def file_digest(file_name) -> str:
+    """
+    Returns the git blob id (SHA-1 of a 'blob <size>' header followed by
+    the content) of the given file. The file is read as raw bytes in
+    chunks, so it is never decoded or held in memory as a whole. Using the
+    git blob id, rather than a plain hash of the content, means the digest
+    matches what 'git hash-object' reports for an unfiltered copy.
+    """
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h = hashlib.sha1(f"blob {size}\0".encode())
+        buf = bytearray(DIGEST_CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def same_content(file_a, file_b) -> bool:
+    if os.path.getsize(file_a) != os.path.getsize(file_b):
+        return False
+    with open(file_a, "rb") as fa, open(file_b, "rb") as fb:
+        while True:
+            a = fa.read(COMPARE_BLOCK_SIZE)
+            if a != fb.read(COMPARE_BLOCK_SIZE):
+                return False
+            if not a:
+                return True
+
+
+def copy_file_bytes(src_name, dst_name) -> bool:
+    """
+    Copies the content of a file as is, using os.copy_file_range where
+    available (the kernel copies the data, or shares it with a reflink
+    on file systems that support that), otherwise shutil.copyfile (which
+    uses sendfile, or the equivalent, where it can). If the destination
+    already has the same content, it is not written, and False is
+    returned.
+    """
+    if os.path.exists(dst_name) and same_content(src_name, dst_name):
+        return False
+
+    if hasattr(os, "copy_file_range"):
+        with open(src_name, "rb") as src_file:
+            with open(dst_name, "wb") as dst_file:
+                try:
+                    while os.copy_file_range(
+                        src_file.fileno(), dst_file.fileno(), 1 << 30
+                    ):
+                        pass
+                    return True
+                except OSError:
+                    #  Not supported for these files (such as across
+                    #  file systems on older kernels).
+                    pass
+
+    shutil.copyfile(src_name, dst_name)
+    return True
+
+
 def datetime_fromisoformat(dts):
     """
     Take an ISO format datetime string and return a datetime type.
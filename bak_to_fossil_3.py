@@ -21,44 +21,85 @@
 
 import argparse
 import csv
+import getpass
+import io
 import os
 import subprocess
 import sys
+import tempfile
 
 from collections import namedtuple
 from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
 from textwrap import dedent
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from bak_to_common import (
     ask_to_continue,
+    copy_file_bytes,
     datetime_fromisoformat,
+    file_digest,
     log_fmt,
     plain_quotes,
     split_quoted,
     strip_outer_quotes,
 )
+from btg3_cache import FilterCache, filter_fingerprint
+from btg3_checkpoint import Checkpoint, groups_after, with_input_digests
+from btg3_filter import LineFilter
+from btg3_fast_import import FastImportStream, pre_command_ops, raw_date_utc
+from btg3_plan import is_plan_file, iter_plan, write_plan
 
 
 AppOptions = namedtuple(
     "AppOptions",
     "input_csv, repo_dir, repo_name, init_date, log_dir, fossil_exe, "
-    + "filter_file",
+    + "filter_file, engine, cache_dir, cache_size, resume, "
+    + "plan_out, filter_memory",
 )
 
 CommitProps = namedtuple(
     "CommitProps",
     "sort_key, full_name, datetime_tag, base_name, "
-    + "commit_message, add_command",
+    + "commit_message, add_command, digest",
 )
 
+CommitGroup = namedtuple(
+    "CommitGroup", "datetime_tag, commit_dt, commit_msg, pre_commit, items"
+)
+
+#  Name of the tool in the header of plan files.
+PLAN_TOOL = "bak_to_fossil_3"
+
+ENGINES = ["worktree", "fast-import"]
+
+#  Message fossil uses for the first check-in made by 'fossil init'.
+INITIAL_MESSAGE = "initial empty check-in"
+
+#  The checkpoint file is named for the repository directory, with this
+#  suffix, and kept beside it (see checkpoint_path).
+CHECKPOINT_SUFFIX = ".bak_to_fossil_3-checkpoint.json"
+
 run_dt = datetime.now()
 
 log_path = Path.cwd() / f"log-bak_to_fossil_3-{run_dt:%Y%m%d_%H%M%S}.txt"
 
 filter_list = []
 
+line_filter = LineFilter(filter_list)
+
+filter_cache: Optional[FilterCache] = None
+
+filter_key = ""
+
+#  Files up to this size are filtered in memory. Larger files are filtered
+#  to a temporary file (in temp_dir), in pieces of a quarter of this size.
+filter_memory = 64 << 20
+
+temp_dir: Optional[tempfile.TemporaryDirectory] = None
+
 
 def write_log(msg):
     print(msg)
@@ -84,15 +125,120 @@ def get_date_string(dt_tag):
     return commit_dt.strftime("%Y-%m-%dT%H:%M:%S")
 
 
-def copy_filtered_content(src_name, dst_name):
+def write_filtered_content(src_name, dst_file, applied_list=None):
+    """
+    Writes the filtered content of a file to dst_file (a text file),
+    writing a log entry for each filter applied. The filters applied are
+    also added to applied_list, if given, as (line number, filter item).
+    """
+
+    def record(entry):
+        num, filter_item = entry
+        write_log(f"FILTER {src_name} ({num}): {filter_item}")
+        if applied_list is not None:
+            applied_list.append(entry)
+
     with open(src_name, "r") as src_file:
-        with open(dst_name, "w") as dst_file:
-            for num, line in enumerate(src_file.readlines(), start=1):
-                for filter_item in filter_list:
-                    if filter_item[0] in line:
-                        write_log(f"FILTER {src_name} ({num}): {filter_item}")
-                        line = line.replace(filter_item[0], filter_item[1])
-                dst_file.write(line)
+        line_filter.filter_file(src_file, dst_file, record)
+
+
+def fits_in_memory(src_name) -> bool:
+    return os.path.getsize(src_name) <= filter_memory
+
+
+def use_filter_cache(src_name) -> bool:
+    return (
+        filter_cache is not None
+        and os.path.getsize(src_name)
+        <= min(filter_cache.max_bytes, filter_memory)
+    )
+
+
+def cached_filtered_content(src_name, digest) -> bytes:
+    """
+    Returns the filtered content of a file from the filter cache, if it
+    has the output for the same content and filters, writing the FILTER
+    log entries as if the file was filtered. Otherwise the file is
+    filtered and the output added to the cache.
+    """
+    key = filter_cache.key(digest or file_digest(src_name), filter_key)
+    entry = filter_cache.get(key)
+    if entry is not None:
+        content, applied_list = entry
+        for num, filter_item in applied_list:
+            write_log(f"FILTER {src_name} ({num}): {filter_item}")
+        return content
+
+    buf = io.BytesIO()
+    dst_file = io.TextIOWrapper(buf)
+    applied_list = []
+    write_filtered_content(src_name, dst_file, applied_list)
+    dst_file.flush()
+    content = buf.getvalue()
+    filter_cache.put(key, content, applied_list)
+    return content
+
+
+def copy_filtered_content(src_name, dst_name, digest=""):
+    """
+    Copies a file, applying the filter list. When no filter can match, the
+    bytes are copied as is (newlines are not changed), and the destination
+    is not written if it already has the same content. The digest of the
+    source file (if known) is used as the filter cache key.
+    """
+    if not line_filter.could_match_file(src_name):
+        copy_file_bytes(src_name, dst_name)
+        return
+    if use_filter_cache(src_name):
+        Path(dst_name).write_bytes(cached_filtered_content(src_name, digest))
+        return
+    with open(dst_name, "w") as dst_file:
+        write_filtered_content(src_name, dst_file)
+
+
+def get_filtered_content(src_name, digest="") -> bytes:
+    """
+    Returns the filtered content of a file as the bytes that
+    copy_filtered_content would write.
+    """
+    if not line_filter.could_match_file(src_name):
+        return Path(src_name).read_bytes()
+    if use_filter_cache(src_name):
+        return cached_filtered_content(src_name, digest)
+    buf = io.BytesIO()
+    dst_file = io.TextIOWrapper(buf)
+    write_filtered_content(src_name, dst_file)
+    dst_file.flush()
+    return buf.getvalue()
+
+
+def write_blob(stream: FastImportStream, src_name, digest="") -> int:
+    """
+    Writes the filtered content of a file to the stream as a blob, and
+    returns its mark. A file larger than filter_memory is copied to the
+    stream in blocks, after filtering it to a temporary file if needed.
+    """
+    if fits_in_memory(src_name):
+        return stream.blob(get_filtered_content(src_name, digest))
+    if not line_filter.could_match_file(src_name):
+        return stream.blob_file(src_name)
+    fd, tmp_name = tempfile.mkstemp(dir=temp_dir.name)
+    try:
+        with open(fd, "w") as dst_file:
+            write_filtered_content(src_name, dst_file)
+        return stream.blob_file(tmp_name)
+    finally:
+        os.remove(tmp_name)
+
+
+def fill_filter_cache(props: CommitProps):
+    """
+    In what-if mode, filters a file into the filter cache (if used), so
+    a following commit run does not need to filter it.
+    """
+    if use_filter_cache(props.full_name):
+        if line_filter.could_match_file(props.full_name):
+            cached_filtered_content(props.full_name, props.digest)
 
 
 def run_fossil(cmds, run_dir):
@@ -105,9 +251,51 @@ def run_fossil(cmds, run_dir):
     )
     write_log(f"STDOUT: {result.stdout.strip()}")
     assert result.returncode == 0
-
-
-def fossil_create_repo(opts: AppOptions, do_run: bool):
+    return result.stdout
+
+
+def pipe_to_fossil(cmds, run_dir, write_input):
+    """
+    Runs a fossil command, calling write_input with the (binary) standard
+    input of the command to write to it, and returns what write_input
+    returns. The output of the command is logged when it is done. If
+    write_input fails, the command is stopped.
+    """
+    with tempfile.TemporaryFile() as out_file:
+        proc = subprocess.Popen(
+            cmds,
+            cwd=run_dir,
+            stdin=subprocess.PIPE,
+            stdout=out_file,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            result = write_input(proc.stdin)
+            proc.stdin.close()
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        returncode = proc.wait()
+        out_file.seek(0)
+        output = out_file.read().decode("utf-8", errors="replace")
+    write_log(f"STDOUT: {output.strip()}")
+    assert returncode == 0
+    return result
+
+
+def checkpoint_path(repo_dir) -> Path:
+    """
+    Returns the path of the checkpoint file for the repository directory.
+    The directory is the fossil check-out (and holds the .fossil file), so
+    the checkpoint is kept beside it, where 'fossil extras' and 'fossil
+    clean' do not see it.
+    """
+    p = Path(repo_dir).resolve()
+    return p.with_name(p.name + CHECKPOINT_SUFFIX)
+
+
+def fossil_new_repo_dir(opts: AppOptions):
     d = Path(opts.repo_dir)
     p = d.joinpath(opts.repo_name)
 
@@ -120,6 +308,10 @@ def fossil_create_repo(opts: AppOptions, do_run: bool):
         write_log(f"mkdir {d}")
         d.mkdir()
 
+
+def fossil_create_repo(opts: AppOptions, do_run: bool):
+    fossil_new_repo_dir(opts)
+
     cmds = [
         opts.fossil_exe,
         "init",
@@ -140,17 +332,26 @@ def fossil_open_repo(opts: AppOptions, do_run: bool):
 
 
 def load_filter_list(filter_file):
-    if filter_file is None:
-        return
-    with open(filter_file) as f:
-        lines = f.readlines()
-    for line in lines:
-        s = line.strip()
-        if 0 < len(s) and not s.startswith("#"):
-            a = s.split(",")
-            assert 2 == len(a)
-            filter_item = (strip_outer_quotes(a[0]), strip_outer_quotes(a[1]))
-            filter_list.append(filter_item)
+    filter_list.clear()
+    if filter_file is not None:
+        with open(filter_file) as f:
+            lines = f.readlines()
+        for line in lines:
+            s = line.strip()
+            if 0 < len(s) and not s.startswith("#"):
+                a = s.split(",")
+                assert 2 == len(a)
+                filter_item = (
+                    strip_outer_quotes(a[0]),
+                    strip_outer_quotes(a[1]),
+                )
+                filter_list.append(filter_item)
+
+    global line_filter, filter_key
+    #  A quarter of the memory limit for the text read at once, leaving
+    #  room for the copies made while replacing.
+    line_filter = LineFilter(filter_list, max(1, filter_memory // 4))
+    filter_key = filter_fingerprint(filter_list)
 
 
 def get_opts(argv) -> AppOptions:
@@ -165,7 +366,8 @@ def get_opts(argv) -> AppOptions:
         "input_csv",
         action="store",
         help="Path to CSV file, manually edited in step 2 to add commit "
-        + "messages.",
+        + "messages. Or a plan file (with a .jsonl extension) written by "
+        + "--plan-out.",
     )
 
     ap.add_argument(
@@ -216,6 +418,76 @@ def get_opts(argv) -> AppOptions:
         + 'comma-separated format ("old string", "new string").',
     )
 
+    ap.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        action="store",
+        help="Directory for a cache of filtered files, keyed by the content "
+        + "of the source file and the filter list, so files with the same "
+        + "content are only filtered once, also across runs. In what-if "
+        + "mode, files are filtered into the cache. Only used with "
+        + "--filter-file.",
+    )
+
+    ap.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=1024,
+        help="Maximum size, in MiB, of the files in the --cache-dir cache. "
+        + "The least recently used files are removed to stay under it. "
+        + "Default is 1024.",
+    )
+
+    ap.add_argument(
+        "--filter-memory",
+        dest="filter_memory",
+        type=int,
+        default=64,
+        help="Most memory, in MiB, to use for the content of a file when "
+        + "filtering it. Larger files are filtered in pieces, and are not "
+        + "kept in the --cache-dir cache. Default is 64.",
+    )
+
+    ap.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        default="worktree",
+        help="How check-ins are made. 'worktree' (the default) runs "
+        + "'fossil init', then copies the files for each check-in to the "
+        + "repository directory and runs 'fossil commit'. 'fast-import' "
+        + "writes all check-ins (starting with an empty check-in at "
+        + "--init-date) as a git fast-export stream, piped to 'fossil "
+        + "import --git' to create the repository in one pass, and then "
+        + "opens it. The stream is not written to a file.",
+    )
+
+    ap.add_argument(
+        "--plan-out",
+        dest="plan_out",
+        action="store",
+        help="Write the plan (the commits to make, with their files, dates, "
+        + "messages, and pre-commit and post-commit commands) to this file, "
+        + "in JSON Lines format. Use a .jsonl extension so it can be given, "
+        + "after review, as the input file to make the commits without "
+        + "reading the CSV file again.",
+    )
+
+    ap.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Continue a run of the worktree engine that stopped part way. "
+        + "After each check-in, the last datetime tag and check-in id are "
+        + f"saved in '<repo_dir>{CHECKPOINT_SUFFIX}', beside the repository "
+        + "directory (outside the check-out). With --resume, the repository "
+        + "is not created again, the current check-out must still be that "
+        + "check-in with no changes, and tags up to the saved one are "
+        + "skipped. The input file must be the same one, with the same "
+        + "commits up to the saved tag (later rows may be changed).",
+    )
+
     args = ap.parse_args(argv[1:])
 
     repo_path = Path(args.repo_dir).expanduser().resolve()
@@ -238,6 +510,12 @@ def get_opts(argv) -> AppOptions:
         args.log_dir,
         args.fossil_exe,
         args.filter_file,
+        args.engine,
+        args.cache_dir,
+        args.cache_size,
+        args.resume,
+        args.plan_out,
+        args.filter_memory,
     )
 
     p = Path(opts.input_csv)
@@ -262,6 +540,19 @@ def get_opts(argv) -> AppOptions:
             sys.stderr.write(f"ERROR: File not found '{opts.filter_file}'")
             sys.exit(1)
 
+    if opts.cache_dir is not None:
+        if not Path(opts.cache_dir).is_dir():
+            sys.stderr.write(f"ERROR: Directory not found '{opts.cache_dir}'")
+            sys.exit(1)
+
+    if opts.filter_memory < 1:
+        sys.stderr.write("ERROR: --filter-memory must be at least 1")
+        sys.exit(1)
+
+    if opts.resume and opts.engine != "worktree":
+        sys.stderr.write("ERROR: --resume is only used with --engine worktree")
+        sys.exit(1)
+
     return opts
 
 
@@ -272,6 +563,390 @@ def fossil_mv_cmd(add_cmd, base_name):
     return s
 
 
+def read_commit_list(input_csv) -> Iterator[CommitProps]:
+    """
+    Yields the rows to check in, as they are read from the file.
+    """
+    with open(input_csv, newline="") as csv_file:
+        reader = csv.DictReader(csv_file)
+        for row in reader:
+            if len(row["full_name"]) > 0:
+                do_skip = str(row["SKIP_Y"]).upper() == "Y"
+                if not do_skip:
+                    yield CommitProps(
+                        row["sort_key"],
+                        row["full_name"],
+                        row["datetime_tag"],
+                        row["base_name"],
+                        row["COMMIT_MESSAGE"],
+                        row["ADD_COMMAND"],
+                        row.get("digest") or "",
+                    )
+
+
+def get_commit_group(dt_tag, items: List[CommitProps]) -> CommitGroup:
+    """
+    Returns the check-in for the items (rows) with the datetime tag
+    dt_tag, with the date, combined commit message, and the pre-commit
+    fossil commands.
+    """
+    commit_dt = get_date_string(dt_tag)
+
+    commit_msg = ""
+    pre_commit = []
+    # post_commit = []
+
+    for item in items:
+        com_msg = plain_quotes(item.commit_message.strip())
+
+        #  Stop on non-ascii characters in the commit message.
+        #  TODO: This check should be temporary, just to see what
+        #  chars, besides left and right quotes, are showing up.
+        as_ascii = ascii(com_msg)
+        if "\\u" in as_ascii:
+            print(com_msg)
+            print(as_ascii)
+            assert 0
+
+        #  If the commit_message has only a single charcter,
+        #  treat it as ditto (no matter what character) indicating
+        #  the message is attached to another file in the same
+        #  commit, and the current file was reviewed in Step 2 of
+        #  the overall process.
+        if len(com_msg) == 1:
+            com_msg = ""
+
+        if 0 < len(com_msg):
+            if com_msg.endswith("."):
+                com_msg += " "
+            else:
+                com_msg += ". "
+
+        commit_msg += com_msg
+
+        add_cmd = item.add_command.strip()
+        if 0 < len(add_cmd):
+            if add_cmd.lower().startswith("rename:"):
+                pre_commit.append(fossil_mv_cmd(add_cmd, item.base_name))
+
+    if len(commit_msg) == 0:
+        commit_msg = f"({dt_tag})"
+    else:
+        commit_msg = commit_msg.strip()
+
+    return CommitGroup(dt_tag, commit_dt, commit_msg, pre_commit, list(items))
+
+
+def iter_commit_groups(
+    commit_list: Iterable[CommitProps],
+) -> Iterator[CommitGroup]:
+    """
+    Yields a check-in for each run of rows with the same datetime tag.
+    Step 1 writes the rows by datetime tag, and they are not sorted here,
+    so a tag that is not after the one before it raises ValueError (when
+    the iteration reaches it). Within a check-in, the items are put in
+    sort key order.
+    """
+    prev_tag = None
+    for dt_tag, items in groupby(commit_list, attrgetter("datetime_tag")):
+        if prev_tag is not None and dt_tag <= prev_tag:
+            raise ValueError(
+                f"The rows for datetime tag {dt_tag} are not in order "
+                + f"(they follow rows for {prev_tag})."
+            )
+        prev_tag = dt_tag
+        yield get_commit_group(dt_tag, sorted(items))
+
+
+def read_groups(input_file) -> Iterator[CommitGroup]:
+    """
+    Returns an iterator of the check-ins in a plan file (written by
+    --plan-out), or in the step 2 CSV file, read as it is used.
+    """
+    if is_plan_file(input_file):
+        try:
+            return iter_plan(input_file, PLAN_TOOL, CommitGroup, CommitProps)
+        except ValueError as e:
+            sys.stderr.write(f"ERROR: {e}\n")
+            sys.exit(1)
+    return iter_commit_groups(read_commit_list(input_file))
+
+
+def count_groups(input_file, check_commands: bool) -> int:
+    """
+    Reads all the check-ins once, before the repository is created or
+    changed, and returns how many there are. An input that is out of
+    order, or (with check_commands, for the fast-import engine) has a
+    pre-commit command that cannot be turned into a file operation, is
+    an error, and the run stops.
+    """
+    n = 0
+    try:
+        for group in read_groups(input_file):
+            n += 1
+            if check_commands:
+                for cmd_args in group.pre_commit:
+                    pre_command_ops(split_quoted(cmd_args))
+    except ValueError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.exit(1)
+    return n
+
+
+def commit_worktree(
+    opts: AppOptions, group: CommitGroup, target_path: Path, do_commit: bool
+) -> str:
+    """
+    Makes a check-in for a group by copying its files to the repository
+    directory and running 'fossil add' (for new files) and 'fossil commit'.
+    Returns the id of the new check-in, as reported by 'fossil commit'
+    (empty if not known).
+    """
+    dt_tag = group.datetime_tag
+    commit_dt = group.commit_dt
+
+    #  Run any pre-commit fossil commands (such as 'mv').
+    for cmd_args in group.pre_commit:
+        cmds = [opts.fossil_exe] + split_quoted(cmd_args)
+        write_log("({0}) RUN (PRE): {1}".format(dt_tag, log_fmt(cmds)))
+        if do_commit:
+            run_fossil(cmds, target_path)
+
+    #  Copy files to commit for current date_time tag.
+    for props in group.items:
+        target_name = target_path / Path(props.base_name).name
+        existing_file = Path(target_name).exists()
+
+        write_log(f"COPY {props.full_name}")
+        write_log(f"  TO {target_name}")
+
+        if do_commit:
+            #  Copy file to target repo location.
+            copy_filtered_content(
+                props.full_name, target_name, props.digest
+            )
+            ts = datetime_fromisoformat(commit_dt).timestamp()
+            os.utime(target_name, (ts, ts))
+        else:
+            fill_filter_cache(props)
+
+        if not existing_file:
+            cmds = [opts.fossil_exe, "add", props.base_name]
+            write_log("({0}) RUN: {1}".format(props.datetime_tag, cmds))
+            if do_commit:
+                run_fossil(cmds, target_path)
+
+    #  Run 'fossil commit' for current date_time tag.
+    cmds = [
+        opts.fossil_exe,
+        "commit",
+        "-m",
+        group.commit_msg,
+        "--date-override",
+        commit_dt,
+    ]
+
+    write_log("({0}) RUN: {1}".format(dt_tag, log_fmt(cmds)))
+
+    if not do_commit:
+        return ""
+    return new_version(run_fossil(cmds, target_path))
+
+
+def new_version(commit_output) -> str:
+    """
+    Returns the check-in id from the 'New_Version: <id>' line of the
+    output of 'fossil commit', or an empty string if there is none.
+    """
+    for line in (commit_output or "").splitlines():
+        if line.startswith("New_Version:"):
+            return line.split(":", 1)[1].strip()
+    return ""
+
+
+def checkout_version(opts: AppOptions, target_path: Path) -> str:
+    """
+    Returns the id of the current check-out, from the 'checkout:' line of
+    the output of 'fossil info', or an empty string if there is none.
+    """
+    output = run_fossil([opts.fossil_exe, "info"], target_path)
+    for line in (output or "").splitlines():
+        if line.startswith("checkout:"):
+            return line.split(":", 1)[1].split()[0]
+    return ""
+
+
+def resume_groups(
+    opts: AppOptions,
+    groups: Iterable[CommitGroup],
+    target_path: Path,
+    checkpoint: Checkpoint,
+) -> Iterator[Tuple[CommitGroup, str]]:
+    """
+    Returns an iterator of (group, input digest) for the groups after the
+    datetime tag saved in the checkpoint, after checking that the input
+    is the same up to that tag, and the check-out is still the saved
+    check-in (when its id is known) with no changes. Exits with an error
+    otherwise.
+    """
+    saved = checkpoint.load()
+    if saved is None:
+        sys.stderr.write(f"ERROR: No checkpoint found '{checkpoint.path}'\n")
+        sys.exit(1)
+
+    try:
+        after = groups_after(saved, opts.input_csv, groups)
+    except ValueError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.exit(1)
+
+    if saved["commit"]:
+        version = checkout_version(opts, target_path)
+        if not (version and saved["commit"].startswith(version)):
+            sys.stderr.write(
+                "ERROR: Check-out ({0}) is not the checkpoint check-in ({1}) "
+                "for datetime tag {2}.\n".format(
+                    version, saved["commit"], saved["datetime_tag"]
+                )
+            )
+            sys.exit(1)
+
+    changes = run_fossil([opts.fossil_exe, "changes"], target_path)
+    if changes and changes.strip():
+        sys.stderr.write(
+            "ERROR: The check-out has changes since the checkpoint check-in. "
+            + "Revert them (for example, 'fossil revert') before resuming:\n"
+            + f"{changes}\n"
+        )
+        sys.exit(1)
+
+    write_log(
+        "RESUME after {0} (check-in {1})".format(
+            saved["datetime_tag"], saved["commit"]
+        )
+    )
+    return after
+
+
+def write_fast_export(
+    opts: AppOptions, groups: Iterable[CommitGroup], out_file
+) -> dict:
+    """
+    Writes all check-ins to out_file as a git fast-export stream, for
+    'fossil import --git', starting with an empty check-in at the
+    --init-date (as 'fossil init --date-override' makes). Returns the
+    commit date of the last version of each file, by path.
+    """
+    #  Fossil takes --date-override as UTC, so the stream uses UTC.
+    #  Fossil import uses the part of the committer inside <> as the user.
+    user = getpass.getuser()
+    ident = f"{user} <{user}>"
+    ref = "refs/heads/trunk"
+
+    stream = FastImportStream(out_file)
+    init_date = raw_date_utc(datetime_fromisoformat(opts.init_date))
+    stream.commit(
+        ref, f"{ident} {init_date}", f"{ident} {init_date}", INITIAL_MESSAGE
+    )
+
+    file_times = {}
+    for group in groups:
+        print(group.datetime_tag)
+        dt_tag = group.datetime_tag
+        pre_ops = []
+        for cmd_args in group.pre_commit:
+            pre_ops += pre_command_ops(split_quoted(cmd_args))
+
+        marks = []
+        for props in group.items:
+            path = Path(props.base_name).name
+            write_log(f"COPY {props.full_name}")
+            write_log(f"  TO {path}")
+            marks.append(
+                (path, write_blob(stream, props.full_name, props.digest))
+            )
+
+        commit_date = raw_date_utc(datetime_fromisoformat(group.commit_dt))
+        write_log(
+            "({0}) FAST-EXPORT: commit {1}".format(
+                dt_tag, log_fmt([group.commit_msg])
+            )
+        )
+        stream.commit(
+            ref,
+            f"{ident} {commit_date}",
+            f"{ident} {commit_date}",
+            group.commit_msg,
+        )
+        for op in pre_ops:
+            write_log(f"({dt_tag}) FAST-EXPORT (PRE): {log_fmt(op)}")
+            if op[0] == "R":
+                stream.rename(op[1], op[2])
+                file_times[op[2]] = file_times.pop(op[1], None)
+            else:
+                stream.delete(op[1])
+                file_times.pop(op[1], None)
+        for path, mark in marks:
+            stream.modify_ref(path, f":{mark}")
+            file_times[path] = group.commit_dt
+
+    return file_times
+
+
+def run_fast_import(
+    opts: AppOptions, groups: Iterable[CommitGroup], do_commit
+):
+    """
+    Creates the fossil repository from a git fast-export stream, piped to
+    'fossil import --git' as it is written, then opens it.
+    """
+    if opts.init_date is None:
+        sys.stderr.write("ERROR: The fast-import engine needs --init-date\n")
+        sys.exit(1)
+
+    fossil_new_repo_dir(opts)
+
+    #  The stream is read from standard input.
+    cmds = [opts.fossil_exe, "import", "--git", opts.repo_name]
+    write_log(f"RUN: {log_fmt(cmds)}")
+    if do_commit:
+        try:
+            file_times = pipe_to_fossil(
+                cmds,
+                opts.repo_dir,
+                lambda stdin: write_fast_export(opts, groups, stdin),
+            )
+        except BaseException:
+            #  Do not leave a partly imported repository.
+            repo_file = Path(opts.repo_dir) / opts.repo_name
+            if repo_file.exists():
+                write_log(f"Remove {repo_file}")
+                repo_file.unlink()
+            raise
+    else:
+        for group in groups:
+            print(group.datetime_tag)
+            for props in group.items:
+                write_log(f"COPY {props.full_name}")
+                write_log(f"  TO {Path(props.base_name).name}")
+                fill_filter_cache(props)
+            write_log(
+                "({0}) FAST-EXPORT: commit {1}".format(
+                    group.datetime_tag, log_fmt([group.commit_msg])
+                )
+            )
+        file_times = {}
+
+    fossil_open_repo(opts, do_commit)
+
+    #  Set modification times as the worktree engine would have.
+    for path, commit_dt in file_times.items():
+        target_name = Path(opts.repo_dir) / path
+        if commit_dt is not None and target_name.exists():
+            ts = datetime_fromisoformat(commit_dt).timestamp()
+            os.utime(target_name, (ts, ts))
+
+
 def main(argv):
     opts = get_opts(argv)
 
@@ -293,139 +968,70 @@ def main(argv):
         do_commit = False
         write_log("MODE: What-if (actions logged, repository not affected)")
 
-    fossil_create_repo(opts, do_commit)
-
-    fossil_open_repo(opts, do_commit)
-
-    target_path = Path(opts.repo_dir)
+    global filter_memory, temp_dir
+    filter_memory = opts.filter_memory << 20
 
     load_filter_list(opts.filter_file)
 
-    commit_list: List[CommitProps] = []
+    if 0 < len(filter_list) and temp_dir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="btf3-")
+
+    global filter_cache
+    if opts.cache_dir is not None and 0 < len(filter_list):
+        filter_cache = FilterCache(opts.cache_dir, opts.cache_size << 20)
+    else:
+        filter_cache = None
 
     write_log(f"Read {opts.input_csv}")
 
-    with open(opts.input_csv, newline="") as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if len(row["full_name"]) > 0:
-                do_skip = str(row["SKIP_Y"]).upper() == "Y"
-                if not do_skip:
-                    commit_list.append(
-                        CommitProps(
-                            row["sort_key"],
-                            row["full_name"],
-                            row["datetime_tag"],
-                            row["base_name"],
-                            row["COMMIT_MESSAGE"],
-                            row["ADD_COMMAND"],
-                        )
-                    )
+    #  Check-ins are read as they are made. One pass over the input comes
+    #  first, to find any problem in it before the repository is touched,
+    #  and to count the check-ins for the plan header.
+    n_groups = count_groups(opts.input_csv, opts.engine == "fast-import")
+
+    if opts.plan_out is not None:
+        write_log(f"Write plan {opts.plan_out}")
+        write_plan(
+            opts.plan_out,
+            PLAN_TOOL,
+            read_groups(opts.input_csv),
+            opts.input_csv,
+            n_groups,
+        )
 
-    commit_list.sort()
-
-    datetime_tags = []
-    for item in commit_list:
-        if item.datetime_tag not in datetime_tags:
-            datetime_tags.append(item.datetime_tag)
-
-    datetime_tags.sort()
-
-    for dt_tag in datetime_tags:
-        print(dt_tag)
-
-        commit_dt = get_date_string(dt_tag)
-
-        commit_msg = ""
-        pre_commit = []
-        # post_commit = []
-        commit_this: List[CommitProps] = []
-
-        for item in commit_list:
-            if item.datetime_tag == dt_tag:
-                com_msg = plain_quotes(item.commit_message.strip())
-
-                #  Stop on non-ascii characters in the commit message.
-                #  TODO: This check should be temporary, just to see what
-                #  chars, besides left and right quotes, are showing up.
-                as_ascii = ascii(com_msg)
-                if "\\u" in as_ascii:
-                    print(com_msg)
-                    print(as_ascii)
-                    assert 0
-
-                #  If the commit_message has only a single charcter,
-                #  treat it as ditto (no matter what character) indicating
-                #  the message is attached to another file in the same
-                #  commit, and the current file was reviewed in Step 2 of
-                #  the overall process.
-                if len(com_msg) == 1:
-                    com_msg = ""
-
-                if 0 < len(com_msg):
-                    if com_msg.endswith("."):
-                        com_msg += " "
-                    else:
-                        com_msg += ". "
-
-                commit_msg += com_msg
-
-                add_cmd = item.add_command.strip()
-                if 0 < len(add_cmd):
-                    if add_cmd.lower().startswith("rename:"):
-                        pre_commit.append(
-                            fossil_mv_cmd(add_cmd, item.base_name)
-                        )
-
-                commit_this.append(item)
-
-        #  Run any pre-commit fossil commands (such as 'mv').
-        if 0 < len(pre_commit):
-            for cmd_args in pre_commit:
-                cmds = [opts.fossil_exe] + split_quoted(cmd_args)
-                write_log("({0}) RUN (PRE): {1}".format(dt_tag, log_fmt(cmds)))
-                if do_commit:
-                    run_fossil(cmds, target_path)
-
-        #  Copy files to commit for current date_time tag.
-        for props in commit_this:
-            target_name = target_path / Path(props.base_name).name
-            existing_file = Path(target_name).exists()
+    groups = read_groups(opts.input_csv)
 
-            write_log(f"COPY {props.full_name}")
-            write_log(f"  TO {target_name}")
+    if opts.engine == "fast-import":
+        run_fast_import(opts, groups, do_commit)
+    else:
+        target_path = Path(opts.repo_dir)
 
-            if do_commit:
-                #  Copy file to target repo location.
-                copy_filtered_content(props.full_name, target_name)
-                ts = datetime_fromisoformat(commit_dt).timestamp()
-                os.utime(target_name, (ts, ts))
-
-            if not existing_file:
-                cmds = [opts.fossil_exe, "add", props.base_name]
-                write_log("({0}) RUN: {1}".format(props.datetime_tag, cmds))
-                if do_commit:
-                    run_fossil(cmds, target_path)
-
-        #  Run 'fossil commit' for current date_time tag.
-        if len(commit_msg) == 0:
-            commit_msg = f"({dt_tag})"
+        checkpoint = Checkpoint(checkpoint_path(target_path))
+
+        #  Each checkpoint is saved with a digest of the input up to its
+        #  tag.
+        if opts.resume:
+            pairs = resume_groups(opts, groups, target_path, checkpoint)
         else:
-            commit_msg = commit_msg.strip()
+            pairs = with_input_digests(groups)
 
-        cmds = [
-            opts.fossil_exe,
-            "commit",
-            "-m",
-            commit_msg,
-            "--date-override",
-            commit_dt,
-        ]
+            fossil_create_repo(opts, do_commit)
 
-        write_log("({0}) RUN: {1}".format(dt_tag, log_fmt(cmds)))
+            fossil_open_repo(opts, do_commit)
 
-        if do_commit:
-            run_fossil(cmds, target_path)
+        for group, digest in pairs:
+            print(group.datetime_tag)
+            version = commit_worktree(opts, group, target_path, do_commit)
+            if do_commit:
+                checkpoint.save(
+                    group.datetime_tag, version, opts.input_csv, digest
+                )
+
+    if filter_cache is not None:
+        write_log(
+            f"Filter cache: {filter_cache.hits} hits, "
+            + f"{filter_cache.misses} misses"
+        )
 
     write_log(f"END at {datetime.now():%Y-%m-%d %H:%M:%S}")
 
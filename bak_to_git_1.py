@@ -5,32 +5,375 @@
 # ---------------------------------------------------------------------
 
 import argparse
+import contextlib
 import csv
+import fnmatch
+import os
 import sys
 
-from collections import namedtuple
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+from bak_to_common import file_digest, same_content
+from btg1_index import IndexEntry, ScanIndex
+from btg1_store import BakProps, BakStore
 
-AppOptions = namedtuple(
-    "AppOptions", "source_dir, output_dir, include_dt, write_debug, skip_list"
-)
 
-
-BakProps = namedtuple(
-    "BakProps", "sort_key, full_name, file_name, base_name, datetime_tag"
+AppOptions = namedtuple(
+    "AppOptions",
+    "source_dir, output_dir, include_dt, write_debug, skip_list, jobs, "
+    + "index_file, continue_from, include_list, exclude_list",
 )
 
 
 ChangeProps = namedtuple(
     "ChangeProps",
     "row_num, sort_key, full_name, prev_full_name, datetime_tag, base_name,"
-    + "SKIP_Y, COMMIT_MESSAGE, ADD_COMMAND, NOTES",
+    + "SKIP_Y, COMMIT_MESSAGE, ADD_COMMAND, NOTES, digest",
 )
 
 
+#  Column names in the step-1 CSV, in the order of the ChangeProps fields.
+STEP_1_COLUMNS = [
+    "row",
+    "sort_key",
+    "full_name",
+    "prev_full_name",
+    "datetime_tag",
+    "base_name",
+    "SKIP_Y",
+    "COMMIT_MESSAGE",
+    "ADD_COMMAND",
+    "NOTES",
+    "digest",
+]
+
+
+PriorCsv = namedtuple(
+    "PriorCsv", "rows, last_row, last_tag, prev_files, prev_digests"
+)
+
+
+#  The output files are flushed after this many rows are written, so a
+#  long scan shows partial output.
+FLUSH_ROWS = 500
+
+
+#  Value in the change list, for the row or previous row, meaning none.
+NO_ROW = -1
+
+
+def iter_bak_files(
+    source_dir: str, include_list: List[str], exclude_list: List[str]
+) -> Iterator[os.DirEntry]:
+    """
+    Walks source_dir with os.scandir and yields an os.DirEntry for each
+    backup (*.bak) file. The entries keep their stat result once it has
+    been retrieved, so it is not repeated.
+
+    Patterns are matched, using fnmatch, against both the name and the
+    path relative to source_dir (with '/' separators). Directories that
+    match an exclude pattern are not walked. Files must match an include
+    pattern, if any are given, and not match an exclude pattern. Symbolic
+    links to directories are not followed.
+    """
+
+    def matches(name, rel_path, patterns):
+        return any(
+            fnmatch.fnmatch(name, pat) or fnmatch.fnmatch(rel_path, pat)
+            for pat in patterns
+        )
+
+    dirs = [(source_dir, "")]
+    while dirs:
+        dir_path, rel_dir = dirs.pop()
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not matches(entry.name, rel_path, exclude_list):
+                        dirs.append((entry.path, rel_path + "/"))
+                elif entry.name.endswith(".bak") and entry.is_file():
+                    if 0 < len(include_list) and not matches(
+                        entry.name, rel_path, include_list
+                    ):
+                        continue
+                    if matches(entry.name, rel_path, exclude_list):
+                        continue
+                    yield entry
+
+
+def prev_version(store: BakStore, last_row: int) -> Tuple:
+    """
+    Returns the (path, size, mtime_ns) of the version a file is compared
+    with, as kept in the index, or all None for a new file.
+    """
+    if last_row == NO_ROW:
+        return None, None, None
+    return (
+        store.full_name(last_row),
+        store.size(last_row),
+        store.mtime_ns(last_row),
+    )
+
+
+def compare_row(
+    store: BakStore,
+    row: int,
+    last_row: int,
+    changed: Optional[bool],
+    digest: Optional[str],
+) -> Tuple[bool, Optional[str], bool]:
+    """
+    Returns (changed, digest, was_read) for a file compared with last_row,
+    the version just before it (NO_ROW for a new file). A file of
+    different size has changed without reading either file. Files of the
+    same size are compared as raw bytes, in chunks, stopping at the first
+    difference (same_content). Only when the previous file is gone (from
+    a --continue-from CSV) is its stored digest compared instead. The
+    digest is calculated for changed files, which are written to the CSV.
+
+    The changed flag and digest are passed in when known from the index.
+    """
+    full_name = store.full_name(row)
+    was_read = False
+    if changed is None:
+        if last_row == NO_ROW:
+            changed = True
+        elif store.size(last_row) is not None:
+            changed = store.size(last_row) != store.size(row)
+            if not changed:
+                prev_name = store.full_name(last_row)
+                changed = not same_content(prev_name, full_name)
+                was_read = True
+        else:
+            if digest is None:
+                digest = file_digest(full_name)
+                was_read = True
+            changed = store.hex_digest(last_row) != digest
+    if changed and digest is None:
+        digest = file_digest(full_name)
+        was_read = True
+    return changed, digest, was_read
+
+
+def compare_rows(
+    store: BakStore,
+    rows: Iterable[int],
+    prev_rows: Dict[str, int],
+    jobs: int,
+    index: ScanIndex = None,
+) -> Iterator[Tuple[int, bool]]:
+    """
+    Compares each of the given rows with the version just before it (of
+    the same base_name, starting from prev_rows) and yields (row, changed),
+    in the given order. The digest of each changed row is set in the
+    store. A version that did not change has the same content as the last
+    changed version, so comparing with the version just before gives the
+    same result, and each comparison is independent of the others. With
+    more than one job, the files are compared in a thread pool (reading
+    and hashing release the GIL) with a bounded number of files ahead of
+    the row last yielded.
+
+    If an index is given, the change decision and digest are taken from
+    a matching entry (same path, size, and mtime, compared with the same
+    previous version), so the file is not read, and new decisions are
+    added to the index.
+    """
+    last_rows = dict(prev_rows)
+
+    def start(row):
+        base_name = store.base_name(row)
+        last_row = last_rows.get(base_name, NO_ROW)
+        last_rows[base_name] = row
+        changed, digest = None, None
+        if index is not None:
+            entry = index.get(
+                store.full_name(row), store.size(row), store.mtime_ns(row)
+            )
+            if entry is not None:
+                digest = entry.digest
+                if entry[1:4] == prev_version(store, last_row):
+                    changed = entry.changed
+        return last_row, changed, digest
+
+    def finish(row, last_row, known, result):
+        changed, digest, was_read = result
+        if digest is not None:
+            store.set_hex_digest(row, digest)
+        if index is not None:
+            if was_read or known is None:
+                index.set(
+                    store.full_name(row),
+                    store.size(row),
+                    store.mtime_ns(row),
+                    IndexEntry(
+                        digest, *prev_version(store, last_row), changed
+                    ),
+                )
+            if not was_read:
+                index.hits += 1
+        return row, changed
+
+    if jobs == 1:
+        for row in rows:
+            last_row, known, digest = start(row)
+            result = compare_row(store, row, last_row, known, digest)
+            yield finish(row, last_row, known, result)
+        return
+
+    lookahead = jobs * 64
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for row in rows:
+            last_row, known, digest = start(row)
+            future = pool.submit(
+                compare_row, store, row, last_row, known, digest
+            )
+            pending.append((row, last_row, known, future))
+            if len(pending) < lookahead:
+                continue
+            row, last_row, known, future = pending.popleft()
+            yield finish(row, last_row, known, future.result())
+        while pending:
+            row, last_row, known, future = pending.popleft()
+            yield finish(row, last_row, known, future.result())
+
+
+def iter_tag_changes(
+    store: BakStore,
+    prev_rows: Dict[str, int],
+    compared_rows: Iterator[Tuple[int, bool]],
+) -> Iterator[Tuple[str, array, List[Tuple[int, int]]]]:
+    """
+    Yields (datetime_tag, rows, changes) for each datetime_tag, in order.
+    The changes are (row, prev_row) pairs for each new or changed file,
+    where prev_row is NO_ROW for a new file. The compared_rows iterator
+    (from compare_rows) is advanced past each row to get its result. The
+    prev_rows dict, of base_name to the row for the last changed version,
+    is updated as it goes.
+    """
+    for dt, rows in store.iter_tags():
+        changes = []
+        for row in rows:
+            compared_row, changed = next(compared_rows)
+            assert compared_row == row
+            if changed:
+                base_name = store.base_name(row)
+                changes.append((row, prev_rows.get(base_name, NO_ROW)))
+                prev_rows[base_name] = row
+        yield dt, rows, changes
+
+
+def get_change_props(
+    store: BakStore,
+    row: int,
+    prev_row: int,
+    row_num: int,
+    skip_list,
+    datetime_tag: str = "",
+) -> ChangeProps:
+    if row == NO_ROW:
+        #  Separator row after each datetime_tag. Only the datetime_tag is
+        #  set, so --continue-from knows a tag with no changed files was
+        #  scanned.
+        return ChangeProps(
+            row_num, "", "", "", datetime_tag, "", "", "", "", "", ""
+        )
+
+    t = store.get(row)
+    if t.base_name in skip_list:
+        skipy = "Y"
+        note = "SKIP_Y set per --skip-names option."
+    else:
+        skipy = ""
+        note = ""
+    if prev_row == NO_ROW:
+        prev_full_name = ""
+    else:
+        prev_full_name = store.full_name(prev_row)
+    return ChangeProps(
+        row_num,
+        t.sort_key,
+        t.full_name,
+        prev_full_name,
+        t.datetime_tag,
+        t.base_name,
+        skipy,
+        "",
+        "",
+        note,
+        store.hex_digest(row),
+    )
+
+
+def read_prior_csv(csv_path) -> PriorCsv:
+    """
+    Reads an existing step-1 CSV file for the --continue-from option.
+    Returns the rows, as written (including manual edits), the last row
+    number and datetime_tag, and the last version of each base_name, as
+    BakProps, along with its digest. The last datetime_tag is taken from
+    every row, including the separator rows, so tags with no changed
+    files are not scanned again.
+
+    CSV files written before the 'digest' column was added are supported.
+    The digest of the last version of each base_name is then calculated
+    from the backup file if it still exists.
+    """
+    rows = []
+    last_row = 0
+    last_tag = ""
+    last_versions = {}
+    with open(csv_path, newline="") as csv_file:
+        reader = csv.DictReader(csv_file)
+        extra = [c for c in reader.fieldnames if c not in STEP_1_COLUMNS]
+        if 0 < len(extra):
+            sys.stderr.write(
+                "ERROR: Unexpected columns in '{0}': {1}\n".format(
+                    csv_path, ", ".join(extra)
+                )
+            )
+            sys.exit(1)
+        for row in reader:
+            rows.append(row)
+            if row["row"].isdigit():
+                last_row = max(last_row, int(row["row"]))
+            last_tag = max(last_tag, row["datetime_tag"])
+            if 0 < len(row["full_name"]):
+                last_versions[row["base_name"]] = row
+
+    prev_files = {}
+    prev_digests = {}
+    for base_name, row in last_versions.items():
+        full_name = row["full_name"]
+        digest = row.get("digest") or None
+        p = Path(full_name)
+        if p.exists():
+            st = p.stat()
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+            if digest is None:
+                digest = file_digest(full_name)
+        else:
+            #  Without the file, only a stored digest can be compared.
+            size, mtime_ns = None, None
+        prev_files[base_name] = BakProps(
+            row["sort_key"],
+            full_name,
+            p.name,
+            base_name,
+            row["datetime_tag"],
+            size,
+            mtime_ns,
+        )
+        prev_digests[base_name] = digest
+
+    return PriorCsv(rows, last_row, last_tag, prev_files, prev_digests)
+
+
 def get_opts(argv) -> AppOptions:
 
     ap = argparse.ArgumentParser(
@@ -76,6 +419,59 @@ def get_opts(argv) -> AppOptions:
         + "with commas (no spaces).",
     )
 
+    ap.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        action="store",
+        help="Number of files to read and hash at the same time. The output "
+        + "is the same for any number of jobs. Default is 1.",
+    )
+
+    ap.add_argument(
+        "--index-file",
+        dest="index_file",
+        action="store",
+        help="Path to an index file (SQLite database) that stores whether "
+        + "each backup file changed from the version before it, and its "
+        + "digest. It is created if it does not exist. On later runs, backup "
+        + "files with the same path, size, and modification time as in the "
+        + "index (compared with the same previous version) are not read "
+        + "again. Entries for backup files that no longer exist are removed "
+        + "after a run without --continue-from, --include, or --exclude.",
+    )
+
+    ap.add_argument(
+        "--continue-from",
+        dest="continue_from",
+        action="store",
+        help="Path to an existing step-1 CSV file to continue from. Only "
+        + "backups with a datetime_tag after the last one in that file are "
+        + "scanned. The output CSV has the rows from the existing file, "
+        + "including any manual edits, followed by the new rows.",
+    )
+
+    ap.add_argument(
+        "--include",
+        dest="include_list",
+        action="append",
+        default=[],
+        help="Only scan backup files with a name, or a path relative to "
+        + "source_dir, matching this (glob) pattern. May be used more than "
+        + "once.",
+    )
+
+    ap.add_argument(
+        "--exclude",
+        dest="exclude_list",
+        action="append",
+        default=[],
+        help="Skip files, and directories (without walking them), with a "
+        + "name, or a path relative to source_dir, matching this (glob) "
+        + "pattern. May be used more than once.",
+    )
+
     args = ap.parse_args(argv[1:])
 
     if args.skip_names is None:
@@ -89,11 +485,27 @@ def get_opts(argv) -> AppOptions:
         args.include_dt,
         args.write_debug,
         skip_list,
+        args.jobs,
+        args.index_file,
+        args.continue_from,
+        args.include_list,
+        args.exclude_list,
     )
 
     assert Path(opts.source_dir).exists()
     assert Path(opts.source_dir).is_dir()
 
+    if opts.continue_from is not None:
+        if not Path(opts.continue_from).is_file():
+            sys.stderr.write(
+                f"ERROR: File not found '{opts.continue_from}'\n"
+            )
+            sys.exit(1)
+
+    if opts.jobs < 1:
+        sys.stderr.write("ERROR: The --jobs value must be at least 1.\n")
+        sys.exit(1)
+
     return opts
 
 
@@ -129,145 +541,76 @@ def main(argv):
 
     assert output_path.exists()
 
+    if opts.continue_from is None:
+        prior = None
+        last_tag = ""
+    else:
+        print(f"Reading '{opts.continue_from}'")
+        prior = read_prior_csv(opts.continue_from)
+        last_tag = prior.last_tag
+        print(f"Continuing after datetime_tag '{last_tag}'")
+
     print(f"Scanning '{opts.source_dir}'")
 
-    bak_files = Path(opts.source_dir).rglob("*.bak")
+    #  Use the same form of the source path as pathlib would, so the
+    #  full_name values do not depend on how the path was typed.
+    bak_files = iter_bak_files(
+        str(Path(opts.source_dir)), opts.include_list, opts.exclude_list
+    )
+
+    store = BakStore()
 
-    file_list: List[BakProps] = []
-    datetime_tags = []
-    base_names = []
+    #  When continuing, the last version of each base_name from the existing
+    #  CSV file is added first, so it can be compared with newer backups,
+    #  but is not part of the sorted rows.
+    prev_rows: Dict[str, int] = {}
+    if prior is not None:
+        for base_name, t in prior.prev_files.items():
+            row = store.add(
+                t.full_name, base_name, t.datetime_tag, t.size, t.mtime_ns
+            )
+            digest = prior.prev_digests[base_name]
+            if digest is not None:
+                store.set_hex_digest(row, digest)
+            prev_rows[base_name] = row
+    first_row = len(store)
 
     #  The backup files, created by the 'wipbak' script, are named with
     #  a .date_time tag preceding the .bak extension (suffix). For example,
     #  'bak_to_git_1.py.20200905_105914.bak'.
 
     for f in bak_files:
-        #  Path.stem returns the name without the suffix. Split the stem on '.'
-        #  and get the last element to retrieve the date_time tag.
+        #  Remove the suffix from the name. Split the rest on '.' and get
+        #  the last element to retrieve the date_time tag.
         #
-        full_name = str(f)
         file_name = f.name
-        datetime_tag = f.stem.split(".")[-1:][0]
-        base_name = ".".join(f.name.split(".")[:-2])
-        sort_key = f"{datetime_tag}:{base_name}"
+        datetime_tag = os.path.splitext(file_name)[0].split(".")[-1]
 
-        file_list.append(
-            BakProps(sort_key, full_name, file_name, base_name, datetime_tag)
-        )
+        #  When continuing, backups up to the last datetime_tag in the
+        #  existing CSV file are not needed.
+        if datetime_tag <= last_tag:
+            continue
 
-        if base_name not in base_names:
-            base_names.append(base_name)
+        base_name = ".".join(file_name.split(".")[:-2])
 
-        if datetime_tag not in datetime_tags:
-            datetime_tags.append(datetime_tag)
+        #  Stat once while scanning (the DirEntry keeps the result). The
+        #  size is used to flag changes without reading the files.
+        st = f.stat()
 
-    file_list.sort()
-    base_names.sort()
-    datetime_tags.sort()
+        store.add(f.path, base_name, datetime_tag, st.st_size, st.st_mtime_ns)
 
-    #  Write all-files list for debugging.
-    if opts.write_debug:
-        filename_out_all = str(output_path.joinpath("z-debug-1-all-files.csv"))
-        with open(filename_out_all, "w", newline="") as csv_file:
-            writer = csv.writer(csv_file)
-            writer.writerow(
-                [
-                    "sort_key",
-                    "full_name",
-                    "file_name",
-                    "base_name",
-                    "datetime_tag",
-                ]
-            )
-            writer.writerows(file_list)
+    #  Sort the files once, grouped by datetime_tag.
+    store.sort(first_row)
 
-    #  Write base-names list for debugging.
-    if opts.write_debug:
-        filename_out_base_names = str(
-            output_path.joinpath("z-debug-2-base_names.csv")
-        )
-        with open(filename_out_base_names, "w", newline="") as out_file:
-            out_file.write("base_name\n")
-            for a in base_names:
-                out_file.write(f"{a}\n")
-
-    #  Write datetime-tags list for debugging.
-    if opts.write_debug:
-        filename_out_dt_tags = str(
-            output_path.joinpath("z-debug-3-datetime_tags.csv")
-        )
-        with open(filename_out_dt_tags, "w", newline="") as out_file:
-            out_file.write("datetime_tag\n")
-            for a in datetime_tags:
-                out_file.write(f"{a}\n")
-
-    changed_list: List[ChangeProps] = []
-    row_num = 0
-    prev_files = {}
-
-    for dt in datetime_tags:
-        # print (dt)
-
-        dt_files: List[BakProps] = [
-            p for p in file_list if p.datetime_tag == dt
-        ]
-
-        for t in dt_files:
-            # print(f"  {t.full_name}")
-            if t.base_name in opts.skip_list:
-                skipy = "Y"
-                note = "SKIP_Y set per --skip-names option."
-            else:
-                skipy = ""
-                note = ""
-            if t.base_name in prev_files:
-                prev_props = prev_files[t.base_name]
-                prev_content = Path(prev_props.full_name).read_text()
-                this_content = Path(t.full_name).read_text()
-                if prev_content != this_content:
-                    #  file changed
-                    row_num += 1
-                    props = ChangeProps(
-                        row_num,
-                        t.sort_key,
-                        t.full_name,
-                        prev_props.full_name,
-                        t.datetime_tag,
-                        t.base_name,
-                        skipy,
-                        "",
-                        "",
-                        note,
-                    )
-                    changed_list.append(props)
-                    prev_files[t.base_name] = t
-            else:
-                #  new file
-                row_num += 1
-                props = ChangeProps(
-                    row_num,
-                    t.sort_key,
-                    t.full_name,
-                    "",
-                    t.datetime_tag,
-                    t.base_name,
-                    skipy,
-                    "",
-                    "",
-                    note,
-                )
-                changed_list.append(props)
-                prev_files[t.base_name] = t
-
-        #  Insert a blank row between each datetime_tag to make it more
-        #  obvious which files will be grouped in a commit.
-        row_num += 1
-        changed_list.append(
-            ChangeProps(row_num, "", "", "", "", "", "", "", "", "")
+    if opts.index_file is None:
+        index = None
+    else:
+        #  Save new entries as often as the output is flushed, so an
+        #  interrupted scan does not lose them.
+        index = ScanIndex(
+            Path(opts.index_file).expanduser().resolve(), FLUSH_ROWS
         )
 
-    #  Write main output from step 1.
-
     if opts.include_dt:
         output_base_name = "step-1-files-changed-{0}.csv".format(now_tag)
         filename_out_files_changed = str(
@@ -280,27 +623,114 @@ def main(argv):
 
     print(f"Writing '{filename_out_files_changed}'")
 
-    with open(filename_out_files_changed, "w", newline="") as csv_file:
+    if prior is None:
+        row_num = 0
+    else:
+        row_num = prior.last_row
+
+    skip_list = set(opts.skip_list)
+
+    with contextlib.ExitStack() as stack:
+        csv_file = stack.enter_context(
+            open(filename_out_files_changed, "w", newline="")
+        )
         writer = csv.writer(csv_file)
 
         #  Add 'SKIP_Y', 'COMMIT_MESSAGE', 'ADD_COMMAND', and 'NOTES'
-        #  columns to populate manually in Step 2.
-        writer.writerow(
-            [
-                "row",
-                "sort_key",
-                "full_name",
-                "prev_full_name",
-                "datetime_tag",
-                "base_name",
-                "SKIP_Y",
-                "COMMIT_MESSAGE",
-                "ADD_COMMAND",
-                "NOTES",
-            ]
+        #  columns to populate manually in Step 2. The 'digest' column is
+        #  last so the manually edited columns keep their positions.
+        writer.writerow(STEP_1_COLUMNS)
+
+        #  When continuing, the existing rows come first, as they were.
+        if prior is not None:
+            for row in prior.rows:
+                writer.writerow([row.get(c, "") for c in STEP_1_COLUMNS])
+
+        #  Write all-files and datetime-tags lists for debugging, in the
+        #  same pass as the main output.
+        if opts.write_debug:
+            all_file = stack.enter_context(
+                open(
+                    output_path.joinpath("z-debug-1-all-files.csv"),
+                    "w",
+                    newline="",
+                )
+            )
+            all_writer = csv.writer(all_file)
+            all_writer.writerow(
+                [
+                    "sort_key",
+                    "full_name",
+                    "file_name",
+                    "base_name",
+                    "datetime_tag",
+                    "size",
+                    "mtime_ns",
+                ]
+            )
+            dt_tags_file = stack.enter_context(
+                open(output_path.joinpath("z-debug-3-datetime_tags.csv"), "w")
+            )
+            dt_tags_file.write("datetime_tag\n")
+
+        #  Each backup is compared with the version before it, just ahead
+        #  of the change detection: by size, then by content, and only the
+        #  changed ones are hashed for the digest column. Rows are written
+        #  as each datetime_tag is done, so nothing but the store is kept
+        #  for the whole scan.
+        compared_rows = compare_rows(
+            store, store.sorted_rows(), prev_rows, opts.jobs, index
         )
 
-        writer.writerows(changed_list)
+        flush_at = row_num + FLUSH_ROWS
+        for dt, rows, changes in iter_tag_changes(
+            store, prev_rows, compared_rows
+        ):
+            if opts.write_debug:
+                all_writer.writerows(store.get(row) for row in rows)
+                dt_tags_file.write(f"{dt}\n")
+
+            for row, prev_row in changes:
+                row_num += 1
+                writer.writerow(
+                    get_change_props(store, row, prev_row, row_num, skip_list)
+                )
+
+            #  Insert a separator row between each datetime_tag to make it
+            #  more obvious which files will be grouped in a commit.
+            row_num += 1
+            writer.writerow(
+                get_change_props(
+                    store, NO_ROW, NO_ROW, row_num, skip_list, dt
+                )
+            )
+
+            if flush_at <= row_num:
+                csv_file.flush()
+                if opts.write_debug:
+                    all_file.flush()
+                flush_at = row_num + FLUSH_ROWS
+
+    if index is not None:
+        n_files = len(store) - first_row
+        print(f"Index: {index.hits} of {n_files} files not re-read.")
+        #  After a scan of all the backups, the entries for backups that
+        #  no longer exist are removed.
+        if not (opts.continue_from or opts.include_list or opts.exclude_list):
+            pruned = index.prune()
+            if pruned:
+                print(f"Index: {pruned} entries removed.")
+        index.close()
+
+    #  Write base-names list for debugging.
+    if opts.write_debug:
+        filename_out_base_names = str(
+            output_path.joinpath("z-debug-2-base_names.csv")
+        )
+        with open(filename_out_base_names, "w", newline="") as out_file:
+            out_file.write("base_name\n")
+            for a in store.base_names():
+                out_file.write(f"{a}\n")
 
     print("Done (bak_to_git_1.py).")
 
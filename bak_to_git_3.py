@@ -6,45 +6,152 @@
 
 import argparse
 import csv
+import io
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from datetime import timedelta
+from itertools import groupby, islice, tee
+from operator import attrgetter
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from bak_to_common import (
     ask_to_continue,
+    copy_file_bytes,
     datetime_fromisoformat,
+    file_digest,
     log_fmt,
     plain_quotes,
     split_quoted,
     strip_outer_quotes,
 )
+from btg3_cache import FilterCache, filter_fingerprint
+from btg3_checkpoint import Checkpoint, groups_after, with_input_digests
+from btg3_filter import LineFilter
+from btg3_fast_import import (
+    FILE_MODE,
+    FastImportStream,
+    cleanup_message,
+    ident_name_email,
+    post_command_tag,
+    pre_command_ops,
+    raw_date,
+)
+from btg3_pack import (
+    OBJ_BLOB,
+    OBJ_COMMIT,
+    OBJ_TAG,
+    OBJ_TREE,
+    PackWriter,
+    commit_data,
+    object_id,
+    tag_data,
+    tree_data,
+)
+from btg3_pipeline import prefetch
+from btg3_plan import is_plan_file, iter_plan, write_plan
+from btg3_plumbing import GitObjectWriter, TreeBuilder, commit_tree, load_tree
+from btg3_verify import CatFileBatch
 
 
 AppOptions = namedtuple(
-    "AppOptions", "input_csv, repo_dir, log_dir, what_if, filter_file"
+    "AppOptions",
+    "input_csv, repo_dir, log_dir, what_if, filter_file, engine, cache_dir, "
+    + "cache_size, resume, "
+    + "plan_out, lookahead, shards, verify, filter_memory",
 )
 
 
 CommitProps = namedtuple(
     "CommitProps",
     "sort_key, full_name, datetime_tag, base_name, "
-    + "commit_message, add_command",
+    + "commit_message, add_command, digest",
+)
+
+CommitGroup = namedtuple(
+    "CommitGroup",
+    "datetime_tag, author_dt, commit_dt, commit_msg, pre_commit, "
+    + "post_commit, items",
+)
+
+#  What a shard worker process returns: the tree id and log messages for
+#  each group of the shard, the name of the pack it wrote (if any), and
+#  its filter cache counts.
+ShardResult = namedtuple(
+    "ShardResult", "trees, pack_name, objects, cache_hits, cache_misses"
+)
+
+#  What the first pass over the input file finds: the number of commit
+#  groups and files, the datetime tag and input digest of the last group,
+#  and the command operations of the groups that have any (see
+#  command_ops).
+InputScan = namedtuple(
+    "InputScan", "input_file, commits, files, last_tag, digest, ops"
 )
 
+#  The command operations of a group without pre-commit or post-commit
+#  commands.
+NO_OPS = ((), ())
+
+#  Name of the tool in the header of plan files.
+PLAN_TOOL = "bak_to_git_3"
+
+ENGINES = ["worktree", "staged", "fast-import", "plumbing", "pack"]
+
+#  The staged engine runs git with automatic gc (and the maintenance
+#  process 'git commit' starts for it) turned off, and repacks once at
+#  the end.
+STAGED_GIT = ["git", "-c", "gc.auto=0", "-c", "maintenance.auto=false"]
+
+#  Name of the checkpoint file, in the .git directory.
+CHECKPOINT_NAME = "bak_to_git_3-checkpoint.json"
+
+#  --verify hashes the files of the groups in batches of about this many
+#  files.
+VERIFY_BATCH = 4096
+
+#  The id of the empty tree, which git knows without it being stored.
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
 run_dt = datetime.now()
 
 log_path = Path.cwd() / f"log-bak_to_git_3-{run_dt:%Y%m%d_%H%M%S}.txt"
 
 filter_list = []
 
+line_filter = LineFilter(filter_list)
+
+filter_cache: Optional[FilterCache] = None
+
+filter_key = ""
+
+#  Files up to this size are filtered in memory. Larger files are filtered
+#  to a temporary file (in temp_dir), in pieces of a quarter of this size.
+filter_memory = 64 << 20
+
+temp_dir: Optional[tempfile.TemporaryDirectory] = None
+
+#  The filter cache is used from worker threads when files are prepared
+#  ahead (--lookahead).
+filter_cache_lock = threading.Lock()
+
+#  In a shard worker process (--shards), log messages are kept here, and
+#  written by the main process in order, instead of to the log file.
+log_lines: Optional[List[str]] = None
+
 
 def write_log(msg):
+    if log_lines is not None:
+        log_lines.append(msg)
+        return
     print(msg)
     with open(log_path, "a") as log_file:
         log_file.write(f"{msg}\n")
@@ -78,29 +185,224 @@ def git_date_strings(dt_tag):
     )
 
 
-def copy_filtered_content(src_name, dst_name):
+def write_filtered_content(src_name, dst_file, record):
+    """
+    Writes the filtered content of a file to dst_file (a text file),
+    calling record() with (line number, filter item) for each filter
+    applied. Does not write to the log (unless record does, see
+    log_applied), so it can be used from a worker thread.
+    """
     with open(src_name, "r") as src_file:
-        with open(dst_name, "w") as dst_file:
-            for num, line in enumerate(src_file.readlines(), start=1):
-                for filter_item in filter_list:
-                    if filter_item[0] in line:
-                        write_log(f"FILTER {src_name} ({num}): {filter_item}")
-                        line = line.replace(filter_item[0], filter_item[1])
-                dst_file.write(line)
+        line_filter.filter_file(src_file, dst_file, record)
 
 
-def load_filter_list(filter_file):
-    if filter_file is None:
+def log_applied(src_name, applied_list):
+    for num, filter_item in applied_list:
+        write_log(f"FILTER {src_name} ({num}): {filter_item}")
+
+
+def fits_in_memory(src_name) -> bool:
+    return os.path.getsize(src_name) <= filter_memory
+
+
+def use_filter_cache(src_name) -> bool:
+    return (
+        filter_cache is not None
+        and os.path.getsize(src_name)
+        <= min(filter_cache.max_bytes, filter_memory)
+    )
+
+
+def cached_filtered_content(src_name, digest) -> Tuple[bytes, list]:
+    """
+    Returns the filtered content of a file, and the filters applied,
+    from the filter cache if it has the output for the same content and
+    filters. Otherwise the file is filtered and the output added to the
+    cache.
+    """
+    key = filter_cache.key(digest or file_digest(src_name), filter_key)
+    with filter_cache_lock:
+        entry = filter_cache.get(key)
+        if entry is not None:
+            return entry
+
+    content, applied_list = filter_to_bytes(src_name)
+    with filter_cache_lock:
+        filter_cache.put(key, content, applied_list)
+    return content, applied_list
+
+
+def filter_to_bytes(src_name) -> Tuple[bytes, list]:
+    buf = io.BytesIO()
+    dst_file = io.TextIOWrapper(buf)
+    applied_list = []
+    write_filtered_content(src_name, dst_file, applied_list.append)
+    dst_file.flush()
+    return buf.getvalue(), applied_list
+
+
+def filter_to_temp(src_name, record) -> Path:
+    """
+    Filters a file to a new temporary file, which the caller removes
+    when done with it, and returns its path.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=temp_dir.name)
+    with open(fd, "w") as dst_file:
+        write_filtered_content(src_name, dst_file, record)
+    return Path(tmp_name)
+
+
+def spool_filter_to_temp(src_name) -> Tuple[Path, Iterator[Tuple]]:
+    """
+    Filters a file to a new temporary file, and returns its path, and the
+    filters applied. Those are also kept in a temporary file, rather than
+    in memory, until read (see read_spooled).
+    """
+    #  Each entry is kept as the line number and the index of the filter.
+    index = {item: i for i, item in enumerate(line_filter.items)}
+    fd, spool_name = tempfile.mkstemp(dir=temp_dir.name)
+    with open(fd, "w") as spool_file:
+        tmp_path = filter_to_temp(
+            src_name,
+            lambda entry: spool_file.write(f"{entry[0]} {index[entry[1]]}\n"),
+        )
+    return tmp_path, read_spooled(Path(spool_name), line_filter.items)
+
+
+def read_spooled(spool_path: Path, items: list) -> Iterator[Tuple]:
+    """
+    Yields the (line number, filter item) entries written to a file by
+    spool_filter_to_temp, then removes the file.
+    """
+    try:
+        with open(spool_path) as spool_file:
+            for line in spool_file:
+                num, i = line.split()
+                yield int(num), items[int(i)]
+    finally:
+        spool_path.unlink()
+
+
+def copy_filtered_content(src_name, dst_name, digest=""):
+    """
+    Copies a file, applying the filter list. When no filter can match, the
+    bytes are copied as is (newlines are not changed), and the destination
+    is not written if it already has the same content. The digest of the
+    source file (if known) is used as the filter cache key.
+    """
+    if not line_filter.could_match_file(src_name):
+        copy_file_bytes(src_name, dst_name)
         return
-    with open(filter_file) as f:
-        lines = f.readlines()
-    for line in lines:
-        s = line.strip()
-        if 0 < len(s) and not s.startswith("#"):
-            a = s.split(",")
-            assert 2 == len(a)
-            filter_item = (strip_outer_quotes(a[0]), strip_outer_quotes(a[1]))
-            filter_list.append(filter_item)
+    if use_filter_cache(src_name):
+        content, applied_list = cached_filtered_content(src_name, digest)
+        log_applied(src_name, applied_list)
+        Path(dst_name).write_bytes(content)
+        return
+    with open(dst_name, "w") as dst_file:
+        write_filtered_content(
+            src_name, dst_file, lambda entry: log_applied(src_name, [entry])
+        )
+
+
+#  Filtered content: the bytes, or, for a file larger than filter_memory,
+#  the path of a temporary file with them (see release_content).
+Content = Union[bytes, Path]
+
+
+def prepare_file(props: CommitProps) -> Optional[Tuple[Content, Iterable]]:
+    """
+    Returns the filtered content of a file, and the filters applied (to be
+    passed to use_prepared), or None if no filter can match (so the file
+    is used as is). Does not write to the log, so it can run in a worker
+    thread.
+    """
+    if not line_filter.could_match_file(props.full_name):
+        return None
+    if use_filter_cache(props.full_name):
+        return cached_filtered_content(props.full_name, props.digest)
+    if fits_in_memory(props.full_name):
+        return filter_to_bytes(props.full_name)
+    return spool_filter_to_temp(props.full_name)
+
+
+def release_content(content: Optional[Content]):
+    """
+    Removes the temporary file for filtered content, if there is one.
+    """
+    if isinstance(content, Path):
+        content.unlink()
+
+
+def prepare_group(group) -> Dict[str, Optional[Tuple[Content, Iterable]]]:
+    """
+    Returns the prepare_file() result for each file in a group, by
+    full_name.
+    """
+    return {props.full_name: prepare_file(props) for props in group.items}
+
+
+def use_prepared(src_name, ready) -> Optional[Content]:
+    """
+    Writes the FILTER log entries for a prepare_file() result, and returns
+    the filtered content, or None if the file is used as is.
+    """
+    if ready is None:
+        return None
+    content, applied_list = ready
+    log_applied(src_name, applied_list)
+    return content
+
+
+def fill_filter_cache(props: CommitProps):
+    """
+    In what-if mode, filters a file into the filter cache (if used), so
+    a following commit run does not need to filter it.
+    """
+    if use_filter_cache(props.full_name):
+        if line_filter.could_match_file(props.full_name):
+            _, applied_list = cached_filtered_content(
+                props.full_name, props.digest
+            )
+            log_applied(props.full_name, applied_list)
+
+
+def load_filter_list(filter_file):
+    filter_list.clear()
+    if filter_file is not None:
+        with open(filter_file) as f:
+            lines = f.readlines()
+        for line in lines:
+            s = line.strip()
+            if 0 < len(s) and not s.startswith("#"):
+                a = s.split(",")
+                assert 2 == len(a)
+                filter_item = (
+                    strip_outer_quotes(a[0]),
+                    strip_outer_quotes(a[1]),
+                )
+                filter_list.append(filter_item)
+
+    global line_filter, filter_key
+    #  A quarter of the memory limit for the text read at once, leaving
+    #  room for the copies made while replacing.
+    line_filter = LineFilter(filter_list, max(1, filter_memory // 4))
+    filter_key = filter_fingerprint(filter_list)
+
+
+def init_filters(filter_file, cache_dir, cache_size, memory_size):
+    global filter_memory, temp_dir
+    filter_memory = memory_size << 20
+
+    load_filter_list(filter_file)
+
+    if 0 < len(filter_list) and temp_dir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="btg3-")
+
+    global filter_cache
+    if cache_dir is not None and 0 < len(filter_list):
+        filter_cache = FilterCache(cache_dir, cache_size << 20)
+    else:
+        filter_cache = None
 
 
 def get_opts(argv) -> AppOptions:
@@ -112,7 +414,8 @@ def get_opts(argv) -> AppOptions:
         "input_csv",
         action="store",
         help="Path to CSV file, manually edited in step 2 to add commit "
-        + "messages.",
+        + "messages. Or a plan file (with a .jsonl extension) written by "
+        + "--plan-out.",
     )
 
     ap.add_argument(
@@ -138,6 +441,104 @@ def get_opts(argv) -> AppOptions:
         + 'comma-separated format ("old string", "new string").',
     )
 
+    ap.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        action="store",
+        help="Directory for a cache of filtered files, keyed by the content "
+        + "of the source file and the filter list, so files with the same "
+        + "content are only filtered once, also across runs. In what-if "
+        + "mode, files are filtered into the cache. Only used with "
+        + "--filter-file.",
+    )
+
+    ap.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=1024,
+        help="Maximum size, in MiB, of the files in the --cache-dir cache. "
+        + "The least recently used files are removed to stay under it. "
+        + "Default is 1024.",
+    )
+
+    ap.add_argument(
+        "--filter-memory",
+        dest="filter_memory",
+        type=int,
+        default=64,
+        help="Most memory, in MiB, to use for the content of a file when "
+        + "filtering it. Larger files are filtered in pieces, to a "
+        + "temporary file, and are not kept in the --cache-dir cache. "
+        + "Default is 64.",
+    )
+
+    ap.add_argument(
+        "--plan-out",
+        dest="plan_out",
+        action="store",
+        help="Write the plan (the commits to make, with their files, dates, "
+        + "messages, and pre-commit and post-commit commands) to this file, "
+        + "in JSON Lines format. Use a .jsonl extension so it can be given, "
+        + "after review, as the input file to make the commits without "
+        + "reading the CSV file again.",
+    )
+
+    ap.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Continue a run of the worktree or staged engine that stopped "
+        + "part way. After each commit the last datetime tag and commit id "
+        + f"are saved in '.git/{CHECKPOINT_NAME}'. With --resume, HEAD must "
+        + "still be that commit, and the working tree must be clean. Tags up "
+        + "to the saved one are skipped. The input file must be the same "
+        + "one, with the same commits up to the saved tag (later rows may be "
+        + "changed). The fast-import, plumbing, and pack engines only change "
+        + "the repository at the end (a run that stops leaves it as it was), "
+        + "so they save the checkpoint at the end, and do not resume.",
+    )
+
+    ap.add_argument(
+        "--lookahead",
+        dest="lookahead",
+        type=int,
+        default=0,
+        help="Number of upcoming datetime tags to prepare (read and filter "
+        + "the files for) in worker threads while git commits the current "
+        + "one. Commits are still made one at a time, in order, and the "
+        + "log is the same. Helps most with large files and many filters. "
+        + "Default is 0 (files are prepared when their tag is committed).",
+    )
+
+    ap.add_argument(
+        "--shards",
+        dest="shards",
+        type=int,
+        default=1,
+        help="With the pack engine, split the datetime tags into this many "
+        + "contiguous shards, and build the blobs and trees of each shard "
+        + "in its own process (each starting from the files as they are at "
+        + "the first tag of its shard). The commits are then made in "
+        + "order, linked to their parents, and are the same as a run "
+        + "without shards. Each shard writes its own pack file. "
+        + "Default is 1 (no separate processes).",
+    )
+
+    ap.add_argument(
+        "--verify",
+        dest="verify",
+        action="store_true",
+        help="Do not commit. Check that the last commits on the current "
+        + "branch of the repository, one for each datetime tag, are the "
+        + "ones the input makes. The expected tree of each commit is built "
+        + "from the (filtered) files, hashed in worker processes, and "
+        + "compared with the commit's tree, read through one 'git cat-file "
+        + "--batch' process. The commit and tag ids are also checked. Each "
+        + "datetime tag that differs, and the files that differ, are "
+        + "written to the log, and the exit status is 1.",
+    )
+
     ap.add_argument(
         "--what-if",
         dest="what_if",
@@ -145,6 +546,28 @@ def get_opts(argv) -> AppOptions:
         help="Run in 'what-if' mode, and do not ask to commit changes.",
     )
 
+    ap.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        default="worktree",
+        help="How commits are made. 'worktree' (the default) copies the "
+        + "files for each commit to the repository directory and runs "
+        + "'git commit'. 'staged' does the same, but adds new files with "
+        + "one 'git add' per commit, and limits 'git commit' to the paths "
+        + "of the commit ('git commit -i'), rather than checking the whole "
+        + "tree ('git commit -a'). It also turns off automatic gc, and "
+        + "repacks once at the end. 'fast-import' streams all commits to "
+        + "a single 'git fast-import' process, then updates the working "
+        + "tree at the end. 'plumbing' writes blobs, trees, and commits "
+        + "with git plumbing commands, without using the working tree, "
+        + "which is updated at the end. 'pack' writes all the objects "
+        + "straight to one new pack file, compressed in worker threads, "
+        + "then updates the branch, tags, and working tree. The "
+        + "fast-import, plumbing, and pack engines only support 'mv' and "
+        + "'rm' pre-commit commands, and 'tag' post-commit commands.",
+    )
+
     args = ap.parse_args(argv[1:])
 
     opts = AppOptions(
@@ -153,6 +576,15 @@ def get_opts(argv) -> AppOptions:
         args.log_dir,
         args.what_if,
         args.filter_file,
+        args.engine,
+        args.cache_dir,
+        args.cache_size,
+        args.resume,
+        args.plan_out,
+        args.lookahead,
+        args.shards,
+        args.verify,
+        args.filter_memory,
     )
 
     p = Path(opts.input_csv)
@@ -181,6 +613,41 @@ def get_opts(argv) -> AppOptions:
             sys.stderr.write(f"ERROR: File not found '{opts.filter_file}'")
             sys.exit(1)
 
+    if opts.cache_dir is not None:
+        if not Path(opts.cache_dir).is_dir():
+            sys.stderr.write(f"ERROR: Directory not found '{opts.cache_dir}'")
+            sys.exit(1)
+
+    if opts.filter_memory < 1:
+        sys.stderr.write("ERROR: --filter-memory must be at least 1")
+        sys.exit(1)
+
+    if opts.lookahead < 0:
+        sys.stderr.write("ERROR: --lookahead cannot be negative")
+        sys.exit(1)
+
+    if opts.shards < 1:
+        sys.stderr.write("ERROR: --shards must be at least 1")
+        sys.exit(1)
+
+    if opts.resume and opts.engine not in ("worktree", "staged"):
+        sys.stderr.write(
+            "ERROR: --resume is only used with --engine worktree or staged. "
+            + "The fast-import, plumbing, and pack engines only change the "
+            + "repository at the end, so a run that stops part way leaves "
+            + "it as it was. Run again without --resume.\n"
+        )
+        sys.exit(1)
+
+    if opts.verify and opts.resume:
+        sys.stderr.write("ERROR: --verify checks all datetime tags, so "
+                         + "cannot be used with --resume")
+        sys.exit(1)
+
+    if 1 < opts.shards and opts.engine != "pack":
+        sys.stderr.write("ERROR: --shards is only used with --engine pack")
+        sys.exit(1)
+
     return opts
 
 
@@ -196,178 +663,1447 @@ def run_git(cmds, run_dir, git_env):
     assert result.returncode == 0
 
 
-def main(argv):
-    opts = get_opts(argv)
+def git_output(cmds, run_dir, git_env=None) -> str:
+    result = subprocess.run(
+        cmds,
+        cwd=run_dir,
+        env=git_env,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0
+    return result.stdout.strip()
+
+
+def git_head(run_dir) -> Optional[str]:
+    """
+    Returns the commit id of HEAD, or None if there are no commits yet.
+    """
+    result = subprocess.run(
+        ["git", "rev-parse", "--verify", "-q", "HEAD"],
+        cwd=run_dir,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
 
-    global log_path
-    if opts.log_dir is not None:
-        log_path = (
-            Path(opts.log_dir).expanduser().resolve().joinpath(log_path.name)
-        )
 
-    write_log(f"BEGIN at {run_dt:%Y-%m-%d %H:%M:%S}")
+def read_commit_list(input_csv) -> Iterator[CommitProps]:
+    """
+    Yields the rows to commit, in the order they are in the file (the
+    order step 1 writes them, by datetime tag).
+    """
+    with open(input_csv, newline="") as csv_file:
+        reader = csv.DictReader(csv_file)
+        for row in reader:
+            if len(row["full_name"]) > 0:
+                do_skip = str(row["SKIP_Y"]).upper() == "Y"
+                if not do_skip:
+                    yield CommitProps(
+                        row["sort_key"],
+                        row["full_name"],
+                        row["datetime_tag"],
+                        row["base_name"],
+                        row["COMMIT_MESSAGE"],
+                        row["ADD_COMMAND"],
+                        row.get("digest") or "",
+                    )
 
-    if opts.what_if:
-        do_commit = False
+
+def get_commit_group(dt_tag, items: List[CommitProps]) -> CommitGroup:
+    """
+    Returns the commit for the items (rows) with the datetime tag dt_tag,
+    with the dates, combined commit message, and the pre-commit and
+    post-commit git commands.
+    """
+    author_dt, commit_dt = git_date_strings(dt_tag)
+
+    commit_msg = ""
+    pre_commit = []
+    post_commit = []
+
+    for item in items:
+        com_msg = plain_quotes(item.commit_message.strip())
+
+        #  Stop on non-ascii characters in the commit message.
+        #  TODO: This check should be temporary, just to see what
+        #  chars, besides left and right quotes, are showing up.
+        as_ascii = ascii(com_msg)
+        # if "\\u" in as_ascii:
+        if "\\" in as_ascii:
+            print(com_msg)
+            print(as_ascii)
+            assert 0
+
+        #  If the commit_message has only a single charcter,
+        #  treat it as ditto (no matter what character) indicating
+        #  the message is attached to another file in the same
+        #  commit, and the current file was reviewed in Step 2 of
+        #  the overall process.
+        if len(com_msg) == 1:
+            com_msg = ""
+
+        if 0 < len(com_msg):
+            if com_msg.endswith("."):
+                com_msg += " "
+            else:
+                com_msg += ". "
+
+        commit_msg += com_msg
+
+        add_cmd = item.add_command.strip()
+        if 0 < len(add_cmd):
+            if add_cmd.lower().startswith("pre:"):
+                pre_commit.append(add_cmd[4:].strip())
+            elif add_cmd.lower().startswith("post:"):
+                post_commit.append(add_cmd[5:].strip())
+            elif add_cmd.lower().startswith("rename:"):
+                pre_commit.append(git_mv_cmd(add_cmd, item.base_name))
+
+    if len(commit_msg) == 0:
+        commit_msg = f"({dt_tag})"
     else:
-        do_commit = ask_to_continue(
-            "Commit to repository (otherwise run in 'what-if' mode) [N,y]? ",
-            ["n", "y", ""]
-        ) == "y"
+        commit_msg = commit_msg.strip()
+
+    return CommitGroup(
+        dt_tag,
+        author_dt,
+        commit_dt,
+        commit_msg,
+        pre_commit,
+        post_commit,
+        list(items),
+    )
 
-    if do_commit:
-        write_log("MODE: COMMIT")
+
+def iter_commit_groups(
+    commit_list: Iterable[CommitProps],
+) -> Iterator[CommitGroup]:
+    """
+    Yields the commit group for each datetime tag, as the rows are read.
+    The rows must already be in datetime tag order, so only one group is
+    held at a time. The items of each group are sorted (by sort key).
+    Raises ValueError, when it is reached, for a datetime tag that comes
+    after a later one.
+    """
+    last_tag = None
+    for dt_tag, items in groupby(commit_list, attrgetter("datetime_tag")):
+        if last_tag is not None and dt_tag <= last_tag:
+            raise ValueError(
+                f"Rows for datetime tag {dt_tag} are after rows for "
+                + f"{last_tag}. The rows must be in datetime tag order."
+            )
+        last_tag = dt_tag
+        yield get_commit_group(dt_tag, sorted(items))
+
+
+def read_groups(input_file) -> Iterator[CommitGroup]:
+    """
+    Returns an iterator of the commit groups from a plan file (written by
+    --plan-out), or else from the step 2 CSV file. Each call reads the
+    file again.
+    """
+    if is_plan_file(input_file):
+        try:
+            return iter_plan(input_file, PLAN_TOOL, CommitGroup, CommitProps)
+        except ValueError as e:
+            sys.stderr.write(f"ERROR: {e}\n")
+            sys.exit(1)
+    return iter_commit_groups(read_commit_list(input_file))
+
+
+def scan_input(input_file, with_ops: bool) -> InputScan:
+    """
+    Reads the commit groups in a first pass, before anything is written
+    to the repository, to count them and check they are in order. With
+    with_ops, the commands of each group are also turned into command
+    operations, so any command the engine does not support is found
+    first. Exits with an error if any of that fails.
+    """
+    commits = 0
+    files = 0
+    last_tag = None
+    digest = None
+    ops = {}
+    try:
+        for group, digest in with_input_digests(read_groups(input_file)):
+            commits += 1
+            files += len(group.items)
+            last_tag = group.datetime_tag
+            if with_ops and (group.pre_commit or group.post_commit):
+                ops[last_tag] = command_ops(group)
+    except ValueError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.exit(1)
+    return InputScan(input_file, commits, files, last_tag, digest, ops)
+
+
+def prepared_groups(
+    groups: Iterable[CommitGroup], do_commit: bool, lookahead: int
+) -> Iterator[Tuple[CommitGroup, dict]]:
+    """
+    Yields each group, in order, with the prepare_group() result for it.
+    With a lookahead, the files for the groups ahead are prepared in
+    worker threads. Otherwise (or in what-if mode), the result is empty,
+    and files are read and filtered when used.
+    """
+    if do_commit and 0 < lookahead:
+        return prefetch(groups, prepare_group, lookahead)
+    return ((group, {}) for group in groups)
+
+
+def copy_group_file(
+    props: CommitProps,
+    target_name: Path,
+    commit_dt: str,
+    do_commit: bool,
+    prepared: Optional[dict],
+):
+    """
+    Copies a file to the repository directory, filtered, using the
+    prepare_group() result for it if there is one, and sets its
+    modification time to the commit date.
+    """
+    write_log(f"COPY {props.full_name}")
+    write_log(f"  TO {target_name}")
+
+    if not do_commit:
+        fill_filter_cache(props)
+        return
+
+    if prepared and props.full_name in prepared:
+        content = use_prepared(props.full_name, prepared[props.full_name])
+        if content is None:
+            copy_file_bytes(props.full_name, target_name)
+        elif isinstance(content, Path):
+            shutil.copyfile(content, target_name)
+            release_content(content)
+        else:
+            Path(target_name).write_bytes(content)
     else:
-        write_log("MODE: What-if (actions logged, repository not affected)")
+        copy_filtered_content(props.full_name, target_name, props.digest)
+    ts = datetime_fromisoformat(commit_dt).timestamp()
+    os.utime(target_name, (ts, ts))
+
+
+def commit_worktree(
+    group: CommitGroup,
+    target_path: Path,
+    do_commit: bool,
+    prepared: Optional[dict] = None,
+):
+    """
+    Commits a group by copying its files to the repository directory and
+    running 'git add' (for new files) and 'git commit -a'. If given,
+    prepared has the prepare_group() result for the group.
+    """
+    dt_tag = group.datetime_tag
+    commit_dt = group.commit_dt
+
+    git_env = {
+        "GIT_COMMITTER_DATE": commit_dt,
+        "GIT_AUTHOR_DATE": group.author_dt,
+    }
+    write_log(f"GIT ENV {git_env}")
+
+    #  Run any pre-commit git commands (such as 'mv').
+    for git_args in group.pre_commit:
+        cmds = ["git"] + split_quoted(git_args)
+        write_log("({0}) RUN (PRE): {1}".format(dt_tag, log_fmt(cmds)))
+        if do_commit:
+            run_git(cmds, target_path, git_env)
 
-    load_filter_list(opts.filter_file)
+    #  Copy files to commit for current date_time tag.
+    for props in group.items:
+        target_name = target_path / Path(props.base_name).name
+        existing_file = Path(target_name).exists()
 
-    commit_list: List[CommitProps] = []
+        copy_group_file(props, target_name, commit_dt, do_commit, prepared)
 
-    write_log(f"Read {opts.input_csv}")
+        if not existing_file:
+            cmds = ["git", "add", props.base_name]
+            write_log(
+                "({0}) RUN: {1}".format(props.datetime_tag, log_fmt(cmds))
+            )
+            if do_commit:
+                run_git(cmds, target_path, git_env)
 
-    with open(opts.input_csv, newline="") as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if len(row["full_name"]) > 0:
-                do_skip = str(row["SKIP_Y"]).upper() == "Y"
-                if not do_skip:
-                    commit_list.append(
-                        CommitProps(
-                            row["sort_key"],
-                            row["full_name"],
-                            row["datetime_tag"],
-                            row["base_name"],
-                            row["COMMIT_MESSAGE"],
-                            row["ADD_COMMAND"],
-                        )
-                    )
+    #  Run 'git commit' for current date_time tag.
+    cmds = ["git", "commit", "-a", "-m", group.commit_msg]
 
-    commit_list.sort()
+    write_log("({0}) RUN: {1}".format(dt_tag, log_fmt(cmds)))
 
-    datetime_tags = []
-    for item in commit_list:
-        if item.datetime_tag not in datetime_tags:
-            datetime_tags.append(item.datetime_tag)
+    if do_commit:
+        run_git(cmds, target_path, git_env)
 
-    datetime_tags.sort()
+    #  Run any post-commit git commands (such as 'tag').
+    for git_args in group.post_commit:
+        cmds = ["git"] + split_quoted(git_args)
+        write_log("({0}) RUN (POST): {1}".format(dt_tag, log_fmt(cmds)))
+        if do_commit:
+            run_git(cmds, target_path, git_env)
 
-    target_path = Path(opts.repo_dir).resolve()
 
-    for dt_tag in datetime_tags:
-        print(dt_tag)
+def commit_staged(
+    group: CommitGroup,
+    target_path: Path,
+    do_commit: bool,
+    prepared: Optional[dict] = None,
+):
+    """
+    Commits a group by copying its files to the repository directory,
+    adding the new ones with one 'git add', and running 'git commit -i'
+    with the paths of the group, so only those paths are staged (rather
+    than checking the whole tree for changes, as 'git commit -a' does).
+    Anything staged by the pre-commit commands is committed too. Git runs
+    with automatic gc and maintenance turned off (see STAGED_GIT).
+    """
+    dt_tag = group.datetime_tag
+    commit_dt = group.commit_dt
+
+    git_env = {
+        "GIT_COMMITTER_DATE": commit_dt,
+        "GIT_AUTHOR_DATE": group.author_dt,
+    }
+    write_log(f"GIT ENV {git_env}")
+
+    for git_args in group.pre_commit:
+        cmds = STAGED_GIT + split_quoted(git_args)
+        write_log("({0}) RUN (PRE): {1}".format(dt_tag, log_fmt(cmds)))
+        if do_commit:
+            run_git(cmds, target_path, git_env)
+
+    paths = []
+    new_paths = []
+    for props in group.items:
+        path = Path(props.base_name).name
+        target_name = target_path / path
+        if not target_name.exists():
+            new_paths.append(path)
+        copy_group_file(props, target_name, commit_dt, do_commit, prepared)
+        paths.append(path)
+
+    if new_paths:
+        cmds = STAGED_GIT + ["add", "--"] + new_paths
+        write_log("({0}) RUN: {1}".format(dt_tag, log_fmt(cmds)))
+        if do_commit:
+            run_git(cmds, target_path, git_env)
+
+    cmds = STAGED_GIT + ["commit", "-m", group.commit_msg, "-i", "--"]
+    cmds += list(dict.fromkeys(paths))
+    write_log("({0}) RUN: {1}".format(dt_tag, log_fmt(cmds)))
+    if do_commit:
+        run_git(cmds, target_path, git_env)
 
-        author_dt, commit_dt = git_date_strings(dt_tag)
+    for git_args in group.post_commit:
+        cmds = STAGED_GIT + split_quoted(git_args)
+        write_log("({0}) RUN (POST): {1}".format(dt_tag, log_fmt(cmds)))
+        if do_commit:
+            run_git(cmds, target_path, git_env)
 
+
+def command_ops(group: CommitGroup) -> tuple:
+    """
+    Returns the file operations for the pre-commit commands, and the tags
+    for the post-commit commands, of a group, for the engines that do not
+    run the commands as given. Raises ValueError for a command those
+    engines do not support.
+    """
+    pre_ops = []
+    for git_args in group.pre_commit:
+        pre_ops += pre_command_ops(split_quoted(git_args))
+    tags = [post_command_tag(split_quoted(a)) for a in group.post_commit]
+    return pre_ops, tags
+
+
+def get_file_modes(target_path: Path, head: Optional[str]) -> Dict[str, str]:
+    modes = {}
+    if head is not None:
+        out = git_output(["git", "ls-tree", "-r", "-z", head], target_path)
+        for entry in out.split("\0"):
+            if entry:
+                info, path = entry.split("\t", 1)
+                modes[path] = info.split()[0]
+    return modes
+
+
+def git_idents(target_path: Path) -> Tuple[str, str]:
+    """
+    Returns the author and committer identities ('Name <email>') git
+    uses for commits in the repository. The worktree engine runs git with
+    only the date variables in the environment, so they are found the
+    same way.
+    """
+    author = ident_name_email(
+        git_output(["git", "var", "GIT_AUTHOR_IDENT"], target_path, {})
+    )
+    committer = ident_name_email(
+        git_output(["git", "var", "GIT_COMMITTER_IDENT"], target_path, {})
+    )
+    return author, committer
+
+
+def run_fast_import(
+    groups: Iterable[CommitGroup],
+    scan: InputScan,
+    target_path: Path,
+    do_commit: bool,
+    lookahead: int = 0,
+):
+    """
+    Commits all groups through one 'git fast-import' process, on the
+    current branch, then updates the index and working tree to the new
+    HEAD. The commits (content, messages, dates, identities) are the same
+    as the worktree engine makes, so they get the same commit ids.
+    """
+    ops = scan.ops
+
+    if do_commit:
+        head = git_head(target_path)
+        ref = git_output(["git", "symbolic-ref", "HEAD"], target_path)
+        author, committer = git_idents(target_path)
+        modes = get_file_modes(target_path, head)
+        cmds = ["git", "fast-import", "--quiet", "--done"]
+        write_log(f"RUN: {log_fmt(cmds)}")
+        proc = subprocess.Popen(cmds, cwd=target_path, stdin=subprocess.PIPE)
+        stream = FastImportStream(proc.stdin)
+    else:
+        head = None
+        ref = "HEAD"
+        stream = None
+
+    file_times = {}
+    parent = head
+
+    for group, prepared in prepared_groups(groups, do_commit, lookahead):
+        print(group.datetime_tag)
+        dt_tag = group.datetime_tag
+        pre_ops, tags = ops.get(dt_tag, NO_OPS)
+        author_date = raw_date(datetime_fromisoformat(group.author_dt))
+        commit_date = raw_date(datetime_fromisoformat(group.commit_dt))
+
+        write_log(
+            "({0}) FAST-IMPORT: commit {1} {2}".format(
+                dt_tag, ref, log_fmt([group.commit_msg])
+            )
+        )
+        if stream is not None:
+            stream.commit(
+                ref,
+                f"{author} {author_date}",
+                f"{committer} {commit_date}",
+                cleanup_message(group.commit_msg),
+                parent,
+            )
+            parent = None
+
+        for op in pre_ops:
+            write_log(f"({dt_tag}) FAST-IMPORT (PRE): {log_fmt(op)}")
+            if stream is not None:
+                if op[0] == "R":
+                    stream.rename(op[1], op[2])
+                    modes[op[2]] = modes.pop(op[1], FILE_MODE)
+                    file_times[op[2]] = file_times.pop(op[1], None)
+                else:
+                    stream.delete(op[1])
+                    modes.pop(op[1], None)
+                    file_times.pop(op[1], None)
+
+        for props in group.items:
+            path = Path(props.base_name).name
+            write_log(f"COPY {props.full_name}")
+            write_log(f"  TO {path}")
+            if stream is not None:
+                if props.full_name in prepared:
+                    ready = prepared[props.full_name]
+                else:
+                    ready = prepare_file(props)
+                content = use_prepared(props.full_name, ready)
+                mode = modes.get(path, FILE_MODE)
+                if content is None:
+                    stream.modify_file(path, props.full_name, mode)
+                elif isinstance(content, Path):
+                    stream.modify_file(path, content, mode)
+                    release_content(content)
+                else:
+                    stream.modify(path, content, mode)
+                file_times[path] = group.commit_dt
+            else:
+                fill_filter_cache(props)
+
+        for name, msg in tags:
+            write_log(f"({dt_tag}) FAST-IMPORT (POST): tag {name}")
+            if stream is not None:
+                if msg is None:
+                    stream.lightweight_tag(name, stream.last_mark)
+                else:
+                    stream.annotated_tag(
+                        name,
+                        stream.last_mark,
+                        f"{committer} {commit_date}",
+                        cleanup_message(msg),
+                    )
+
+    if stream is None:
+        return
+
+    stream.done()
+    proc.stdin.close()
+    assert proc.wait() == 0
+
+    update_worktree(target_path, head, file_times)
+
+
+def update_worktree(target_path: Path, old_head: Optional[str], file_times):
+    """
+    Brings the index and working tree up to the new HEAD, after commits
+    were made without them, and sets the modification times of the
+    files committed (file_times maps path to commit date) as the
+    worktree engine would have.
+    """
+    old_tree = EMPTY_TREE if old_head is None else old_head
+    cmds = ["git", "read-tree", "-m", "-u", old_tree, "HEAD"]
+    write_log(f"RUN: {log_fmt(cmds)}")
+    run_git(cmds, target_path, None)
+
+    for path, commit_dt in file_times.items():
+        target_name = target_path / path
+        if commit_dt is not None and target_name.exists():
+            ts = datetime_fromisoformat(commit_dt).timestamp()
+            os.utime(target_name, (ts, ts))
+
+
+def run_plumbing(
+    groups: Iterable[CommitGroup],
+    scan: InputScan,
+    target_path: Path,
+    do_commit: bool,
+    lookahead: int = 0,
+):
+    """
+    Commits all groups using git plumbing commands, without the working
+    tree or index. Blobs and trees are written through long-running
+    'git hash-object' and 'git mktree' processes, from trees kept in
+    memory, and each commit is made with 'git commit-tree' (using the same
+    environment as the worktree engine, so commits get the same ids).
+    The branch and tags are updated, and the working tree checked out, at
+    the end, so a run that stops part way leaves the repository as it was.
+    """
+    ops = scan.ops
+
+    head = git_head(target_path) if do_commit else None
+    tree = TreeBuilder()
+    if head is not None:
+        load_tree(target_path, head, tree)
+    writer = GitObjectWriter(target_path) if do_commit else None
+
+    file_times = {}
+    tag_cmds = []
+    parent = head
+
+    for group, prepared in prepared_groups(groups, do_commit, lookahead):
+        print(group.datetime_tag)
+        dt_tag = group.datetime_tag
+        pre_ops, tags = ops.get(dt_tag, NO_OPS)
         git_env = {
-            "GIT_COMMITTER_DATE": commit_dt,
-            "GIT_AUTHOR_DATE": author_dt,
+            "GIT_COMMITTER_DATE": group.commit_dt,
+            "GIT_AUTHOR_DATE": group.author_dt,
         }
         write_log(f"GIT ENV {git_env}")
 
-        commit_msg = ""
-        pre_commit = []
-        post_commit = []
-        commit_this: List[CommitProps] = []
-
-        for item in commit_list:
-            if item.datetime_tag == dt_tag:
-                com_msg = plain_quotes(item.commit_message.strip())
-
-                #  Stop on non-ascii characters in the commit message.
-                #  TODO: This check should be temporary, just to see what
-                #  chars, besides left and right quotes, are showing up.
-                as_ascii = ascii(com_msg)
-                # if "\\u" in as_ascii:
-                if "\\" in as_ascii:
-                    print(com_msg)
-                    print(as_ascii)
-                    assert 0
-
-                #  If the commit_message has only a single charcter,
-                #  treat it as ditto (no matter what character) indicating
-                #  the message is attached to another file in the same
-                #  commit, and the current file was reviewed in Step 2 of
-                #  the overall process.
-                if len(com_msg) == 1:
-                    com_msg = ""
-
-                if 0 < len(com_msg):
-                    if com_msg.endswith("."):
-                        com_msg += " "
-                    else:
-                        com_msg += ". "
-
-                commit_msg += com_msg
-
-                add_cmd = item.add_command.strip()
-                if 0 < len(add_cmd):
-                    if add_cmd.lower().startswith("pre:"):
-                        pre_commit.append(add_cmd[4:].strip())
-                    elif add_cmd.lower().startswith("post:"):
-                        post_commit.append(add_cmd[5:].strip())
-                    elif add_cmd.lower().startswith("rename:"):
-                        pre_commit.append(git_mv_cmd(add_cmd, item.base_name))
-
-                commit_this.append(item)
-
-        #  Run any pre-commit git commands (such as 'mv').
-        if 0 < len(pre_commit):
-            for git_args in pre_commit:
-                cmds = ["git"] + split_quoted(git_args)
-                write_log("({0}) RUN (PRE): {1}".format(dt_tag, log_fmt(cmds)))
+        for op in pre_ops:
+            write_log(f"({dt_tag}) TREE (PRE): {log_fmt(op)}")
+            try:
+                if op[0] == "R":
+                    tree.rename(op[1], op[2])
+                    file_times[op[2]] = file_times.pop(op[1], None)
+                else:
+                    tree.remove(op[1])
+                    file_times.pop(op[1], None)
+            except KeyError as e:
                 if do_commit:
-                    run_git(cmds, target_path, git_env)
-
-        #  Copy files to commit for current date_time tag.
-        for props in commit_this:
-            target_name = target_path / Path(props.base_name).name
-            existing_file = Path(target_name).exists()
+                    sys.stderr.write(f"ERROR: ({dt_tag}) Not found: {e}\n")
+                    sys.exit(1)
 
+        for props in group.items:
+            path = Path(props.base_name).name
             write_log(f"COPY {props.full_name}")
-            write_log(f"  TO {target_name}")
+            write_log(f"  TO {path}")
+            if writer is not None:
+                if props.full_name in prepared:
+                    ready = prepared[props.full_name]
+                else:
+                    ready = prepare_file(props)
+                content = use_prepared(props.full_name, ready)
+                if content is None:
+                    blob_id = writer.write_blob_file(props.full_name)
+                elif isinstance(content, Path):
+                    blob_id = writer.write_blob_file(content)
+                    release_content(content)
+                else:
+                    blob_id = writer.write_blob(content)
+                entry = tree.get(path)
+                mode = FILE_MODE if entry is None else entry[0]
+                tree.set(path, mode, blob_id)
+                file_times[path] = group.commit_dt
+            else:
+                fill_filter_cache(props)
+
+        write_log(
+            "({0}) COMMIT-TREE: {1}".format(
+                dt_tag, log_fmt([group.commit_msg])
+            )
+        )
+        if writer is not None:
+            parent = commit_tree(
+                target_path,
+                tree.write(writer.write_tree),
+                parent,
+                cleanup_message(group.commit_msg),
+                git_env,
+            )
+
+        for name, msg in tags:
+            if msg is None:
+                cmds = ["git", "tag", name]
+            else:
+                cmds = ["git", "tag", "-a", name, "-m", msg]
+            write_log("({0}) RUN (POST): {1}".format(dt_tag, log_fmt(cmds)))
+            if writer is not None:
+                tag_cmds.append((cmds + [parent], git_env))
+
+    if writer is None:
+        return
+
+    writer.close()
 
+    if parent != head:
+        ref = git_output(["git", "symbolic-ref", "HEAD"], target_path)
+        cmds = ["git", "update-ref", ref, parent]
+        if head is not None:
+            cmds.append(head)
+        write_log(f"RUN: {log_fmt(cmds)}")
+        run_git(cmds, target_path, None)
+
+        #  Tags are made after the branch is updated, with the environment
+        #  of their commit (for the tagger date of annotated tags).
+        for cmds, git_env in tag_cmds:
+            write_log(f"RUN: {log_fmt(cmds)}")
+            run_git(cmds, target_path, git_env)
+
+        update_worktree(target_path, head, file_times)
+
+
+def pack_tree_ops(dt_tag, pre_ops, tree: TreeBuilder, do_commit: bool):
+    """
+    Applies the pre-commit file operations ('mv' and 'rm') of a group to
+    the tree. A file not found is an error when committing.
+    """
+    for op in pre_ops:
+        write_log(f"({dt_tag}) TREE (PRE): {log_fmt(op)}")
+        try:
+            if op[0] == "R":
+                tree.rename(op[1], op[2])
+            else:
+                tree.remove(op[1])
+        except KeyError as e:
             if do_commit:
-                #  Copy file to target repo location.
-                copy_filtered_content(props.full_name, target_name)
-                ts = datetime_fromisoformat(commit_dt).timestamp()
-                os.utime(target_name, (ts, ts))
+                sys.stderr.write(f"ERROR: ({dt_tag}) Not found: {e}\n")
+                sys.exit(1)
+
+
+def pack_group_files(
+    group: CommitGroup,
+    tree: TreeBuilder,
+    writer: Optional[PackWriter],
+    prepared,
+):
+    """
+    Adds the blobs for the files of a group to the pack, and sets them
+    in the tree. In what-if mode (no writer), only fills the filter cache.
+    """
+    for props in group.items:
+        path = Path(props.base_name).name
+        write_log(f"COPY {props.full_name}")
+        write_log(f"  TO {path}")
+        if writer is None:
+            fill_filter_cache(props)
+            continue
+        if props.full_name in prepared:
+            ready = prepared[props.full_name]
+        else:
+            ready = prepare_file(props)
+        content = use_prepared(props.full_name, ready)
+        if content is None and props.digest in writer:
+            #  Unfiltered, and the same as a blob already written
+            #  (the digest is the blob id of the source file).
+            blob_id = props.digest
+        elif content is None:
+            if fits_in_memory(props.full_name):
+                content = Path(props.full_name).read_bytes()
+                blob_id = writer.add(OBJ_BLOB, content)
+            else:
+                blob_id = writer.add_file(OBJ_BLOB, props.full_name)
+        elif isinstance(content, Path):
+            blob_id = writer.add_file(OBJ_BLOB, content)
+            release_content(content)
+        else:
+            blob_id = writer.add(OBJ_BLOB, content)
+        entry = tree.get(path)
+        mode = FILE_MODE if entry is None else entry[0]
+        tree.set(path, mode, blob_id)
+
+
+def group_file_times(group: CommitGroup, pre_ops, file_times):
+    """
+    Updates file_times (path to commit date, for update_worktree) for
+    the pre-commit file operations and files of a group.
+    """
+    for op in pre_ops:
+        if op[0] == "R":
+            file_times[op[2]] = file_times.pop(op[1], None)
+        else:
+            file_times.pop(op[1], None)
+    for props in group.items:
+        file_times[Path(props.base_name).name] = group.commit_dt
+
+
+def filtered_blob_id(props: CommitProps) -> Optional[str]:
+    """
+    Returns the id of the blob for the filtered content of a file, or None
+    if no filter can match. The filters applied are not kept.
+    """
+    if not line_filter.could_match_file(props.full_name):
+        return None
+    if use_filter_cache(props.full_name):
+        content, _ = cached_filtered_content(props.full_name, props.digest)
+    elif fits_in_memory(props.full_name):
+        content, _ = filter_to_bytes(props.full_name)
+    else:
+        tmp_path = filter_to_temp(props.full_name, lambda entry: None)
+        blob_id = file_digest(tmp_path)
+        tmp_path.unlink()
+        return blob_id
+    return object_id(OBJ_BLOB, content)
 
-            if not existing_file:
-                cmds = ["git", "add", props.base_name]
+
+def source_blob_id(props: CommitProps) -> str:
+    """
+    Returns the id of the blob a file is committed as, without writing it.
+    """
+    return (
+        filtered_blob_id(props)
+        or props.digest
+        or file_digest(props.full_name)
+    )
+
+
+def snapshot_tree(groups: Iterable[CommitGroup], ops, tree: TreeBuilder):
+    """
+    Brings the tree to the state after the given groups, without adding
+    anything to a pack. Only the last version of each file still in the
+    tree is read (and filtered) to find its blob id.
+    """
+    sources = {}
+    for group in groups:
+        for op in ops.get(group.datetime_tag, NO_OPS)[0]:
+            try:
+                if op[0] == "R":
+                    tree.rename(op[1], op[2])
+                else:
+                    tree.remove(op[1])
+            except KeyError:
+                #  Reported by the shard that commits the group.
+                pass
+        for props in group.items:
+            #  Hold the place with the sort key (never a valid object id)
+            #  until the blob id is known.
+            path = Path(props.base_name).name
+            entry = tree.get(path)
+            mode = FILE_MODE if entry is None else entry[0]
+            tree.set(path, mode, props.sort_key)
+            sources[props.sort_key] = props
+
+    for path, mode, blob_id in list(tree.files()):
+        if blob_id in sources:
+            tree.set(path, mode, source_blob_id(sources[blob_id]))
+
+
+def init_worker(filter_args):
+    global log_lines
+    init_filters(*filter_args)
+    log_lines = []
+
+
+def build_shard(
+    input_file,
+    start: int,
+    end: int,
+    ops,
+    target_path: Path,
+    head: Optional[str],
+) -> ShardResult:
+    """
+    Runs in a worker process. Reads the input file, and writes the blobs
+    and trees for groups start to end (not included) to a new pack,
+    starting from the tree as it is after the groups before them. Commits
+    are not made here, as a commit id depends on the id of its parent.
+    """
+    groups = read_groups(input_file)
+    tree = TreeBuilder()
+    if head is not None:
+        load_tree(target_path, head, tree)
+    snapshot_tree(islice(groups, start), ops, tree)
+
+    #  The shards already run in parallel, so compress in one thread.
+    writer = PackWriter(target_path / ".git", workers=1)
+
+    def make_tree(lines):
+        return writer.add(OBJ_TREE, tree_data(lines))
+
+    trees = []
+    try:
+        for group in islice(groups, end - start):
+            log_lines.clear()
+            pre_ops = ops.get(group.datetime_tag, NO_OPS)[0]
+            pack_tree_ops(group.datetime_tag, pre_ops, tree, True)
+            pack_group_files(group, tree, writer, {})
+            trees.append((tree.write(make_tree), list(log_lines)))
+    except BaseException:
+        writer.abort()
+        raise
+
+    pack_name = writer.close()
+    if filter_cache is None:
+        hits, misses = 0, 0
+    else:
+        hits, misses = filter_cache.hits, filter_cache.misses
+    return ShardResult(trees, pack_name, len(writer), hits, misses)
+
+
+def shard_bounds(
+    groups: Iterable[CommitGroup], files: int, shards: int
+) -> List[int]:
+    """
+    Returns the start index of each shard, splitting the groups (with the
+    given number of files in all) into up to the given number of
+    contiguous shards with about the same number of files.
+    """
+    starts = [0]
+    count = 0
+    end = 0
+    for end, group in enumerate(groups, start=1):
+        count += len(group.items)
+        if len(starts) < shards and files * len(starts) <= count * shards:
+            starts.append(end)
+    if starts[-1] == end and 1 < len(starts):
+        #  No shard starts after the last group.
+        starts.pop()
+    return starts
+
+
+def remove_pack(target_path: Path, pack_name: str):
+    pack_dir = target_path / ".git" / "objects" / "pack"
+    for ext in (".idx", ".pack"):
+        p = pack_dir / f"{pack_name}{ext}"
+        if p.exists():
+            p.unlink()
+
+
+def sharded_trees(
+    groups: Iterable[CommitGroup],
+    scan: InputScan,
+    target_path: Path,
+    head: Optional[str],
+    shards: int,
+    filter_args,
+) -> Iterator[Tuple[CommitGroup, str]]:
+    """
+    Yields (group, tree id) for each group, in order, as the shard worker
+    processes finish, writing the log messages of each group first. Each
+    worker reads the input file for its own shard. If anything fails, the
+    packs written by the shards are removed.
+    """
+    starts = shard_bounds(read_groups(scan.input_file), scan.files, shards)
+    ends = starts[1:] + [scan.commits]
+    groups = iter(groups)
+    packs = []
+    with ProcessPoolExecutor(
+        max_workers=len(starts),
+        initializer=init_worker,
+        initargs=(filter_args,),
+    ) as pool:
+        futures = [
+            pool.submit(
+                build_shard,
+                scan.input_file,
+                start,
+                end,
+                scan.ops,
+                target_path,
+                head,
+            )
+            for start, end in zip(starts, ends)
+        ]
+        try:
+            for start, end, future in zip(starts, ends, futures):
+                result = future.result()
+                packs.append(result.pack_name)
+                if filter_cache is not None:
+                    filter_cache.hits += result.cache_hits
+                    filter_cache.misses += result.cache_misses
+                first_tag = None
+                for group, (tree_id, msgs) in zip(
+                    islice(groups, end - start), result.trees
+                ):
+                    print(group.datetime_tag)
+                    first_tag = first_tag or group.datetime_tag
+                    for msg in msgs:
+                        write_log(msg)
+                    yield group, tree_id
                 write_log(
-                    "({0}) RUN: {1}".format(props.datetime_tag, log_fmt(cmds))
+                    "PACK {0} ({1} objects, tags {2} to {3})".format(
+                        result.pack_name,
+                        result.objects,
+                        first_tag,
+                        group.datetime_tag,
+                    )
                 )
-                if do_commit:
-                    run_git(cmds, target_path, git_env)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    packs.append(future.result().pack_name)
+            for pack_name in set(packs):
+                if pack_name is not None:
+                    remove_pack(target_path, pack_name)
+            raise
+
+
+def run_pack(
+    groups: Iterable[CommitGroup],
+    scan: InputScan,
+    target_path: Path,
+    do_commit: bool,
+    lookahead: int = 0,
+    shards: int = 1,
+    filter_args=(None, None, 0, 64),
+):
+    """
+    Commits all groups by writing their blobs, trees, commits, and
+    annotated tags straight to one new pack file (see PackWriter), with
+    no git process run per object or commit. The branch and tags are
+    then updated with one 'git update-ref --stdin', and the working tree
+    checked out. The commits are the same as the worktree engine makes.
+
+    With more than one shard, the blobs and trees are built in worker
+    processes (see build_shard), each writing its own pack, and only the
+    commits and tags are written to the pack here. filter_args are the
+    filter file, cache directory, cache size, and memory size for
+    init_filters() in the workers.
+    """
+    ops = scan.ops
+
+    head = git_head(target_path) if do_commit else None
+    if do_commit:
+        ref = git_output(["git", "symbolic-ref", "HEAD"], target_path)
+        author, committer = git_idents(target_path)
+        writer = PackWriter(target_path / ".git")
+    else:
+        ref = "HEAD"
+        writer = None
+
+    def serial_trees():
+        tree = TreeBuilder()
+        if head is not None:
+            load_tree(target_path, head, tree)
+
+        def make_tree(lines):
+            return writer.add(OBJ_TREE, tree_data(lines))
+
+        for group, prepared in prepared_groups(groups, do_commit, lookahead):
+            print(group.datetime_tag)
+            pre_ops = ops.get(group.datetime_tag, NO_OPS)[0]
+            pack_tree_ops(group.datetime_tag, pre_ops, tree, do_commit)
+            pack_group_files(group, tree, writer, prepared)
+            if writer is None:
+                yield group, None
+            else:
+                yield group, tree.write(make_tree)
+
+    if do_commit and 1 < shards and 1 < scan.commits:
+        group_trees = sharded_trees(
+            groups, scan, target_path, head, shards, filter_args
+        )
+    else:
+        group_trees = serial_trees()
 
-        #  Run 'git commit' for current date_time tag.
-        if len(commit_msg) == 0:
-            commit_msg = f"({dt_tag})"
-        else:
-            commit_msg = commit_msg.strip()
+    file_times = {}
+    parent = head
+    tag_refs = []
 
-        cmds = ["git", "commit", "-a", "-m", commit_msg]
+    try:
+        for group, tree_id in group_trees:
+            dt_tag = group.datetime_tag
+            pre_ops, tags = ops.get(dt_tag, NO_OPS)
+            group_file_times(group, pre_ops, file_times)
 
-        write_log("({0}) RUN: {1}".format(dt_tag, log_fmt(cmds)))
+            write_log(
+                "({0}) PACK: commit {1} {2}".format(
+                    dt_tag, ref, log_fmt([group.commit_msg])
+                )
+            )
+            if writer is None:
+                continue
+
+            author_date = raw_date(datetime_fromisoformat(group.author_dt))
+            commit_date = raw_date(datetime_fromisoformat(group.commit_dt))
+            parent = writer.add(
+                OBJ_COMMIT,
+                commit_data(
+                    tree_id,
+                    parent,
+                    f"{author} {author_date}",
+                    f"{committer} {commit_date}",
+                    cleanup_message(group.commit_msg),
+                ),
+            )
 
-        if do_commit:
-            run_git(cmds, target_path, git_env)
+            for name, msg in tags:
+                write_log(f"({dt_tag}) PACK (POST): tag {name}")
+                if msg is None:
+                    tag_refs.append((name, parent))
+                else:
+                    tag_id = writer.add(
+                        OBJ_TAG,
+                        tag_data(
+                            parent,
+                            name,
+                            f"{committer} {commit_date}",
+                            cleanup_message(msg),
+                        ),
+                    )
+                    tag_refs.append((name, tag_id))
+    except BaseException:
+        group_trees.close()
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is None:
+        return
 
-        #  Run any post-commit git commands (such as 'tag').
-        if 0 < len(post_commit):
-            for git_args in post_commit:
-                cmds = ["git"] + split_quoted(git_args)
-                write_log(
-                    "({0}) RUN (POST): {1}".format(dt_tag, log_fmt(cmds))
+    pack_name = writer.close()
+    write_log(f"PACK {pack_name} ({len(writer)} objects)")
+
+    if parent == head:
+        return
+
+    if head is None:
+        updates = [f"create {ref} {parent}"]
+    else:
+        updates = [f"update {ref} {parent} {head}"]
+    updates += [f"create refs/tags/{name} {obj}" for name, obj in tag_refs]
+    cmds = ["git", "update-ref", "--stdin"]
+    write_log(f"RUN: {log_fmt(cmds)}")
+    for line in updates:
+        write_log(f"  {line}")
+    result = subprocess.run(
+        cmds,
+        cwd=target_path,
+        input="".join(f"{line}\n" for line in updates),
+        universal_newlines=True,
+    )
+    assert result.returncode == 0
+
+    update_worktree(target_path, head, file_times)
+
+
+def file_blob_id(props: CommitProps) -> str:
+    """
+    Returns the id of the blob for the (filtered) content of a file.
+    Unlike source_blob_id, the file is always read, rather than using the
+    digest from the input.
+    """
+    return filtered_blob_id(props) or file_digest(props.full_name)
+
+
+def with_blob_ids(
+    groups: Iterable[CommitGroup], filter_args
+) -> Iterator[Tuple[CommitGroup, Dict[str, str]]]:
+    """
+    Yields each group with the blob id of each of its files, by full_name.
+    The files are read, filtered, and hashed in worker processes, for a
+    batch of groups with VERIFY_BATCH files or more at a time.
+    """
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(filter_args,)
+    ) as pool:
+
+        def hashed(batch, items):
+            blob_ids = pool.map(
+                file_blob_id,
+                items.values(),
+                chunksize=max(1, len(items) // (workers * 4)),
+            )
+            blob_ids = dict(zip(items, blob_ids))
+            for group in batch:
+                yield group, blob_ids
+
+        batch = []
+        items = {}
+        for group in groups:
+            batch.append(group)
+            items.update((p.full_name, p) for p in group.items)
+            if VERIFY_BATCH <= len(items):
+                yield from hashed(batch, items)
+                batch = []
+                items = {}
+        yield from hashed(batch, items)
+
+
+def run_verify(
+    groups: Iterable[CommitGroup],
+    scan: InputScan,
+    target_path: Path,
+    filter_args,
+) -> int:
+    """
+    Checks that the last commits on the current branch, one per group,
+    are the commits the groups make, without changing the repository.
+    For each group, the tree is compared with the one expected from the
+    files (built in memory, as the pack engine does), and the commit id
+    with the one expected for that tree, message, dates, and identities
+    on the actual parent (so one difference does not make every later
+    commit differ). The post-commit tags are checked the same way.
+    Returns the number of groups that differ.
+    """
+    ops = scan.ops
+
+    if scan.commits == 0:
+        return 0
+
+    if git_head(target_path) is None:
+        sys.stderr.write("ERROR: The repository has no commits to verify.\n")
+        sys.exit(1)
+
+    commits = git_output(
+        ["git", "rev-list", "--first-parent", "--reverse", "HEAD"],
+        target_path,
+    ).split()
+    n = scan.commits
+    if len(commits) < n:
+        sys.stderr.write(
+            "ERROR: The current branch has {0} commits, but the input has "
+            "{1} datetime tags.\n".format(len(commits), n)
+        )
+        sys.exit(1)
+    base = commits[-n - 1] if n < len(commits) else None
+    commits = commits[-n:]
+
+    write_log(f"VERIFY: Hash files for {n} datetime tags")
+    author, committer = git_idents(target_path)
+
+    def make_tree(lines):
+        return object_id(OBJ_TREE, tree_data(lines))
+
+    tree = TreeBuilder()
+    differ = 0
+
+    with CatFileBatch(target_path) as batch:
+        if base is not None:
+            base_files = batch.tree_files(batch.commit_tree_id(base))
+            for path, (mode, blob_id) in base_files.items():
+                tree.set(path, mode, blob_id)
+
+        parent = base
+        for (group, blob_ids), commit in zip(
+            with_blob_ids(groups, filter_args), commits
+        ):
+            dt_tag = group.datetime_tag
+            pre_ops, tags = ops.get(dt_tag, NO_OPS)
+            problems = []
+
+            for op in pre_ops:
+                try:
+                    if op[0] == "R":
+                        tree.rename(op[1], op[2])
+                    else:
+                        tree.remove(op[1])
+                except KeyError as e:
+                    problems.append(f"Not found: {e}")
+
+            for props in group.items:
+                path = Path(props.base_name).name
+                entry = tree.get(path)
+                mode = FILE_MODE if entry is None else entry[0]
+                tree.set(path, mode, blob_ids[props.full_name])
+
+            tree_id = tree.write(make_tree)
+            found_tree = batch.commit_tree_id(commit)
+            if found_tree != tree_id:
+                problems.append(
+                    f"Tree {found_tree} (expected {tree_id})"
                 )
-                if do_commit:
-                    run_git(cmds, target_path, git_env)
+                expected = {p: (m, b) for p, m, b in tree.files()}
+                found = batch.tree_files(found_tree)
+                for path in sorted(set(expected) | set(found)):
+                    if expected.get(path) != found.get(path):
+                        problems.append(
+                            "  {0}: {1} (expected {2})".format(
+                                path,
+                                " ".join(found.get(path, ["missing"])),
+                                " ".join(expected.get(path, ["none"])),
+                            )
+                        )
+
+            author_date = raw_date(datetime_fromisoformat(group.author_dt))
+            commit_date = raw_date(datetime_fromisoformat(group.commit_dt))
+            commit_id = object_id(
+                OBJ_COMMIT,
+                commit_data(
+                    tree_id,
+                    parent,
+                    f"{author} {author_date}",
+                    f"{committer} {commit_date}",
+                    cleanup_message(group.commit_msg),
+                ),
+            )
+            if commit_id != commit and found_tree == tree_id:
+                problems.append(
+                    f"Commit {commit} (expected {commit_id}, the message, "
+                    + "dates, or identities differ)"
+                )
+
+            for name, msg in tags:
+                if msg is None:
+                    tag_id = commit
+                else:
+                    tag_id = object_id(
+                        OBJ_TAG,
+                        tag_data(
+                            commit,
+                            name,
+                            f"{committer} {commit_date}",
+                            cleanup_message(msg),
+                        ),
+                    )
+                obj = batch.read(f"refs/tags/{name}")
+                if obj is None:
+                    problems.append(f"Tag {name} not found")
+                elif obj[0] != tag_id:
+                    problems.append(
+                        f"Tag {name} is {obj[0]} (expected {tag_id})"
+                    )
+
+            if problems:
+                differ += 1
+                write_log(f"({dt_tag}) VERIFY DIFFERS: commit {commit}")
+                for problem in problems:
+                    write_log(f"  {problem}")
+            else:
+                write_log(f"({dt_tag}) VERIFY OK: commit {commit}")
+            parent = commit
+
+    write_log(f"VERIFY: {n} datetime tags checked, {differ} differ")
+    return differ
+
+
+def resume_groups(
+    groups: Iterable[CommitGroup],
+    target_path: Path,
+    checkpoint: Checkpoint,
+    input_csv: str,
+) -> Iterator[Tuple[CommitGroup, str]]:
+    """
+    Returns an iterator of (group, input digest) for the groups after the
+    datetime tag saved in the checkpoint, after checking that the input
+    is the same up to that tag, the repository is still at the saved
+    commit, and the working tree is clean. Exits with an error otherwise.
+    """
+    saved = checkpoint.load()
+    if saved is None:
+        sys.stderr.write(f"ERROR: No checkpoint found '{checkpoint.path}'\n")
+        sys.exit(1)
+
+    try:
+        after = groups_after(saved, input_csv, groups)
+    except ValueError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.exit(1)
+
+    head = git_head(target_path)
+    if head != saved["commit"]:
+        sys.stderr.write(
+            "ERROR: HEAD ({0}) is not the checkpoint commit ({1}) for "
+            "datetime tag {2}.\n".format(
+                head, saved["commit"], saved["datetime_tag"]
+            )
+        )
+        sys.exit(1)
+
+    status = git_output(
+        ["git", "status", "--porcelain", "--untracked-files=all"], target_path
+    )
+    if status:
+        sys.stderr.write(
+            "ERROR: The working tree has changes since the checkpoint "
+            + "commit. Restore it to HEAD (for example, 'git reset --hard' "
+            + "and remove the untracked files) before resuming:\n"
+            + f"{status}\n"
+        )
+        sys.exit(1)
+
+    write_log(
+        "RESUME after {0} (commit {1})".format(
+            saved["datetime_tag"], saved["commit"]
+        )
+    )
+    return after
+
+
+def main(argv):
+    opts = get_opts(argv)
+
+    global log_path
+    if opts.log_dir is not None:
+        log_path = (
+            Path(opts.log_dir).expanduser().resolve().joinpath(log_path.name)
+        )
+
+    write_log(f"BEGIN at {run_dt:%Y-%m-%d %H:%M:%S}")
+
+    if opts.what_if or opts.verify:
+        do_commit = False
+    else:
+        do_commit = ask_to_continue(
+            "Commit to repository (otherwise run in 'what-if' mode) [N,y]? ",
+            ["n", "y", ""]
+        ) == "y"
+
+    if opts.verify:
+        write_log("MODE: Verify (repository not affected)")
+    elif do_commit:
+        write_log("MODE: COMMIT")
+    else:
+        write_log("MODE: What-if (actions logged, repository not affected)")
+
+    filter_args = (
+        opts.filter_file,
+        opts.cache_dir,
+        opts.cache_size,
+        opts.filter_memory,
+    )
+    init_filters(*filter_args)
+
+    write_log(f"Read {opts.input_csv}")
+
+    #  Only one commit group is held at a time. The input is read once
+    #  first, to check it (before anything is committed), count the
+    #  groups for the plan and the engines, and get the operations of
+    #  the commands for the engines that do not run them as given.
+    scan = scan_input(
+        opts.input_csv,
+        opts.verify or opts.engine not in ("worktree", "staged"),
+    )
+
+    if opts.plan_out is not None:
+        write_log(f"Write plan {opts.plan_out}")
+        write_plan(
+            opts.plan_out,
+            PLAN_TOOL,
+            read_groups(opts.input_csv),
+            opts.input_csv,
+            scan.commits,
+        )
+
+    target_path = Path(opts.repo_dir).resolve()
+
+    checkpoint = Checkpoint(target_path / ".git" / CHECKPOINT_NAME)
+
+    groups = read_groups(opts.input_csv)
+
+    differ = 0
+
+    if opts.verify:
+        differ = run_verify(groups, scan, target_path, filter_args)
+    elif opts.engine == "fast-import":
+        run_fast_import(groups, scan, target_path, do_commit, opts.lookahead)
+    elif opts.engine == "plumbing":
+        run_plumbing(groups, scan, target_path, do_commit, opts.lookahead)
+    elif opts.engine == "pack":
+        run_pack(
+            groups,
+            scan,
+            target_path,
+            do_commit,
+            opts.lookahead,
+            opts.shards,
+            filter_args,
+        )
+    else:
+        #  Each checkpoint is saved with a digest of the input up to its
+        #  tag.
+        if opts.resume:
+            pairs = resume_groups(
+                groups, target_path, checkpoint, opts.input_csv
+            )
+        else:
+            pairs = with_input_digests(groups)
+
+        #  The groups go through the lookahead pipeline, and the digest
+        #  for each is taken from a copy of the pairs as it is committed
+        #  (tee only holds the pairs in between).
+        group_pairs, digest_pairs = tee(pairs)
+        pipeline = prepared_groups(
+            (group for group, _ in group_pairs), do_commit, opts.lookahead
+        )
+        committed = 0
+        for (group, prepared), (_, digest) in zip(pipeline, digest_pairs):
+            print(group.datetime_tag)
+            if opts.engine == "staged":
+                commit_staged(group, target_path, do_commit, prepared)
+            else:
+                commit_worktree(group, target_path, do_commit, prepared)
+            committed += 1
+            if do_commit:
+                checkpoint.save(
+                    group.datetime_tag,
+                    git_head(target_path),
+                    opts.input_csv,
+                    digest,
+                )
+        if opts.engine == "staged" and committed:
+            cmds = STAGED_GIT + ["repack", "-d", "-q"]
+            write_log(f"RUN: {log_fmt(cmds)}")
+            if do_commit:
+                run_git(cmds, target_path, None)
+
+    if do_commit and scan.commits and opts.engine not in (
+        "worktree",
+        "staged",
+    ):
+        checkpoint.save(
+            scan.last_tag, git_head(target_path), opts.input_csv, scan.digest
+        )
+
+    if filter_cache is not None:
+        write_log(
+            f"Filter cache: {filter_cache.hits} hits, "
+            + f"{filter_cache.misses} misses"
+        )
 
     write_log(f"END at {datetime.now():%Y-%m-%d %H:%M:%S}")
 
     print("Done (bak_to_git_3.py).")
 
+    if differ:
+        return 1
+
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------
+#  bench_bak_to_git.py
+#
+#  Benchmarks for the bak_to_*.py scripts. Builds a synthetic tree of
+#  'wipbak' backup files, then times step 1, the step 2 progress report,
+#  and step 3 (git, and fossil if available) in what-if mode and against
+#  a new local repository. Results are written as JSON.
+#
+# ---------------------------------------------------------------------
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import bak_to_fossil_3
+import bak_to_git_1
+import bak_to_git_2
+import bak_to_git_3
+
+
+AppOptions = namedtuple(
+    "AppOptions",
+    "work_dir, output_file, n_files, n_tags, file_size, change_rate, "
+    + "rename_rate, seed, skip_commit",
+)
+
+CorpusProps = namedtuple("CorpusProps", "bak_path, n_backups, renames")
+
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo "
+    + "lima mike november oscar papa quebec romeo sierra tango uniform"
+).split()
+
+
+def random_line(rnd: random.Random) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 12)))
+
+
+def random_content(rnd: random.Random, size: int) -> list:
+    lines = []
+    n = 0
+    while n < size:
+        line = random_line(rnd)
+        lines.append(line)
+        n += len(line) + 1
+    return lines
+
+
+def make_wipbak_tree(
+    root: Path,
+    n_files: int,
+    n_tags: int,
+    file_size: int,
+    change_rate: float,
+    rename_rate: float,
+    seed: int = 1,
+) -> CorpusProps:
+    """
+    Makes a '_0_bak' directory under root with backup files named the way
+    'wipbak' names them ('<name>.<yyyymmdd_hhmmss>.bak'). Every file is
+    backed up at each datetime tag (as wipbak does). At each tag, a file's
+    content changes with probability change_rate, and the file is renamed
+    with probability rename_rate. Returns the path, the number of backup
+    files, and a list of (datetime_tag, old_name, new_name) renames.
+    """
+    rnd = random.Random(seed)
+    bak_path = root / "_0_bak"
+    bak_path.mkdir()
+
+    names = [f"file_{i:04d}.txt" for i in range(n_files)]
+    contents = [random_content(rnd, file_size) for _ in range(n_files)]
+    renames = []
+    n_backups = 0
+    n_renamed = 0
+    dt = datetime(2021, 1, 4, 8, 0, 0)
+
+    for t in range(n_tags):
+        dt_tag = dt.strftime("%Y%m%d_%H%M%S")
+        for i in range(n_files):
+            if 0 < t and rnd.random() < rename_rate:
+                n_renamed += 1
+                new_name = f"renamed_{n_renamed:04d}_{names[i]}"
+                renames.append((dt_tag, names[i], new_name))
+                names[i] = new_name
+            if 0 < t and rnd.random() < change_rate:
+                lines = contents[i]
+                lines[rnd.randrange(len(lines))] = random_line(rnd)
+            p = bak_path / f"{names[i]}.{dt_tag}.bak"
+            p.write_text("\n".join(contents[i]) + "\n")
+            n_backups += 1
+        dt += timedelta(minutes=rnd.randint(5, 600))
+
+    return CorpusProps(bak_path, n_backups, renames)
+
+
+def edit_step_1_csv(step_1_csv: Path, out_csv: Path, renames: list):
+    """
+    Does what is done manually in step 2: adds a commit message to every
+    row, and a 'rename:' command for the first row of each renamed file.
+    """
+    rename_cmds = {(t, new): f"rename: {old}" for t, old, new in renames}
+    with open(step_1_csv, newline="") as f:
+        reader = csv.DictReader(f)
+        flds = reader.fieldnames
+        rows = list(reader)
+    for row in rows:
+        if 0 < len(row["sort_key"]):
+            row["COMMIT_MESSAGE"] = f"Update {row['base_name']}"
+            key = (row["datetime_tag"], row["base_name"])
+            row["ADD_COMMAND"] = rename_cmds.get(key, "")
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=flds)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def git_init(repo_path: Path):
+    repo_path.mkdir()
+    for cmds in [
+        ["git", "init", "-q"],
+        ["git", "config", "user.name", "Bench Mark"],
+        ["git", "config", "user.email", "bench@example.com"],
+    ]:
+        subprocess.run(cmds, cwd=repo_path, check=True)
+
+
+def count_commits(repo_path: Path) -> int:
+    result = subprocess.run(
+        ["git", "rev-list", "--count", "HEAD"],
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    return int(result.stdout.strip()) if result.returncode == 0 else 0
+
+
+@contextlib.contextmanager
+def answer_prompts(module, answer):
+    """
+    Replaces the ask_to_continue function in a module so it does not
+    prompt for input.
+    """
+    saved = module.ask_to_continue
+    module.ask_to_continue = lambda prompt, choices: answer
+    try:
+        yield
+    finally:
+        module.ask_to_continue = saved
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    """
+    Sends standard output, including that of child processes (such as
+    git), to the null device.
+    """
+    sys.stdout.flush()
+    saved_fd = os.dup(1)
+    with open(os.devnull, "w") as null_file:
+        os.dup2(null_file.fileno(), 1)
+        try:
+            with contextlib.redirect_stdout(null_file):
+                yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved_fd, 1)
+            os.close(saved_fd)
+
+
+def time_it(results: list, name: str, func, *args, **kwargs):
+    print(f"  {name}")
+    t0 = time.perf_counter()
+    with quiet_stdout():
+        extra = func(*args, **kwargs)
+    secs = time.perf_counter() - t0
+    item = {"name": name, "seconds": round(secs, 4)}
+    if extra:
+        item.update(extra)
+    results.append(item)
+    print(f"    {secs:0.3f} seconds")
+    return item
+
+
+def run_benchmarks(opts: AppOptions) -> dict:
+    work_path = Path(opts.work_dir).expanduser().resolve()
+    run_path = work_path / f"bench-{datetime.now():%Y%m%d_%H%M%S_%f}"
+    run_path.mkdir()
+    results = []
+
+    print(f"Benchmark directory '{run_path}'")
+
+    print("  make_wipbak_tree")
+    corpus = make_wipbak_tree(
+        run_path,
+        opts.n_files,
+        opts.n_tags,
+        opts.file_size,
+        opts.change_rate,
+        opts.rename_rate,
+        opts.seed,
+    )
+    bak_path = corpus.bak_path
+    renames = corpus.renames
+
+    #  Step 1.
+    out_1 = run_path / "step_1"
+    out_1.mkdir()
+    time_it(
+        results,
+        "bak_to_git_1",
+        bak_to_git_1.main,
+        ["bak_to_git_1.py", str(bak_path), "--output-dir", str(out_1)],
+    )
+    step_1_csv = next(out_1.glob("*/step-1-files-changed.csv"))
+    with open(step_1_csv, newline="") as f:
+        n_rows = sum(1 for r in csv.DictReader(f) if r["sort_key"])
+    results[-1]["rows"] = n_rows
+
+    #  Step 2 (progress report only).
+    step_2_csv = run_path / "step-2-edited.csv"
+    edit_step_1_csv(step_1_csv, step_2_csv, renames)
+    stats_file = run_path / "btg2-stats.csv"
+    stats_file.write_text("")
+    time_it(
+        results,
+        "bak_to_git_2 --report",
+        bak_to_git_2.main,
+        [
+            "bak_to_git_2.py",
+            str(step_2_csv),
+            "--report",
+            "--stats-file",
+            str(stats_file),
+            "--log-dir",
+            str(run_path),
+        ],
+    )
+
+    #  Step 3 (git), with each engine committing to its own repository.
+    def git_args(repo_path):
+        return [
+            "bak_to_git_3.py",
+            str(step_2_csv),
+            str(repo_path),
+            "--log-dir",
+            str(run_path),
+        ]
+
+    what_if_repo = run_path / "git_repo"
+    git_init(what_if_repo)
+    time_it(
+        results,
+        "bak_to_git_3 what-if",
+        bak_to_git_3.main,
+        git_args(what_if_repo) + ["--what-if"],
+    )
+    if not opts.skip_commit:
+
+        def git_commit(engine):
+            repo_path = run_path / f"git_repo_{engine}"
+            git_init(repo_path)
+            with answer_prompts(bak_to_git_3, "y"):
+                bak_to_git_3.main(git_args(repo_path) + ["--engine", engine])
+            return {"commits": count_commits(repo_path)}
+
+        for engine in bak_to_git_3.ENGINES:
+            time_it(
+                results,
+                f"bak_to_git_3 commit --engine {engine}",
+                git_commit,
+                engine,
+            )
+
+    #  Step 3 (fossil).
+    fossil_exe = shutil.which("fossil")
+    if fossil_exe is None:
+        print("  Skipping bak_to_fossil_3: 'fossil' not found.")
+    else:
+        def fossil_args(repo_path):
+            return [
+                "bak_to_fossil_3.py",
+                str(step_2_csv),
+                str(repo_path),
+                "--init-date",
+                "2021-01-04T07:00:00",
+                "--fossil-exe",
+                fossil_exe,
+                "--log-dir",
+                str(run_path),
+            ]
+
+        def fossil_run(answer, engine):
+            repo_path = run_path / f"fossil_repo_{engine}"
+            with answer_prompts(bak_to_fossil_3, answer):
+                bak_to_fossil_3.main(
+                    fossil_args(repo_path) + ["--engine", engine]
+                )
+
+        time_it(
+            results, "bak_to_fossil_3 what-if", fossil_run, "n", "worktree"
+        )
+        if not opts.skip_commit:
+            for engine in bak_to_fossil_3.ENGINES:
+                time_it(
+                    results,
+                    f"bak_to_fossil_3 commit --engine {engine}",
+                    fossil_run,
+                    "y",
+                    engine,
+                )
+
+    git_version = subprocess.run(
+        ["git", "--version"], stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.strip()
+
+    return {
+        "run_at": f"{datetime.now():%Y-%m-%dT%H:%M:%S}",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "git": git_version,
+        "params": {
+            "n_files": opts.n_files,
+            "n_tags": opts.n_tags,
+            "file_size": opts.file_size,
+            "change_rate": opts.change_rate,
+            "rename_rate": opts.rename_rate,
+            "seed": opts.seed,
+        },
+        "corpus": {
+            "n_backups": corpus.n_backups,
+            "n_renames": len(renames),
+        },
+        "results": results,
+    }
+
+
+def get_opts(argv) -> AppOptions:
+    ap = argparse.ArgumentParser(
+        description="Benchmark the bak_to_*.py scripts using a synthetic "
+        + "tree of 'wipbak' backup files."
+    )
+
+    ap.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        default=".",
+        action="store",
+        help="Directory in which to create a run-specific directory for the "
+        + "synthetic backups, outputs, and repositories. Default is the "
+        + "current directory.",
+    )
+
+    ap.add_argument(
+        "--output",
+        dest="output_file",
+        default="bench_output.json",
+        action="store",
+        help="Name of the JSON file to write the results to. Default is "
+        + "'bench_output.json'.",
+    )
+
+    ap.add_argument(
+        "--files",
+        dest="n_files",
+        type=int,
+        default=10,
+        help="Number of source files in the synthetic project.",
+    )
+
+    ap.add_argument(
+        "--tags",
+        dest="n_tags",
+        type=int,
+        default=50,
+        help="Number of backup runs (datetime tags).",
+    )
+
+    ap.add_argument(
+        "--file-size",
+        dest="file_size",
+        type=int,
+        default=4096,
+        help="Approximate size, in bytes, of each source file.",
+    )
+
+    ap.add_argument(
+        "--change-rate",
+        dest="change_rate",
+        type=float,
+        default=0.2,
+        help="Probability that a file changed between backup runs.",
+    )
+
+    ap.add_argument(
+        "--rename-rate",
+        dest="rename_rate",
+        type=float,
+        default=0.01,
+        help="Probability that a file was renamed between backup runs.",
+    )
+
+    ap.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=1,
+        help="Seed for the random number generator.",
+    )
+
+    ap.add_argument(
+        "--skip-commit",
+        dest="skip_commit",
+        action="store_true",
+        help="Only time step 3 in what-if mode.",
+    )
+
+    args = ap.parse_args(argv[1:])
+
+    opts = AppOptions(
+        args.work_dir,
+        args.output_file,
+        args.n_files,
+        args.n_tags,
+        args.file_size,
+        args.change_rate,
+        args.rename_rate,
+        args.seed,
+        args.skip_commit,
+    )
+
+    if not Path(opts.work_dir).is_dir():
+        sys.stderr.write(f"ERROR: Directory not found '{opts.work_dir}'\n")
+        sys.exit(1)
+
+    return opts
+
+
+def main(argv):
+    opts = get_opts(argv)
+
+    report = run_benchmarks(opts)
+
+    print(f"Writing '{opts.output_file}'")
+    with open(opts.output_file, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+    print("Done (bench_bak_to_git.py).")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
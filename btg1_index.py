@@ -0,0 +1,129 @@
+import sqlite3
+
+from collections import namedtuple
+from pathlib import Path
+from typing import Optional
+
+
+#  An index entry: the digest of the file (None if it was not read for a
+#  digest), the path, size, and mtime_ns of the version it was compared
+#  with (all None for a new file), and whether it changed from that
+#  version.
+IndexEntry = namedtuple(
+    "IndexEntry", "digest, prev_path, prev_size, prev_mtime_ns, changed"
+)
+
+_COLUMNS = [
+    "path",
+    "size",
+    "mtime_ns",
+    "digest",
+    "prev_path",
+    "prev_size",
+    "prev_mtime_ns",
+    "changed",
+    "seen",
+]
+
+
+class ScanIndex:
+    """
+    Persistent index of the change decisions, and digests, for backup
+    files, stored in a SQLite database, used by bak_to_git_1 so re-runs
+    only read backups that are new or were modified since the previous
+    run. An entry is only used when the path, size, and modification time
+    (in nanoseconds) all match, and its change decision only when the
+    version it was compared with also matches.
+
+    Entries are looked up in the database as needed, rather than loaded
+    into memory. New entries are saved each time save_rows of them have
+    been set (and on close), so an interrupted scan keeps most of the work
+    it did. Each entry records the run that last saw it, so prune() can
+    remove the entries for backups that no longer exist. The index must
+    be used from the thread that created it.
+    """
+
+    def __init__(self, index_file: str, save_rows: int = 500):
+        p = Path(index_file).parent
+        if not p.exists():
+            raise FileNotFoundError(f"Cannot find directory '{p}'")
+
+        self.file_name = str(index_file)
+        self._con = sqlite3.connect(self.file_name)
+        columns = [
+            row[1] for row in self._con.execute("PRAGMA table_info(files)")
+        ]
+        if columns and columns != _COLUMNS:
+            #  Written by an older version. The index only saves work, so
+            #  it is started again.
+            with self._con:
+                self._con.execute("DROP TABLE files")
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            + "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            + "digest TEXT, prev_path TEXT, prev_size INTEGER, "
+            + "prev_mtime_ns INTEGER, changed INTEGER, seen INTEGER)"
+        )
+        self._run = self._con.execute(
+            "SELECT COALESCE(MAX(seen), 0) + 1 FROM files"
+        ).fetchone()[0]
+        self._new_entries = []
+        self._seen = []
+        self._save_rows = save_rows
+        #  Files not read because of the index (counted by the caller).
+        self.hits = 0
+
+    def get(self, path: str, size: int, mtime_ns: int) -> Optional[IndexEntry]:
+        row = self._con.execute(
+            "SELECT size, mtime_ns, digest, prev_path, prev_size, "
+            + "prev_mtime_ns, changed FROM files WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        self._seen.append((self._run, path))
+        self._save_if_due()
+        return IndexEntry(row[2], row[3], row[4], row[5], bool(row[6]))
+
+    def set(self, path: str, size: int, mtime_ns: int, entry: IndexEntry):
+        self._new_entries.append(
+            (path, size, mtime_ns) + tuple(entry) + (self._run,)
+        )
+        self._save_if_due()
+
+    def _save_if_due(self):
+        if self._save_rows <= len(self._new_entries) + len(self._seen):
+            self.save()
+
+    def save(self):
+        with self._con:
+            if 0 < len(self._new_entries):
+                self._con.executemany(
+                    "INSERT OR REPLACE INTO files ("
+                    + ", ".join(_COLUMNS)
+                    + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._new_entries,
+                )
+                self._new_entries.clear()
+            if 0 < len(self._seen):
+                self._con.executemany(
+                    "UPDATE files SET seen = ? WHERE path = ?", self._seen
+                )
+                self._seen.clear()
+
+    def prune(self) -> int:
+        """
+        Removes the entries that were not looked up or set in this run,
+        and returns how many were removed. Only use this after a scan of
+        all the backup files the index is for.
+        """
+        self.save()
+        with self._con:
+            cur = self._con.execute(
+                "DELETE FROM files WHERE seen < ?", (self._run,)
+            )
+        return cur.rowcount
+
+    def close(self):
+        self.save()
+        self._con.close()
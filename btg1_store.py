@@ -0,0 +1,230 @@
+import os
+
+from array import array
+from collections import namedtuple
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+BakProps = namedtuple(
+    "BakProps",
+    "sort_key, full_name, file_name, base_name, datetime_tag, size, mtime_ns",
+)
+
+
+#  Size, in bytes, of a digest as stored (a SHA-1 git blob id).
+DIGEST_SIZE = 20
+
+#  Stored in the size column when the size of a file is not known.
+UNKNOWN_SIZE = -1
+
+
+class _Interned:
+    """
+    Table of unique strings, each identified by an integer.
+    """
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def get_id(self, value: str) -> int:
+        i = self._ids.get(value)
+        if i is None:
+            i = len(self.values)
+            self.values.append(value)
+            self._ids[value] = i
+        return i
+
+    def __len__(self):
+        return len(self.values)
+
+
+class BakStore:
+    """
+    Compact, column-oriented store of the backup file properties used by
+    bak_to_git_1. Directory paths, base names, and datetime tags are
+    interned, so each row holds integer ids, and the columns are arrays.
+    Each row takes a few dozen bytes, rather than a namedtuple with
+    several full strings.
+
+    The file name is not stored. It is rebuilt from the base name and
+    datetime tag ('<base_name>.<datetime_tag>.bak'), except for the rare
+    names that do not follow that form, which are kept as is.
+
+    Rows are numbered in the order they are added. Use sort() after adding
+    the scanned files to get them in sort_key order by datetime tag.
+    """
+
+    def __init__(self):
+        self._dirs = _Interned()
+        self._base_names = _Interned()
+        self._tags = _Interned()
+        self._dir_col = array("I")
+        self._base_col = array("I")
+        self._tag_col = array("I")
+        self._size_col = array("q")
+        self._mtime_col = array("q")
+        self._digests = bytearray()
+        self._odd_names: Dict[int, str] = {}
+        self._order = array("I")
+        self._tag_bounds: List[Tuple[str, int, int]] = []
+
+    def __len__(self):
+        return len(self._base_col)
+
+    def add(
+        self,
+        full_name: str,
+        base_name: str,
+        datetime_tag: str,
+        size: Optional[int],
+        mtime_ns: Optional[int],
+    ) -> int:
+        """
+        Adds a row and returns its number.
+        """
+        dir_name, file_name = os.path.split(full_name)
+        row = len(self)
+        self._dir_col.append(self._dirs.get_id(dir_name))
+        self._base_col.append(self._base_names.get_id(base_name))
+        self._tag_col.append(self._tags.get_id(datetime_tag))
+        self._size_col.append(UNKNOWN_SIZE if size is None else size)
+        self._mtime_col.append(0 if mtime_ns is None else mtime_ns)
+        self._digests.extend(bytes(DIGEST_SIZE))
+        if file_name != f"{base_name}.{datetime_tag}.bak":
+            self._odd_names[row] = file_name
+        return row
+
+    def base_name(self, row: int) -> str:
+        return self._base_names.values[self._base_col[row]]
+
+    def datetime_tag(self, row: int) -> str:
+        return self._tags.values[self._tag_col[row]]
+
+    def file_name(self, row: int) -> str:
+        name = self._odd_names.get(row)
+        if name is None:
+            name = f"{self.base_name(row)}.{self.datetime_tag(row)}.bak"
+        return name
+
+    def full_name(self, row: int) -> str:
+        return os.path.join(
+            self._dirs.values[self._dir_col[row]], self.file_name(row)
+        )
+
+    def size(self, row: int) -> Optional[int]:
+        size = self._size_col[row]
+        return None if size == UNKNOWN_SIZE else size
+
+    def mtime_ns(self, row: int) -> int:
+        return self._mtime_col[row]
+
+    def digest(self, row: int) -> bytes:
+        """
+        Returns the digest, as bytes, or all zero bytes if it is not set.
+        """
+        i = row * DIGEST_SIZE
+        return bytes(self._digests[i:i + DIGEST_SIZE])
+
+    def hex_digest(self, row: int) -> Optional[str]:
+        d = self.digest(row)
+        return None if d == bytes(DIGEST_SIZE) else d.hex()
+
+    def set_hex_digest(self, row: int, hex_digest: str):
+        i = row * DIGEST_SIZE
+        self._digests[i:i + DIGEST_SIZE] = bytes.fromhex(hex_digest)
+
+    def get(self, row: int) -> BakProps:
+        """
+        Returns the properties of a row as a BakProps namedtuple.
+        """
+        base_name = self.base_name(row)
+        datetime_tag = self.datetime_tag(row)
+        return BakProps(
+            f"{datetime_tag}:{base_name}",
+            self.full_name(row),
+            self.file_name(row),
+            base_name,
+            datetime_tag,
+            self.size(row),
+            self.mtime_ns(row),
+        )
+
+    def base_names(self) -> List[str]:
+        """
+        Returns the sorted base names of the rows in the sorted order.
+        """
+        ids = {self._base_col[row] for row in self._order}
+        return sorted(self._base_names.values[i] for i in ids)
+
+    def sort(self, first_row: int = 0):
+        """
+        Sorts the rows, starting at first_row, by datetime tag, then base
+        name, then full name (the sort_key order), and groups them by
+        datetime tag. Rows before first_row are not part of the sorted
+        order (they can be used for earlier versions from another source).
+        """
+        tag_rank = array("I", bytes(4 * len(self._tags)))
+        for rank, i in enumerate(
+            sorted(range(len(self._tags)), key=self._tags.values.__getitem__)
+        ):
+            tag_rank[i] = rank
+        base_rank = array("I", bytes(4 * len(self._base_names)))
+        for rank, i in enumerate(
+            sorted(
+                range(len(self._base_names)),
+                key=self._base_names.values.__getitem__,
+            )
+        ):
+            base_rank[i] = rank
+
+        #  Sort on a single integer key per row. Rows with the same key
+        #  (the same file name in different directories) are then put in
+        #  full name order.
+        n_bases = len(self._base_names)
+        keys = array(
+            "q",
+            (
+                tag_rank[self._tag_col[i]] * n_bases
+                + base_rank[self._base_col[i]]
+                for i in range(first_row, len(self))
+            ),
+        )
+        order = sorted(
+            range(first_row, len(self)), key=lambda i: keys[i - first_row]
+        )
+        self._order = array("I", order)
+        del order
+
+        self._tag_bounds = []
+        start = 0
+        n = len(self._order)
+        while start < n:
+            key = keys[self._order[start] - first_row]
+            end = start + 1
+            while end < n and keys[self._order[end] - first_row] == key:
+                end += 1
+            if 1 < end - start:
+                self._order[start:end] = array(
+                    "I", sorted(self._order[start:end], key=self.full_name)
+                )
+            tag = self.datetime_tag(self._order[start])
+            if self._tag_bounds and self._tag_bounds[-1][0] == tag:
+                t, s, e = self._tag_bounds[-1]
+                self._tag_bounds[-1] = (t, s, end)
+            else:
+                self._tag_bounds.append((tag, start, end))
+            start = end
+
+    def sorted_rows(self) -> Iterator[int]:
+        return iter(self._order)
+
+    def datetime_tags(self) -> List[str]:
+        return [t for t, _, _ in self._tag_bounds]
+
+    def iter_tags(self) -> Iterator[Tuple[str, array]]:
+        """
+        Yields (datetime_tag, rows) in sorted order, after sort().
+        """
+        for tag, start, end in self._tag_bounds:
+            yield tag, self._order[start:end]
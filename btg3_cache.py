@@ -0,0 +1,132 @@
+import hashlib
+import json
+import locale
+import os
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+#  Suffix of the file, next to each cached output file, that holds the
+#  filter log records (line number and filter item) for the output.
+APPLIED_SUFFIX = ".applied.json"
+
+
+def filter_fingerprint(filter_list: List[Tuple[str, str]]) -> str:
+    """
+    Returns a digest of the filter list, and of the settings that affect
+    the bytes written for filtered text (encoding and line separator),
+    so cached output is only used with the same filters.
+    """
+    data = json.dumps(
+        [locale.getpreferredencoding(False), os.linesep, filter_list]
+    )
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class FilterCache:
+    """
+    On-disk cache of filtered output files, keyed by the digest of the
+    source content and the filter fingerprint, so a backup file with the
+    same content as one filtered before (in this run, or an earlier one)
+    is not filtered again. Along with each output file, the filter log
+    records are kept so the FILTER log entries can be written as if the
+    file was filtered.
+
+    The total size of the cached files is kept under max_bytes by removing
+    the least recently used entries. Use is tracked by modification time,
+    so it carries over between runs.
+    """
+
+    def __init__(self, cache_dir, max_bytes: int):
+        self.cache_path = Path(cache_dir)
+        if not self.cache_path.exists():
+            raise FileNotFoundError(f"Cannot find directory '{cache_dir}'")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+
+        found = []
+        for p in self.cache_path.glob("*/*"):
+            if p.name.endswith(APPLIED_SUFFIX) or p.name.endswith(".tmp"):
+                continue
+            st = p.stat()
+            found.append((st.st_mtime_ns, p.name, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def key(source_digest: str, fingerprint: str) -> str:
+        return hashlib.sha1(
+            f"{source_digest}:{fingerprint}".encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_path / key[:2] / key
+
+    def get(self, key: str) -> Optional[Tuple[bytes, List[Tuple]]]:
+        """
+        Returns the cached output, and the filter log records as a list
+        of (line number, filter item), or None if the key is not in the
+        cache. The output is read here, rather than returning its path,
+        since another process using the same cache directory could remove
+        the file at any time.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        p = self._path(key)
+        try:
+            applied = json.loads(
+                p.with_name(key + APPLIED_SUFFIX).read_text()
+            )
+            content = p.read_bytes()
+            os.utime(p)
+        except (OSError, ValueError):
+            #  Removed or damaged outside of this process.
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return content, [(num, tuple(item)) for num, item in applied]
+
+    def put(self, key: str, content: bytes, applied: List[Tuple]):
+        """
+        Adds filtered content, and its filter log records, to the cache,
+        then removes the least recently used entries over the size limit.
+        """
+        if self.max_bytes < len(content):
+            return
+        p = self._path(key)
+        p.parent.mkdir(exist_ok=True)
+        self._remove(key)
+        #  Other processes may use the same cache directory, so each file
+        #  is written under a name of this process, then moved into place.
+        tmp = p.with_name(f"{key}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(applied))
+        os.replace(tmp, p.with_name(key + APPLIED_SUFFIX))
+        tmp.write_bytes(content)
+        os.replace(tmp, p)
+        self._entries[key] = len(content)
+        self.total_bytes += len(content)
+
+        while self.max_bytes < self.total_bytes:
+            old_key = next(iter(self._entries))
+            self._remove(old_key)
+
+    def _remove(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+        self.total_bytes -= size
+        p = self._path(key)
+        for f in (p, p.with_name(key + APPLIED_SUFFIX)):
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+class Checkpoint:
+    """
+    Records, in a small JSON file, the last datetime tag fully committed
+    by a step 3 run, and the resulting commit (or check-in) id, so a run
+    that stops part way can be resumed from the next tag. The file is
+    replaced as a whole on each save, so it is never left half written.
+    """
+
+    def __init__(self, file_name):
+        self.path = Path(file_name)
+
+    def load(self) -> Optional[dict]:
+        """
+        Returns the checkpoint as a dict with 'datetime_tag', 'commit',
+        'input_csv', 'input_digest', and 'saved_at' keys, or None if there
+        is none.
+        """
+        if not self.path.exists():
+            return None
+        with open(self.path) as f:
+            data = json.load(f)
+        if not (data.get("datetime_tag") and "commit" in data):
+            raise ValueError(f"Invalid checkpoint file '{self.path}'")
+        return data
+
+    def save(
+        self,
+        datetime_tag: str,
+        commit_id: str,
+        input_csv: str,
+        input_digest: str,
+    ):
+        data = {
+            "datetime_tag": datetime_tag,
+            "commit": commit_id,
+            "input_csv": str(Path(input_csv).resolve()),
+            "input_digest": input_digest,
+            "saved_at": f"{datetime.now():%Y-%m-%dT%H:%M:%S}",
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+        os.replace(tmp, self.path)
+
+
+def with_input_digests(groups: Iterable) -> Iterator[Tuple]:
+    """
+    Yields (group, digest) for each commit group (a namedtuple with a list
+    of namedtuples as 'items'), where the digest covers that group and all
+    the groups before it. The digest saved with a checkpoint tells whether
+    the groups already committed are the same when resuming, while later
+    groups (such as one fixed after a failed run) may differ.
+    """
+    h = hashlib.sha1()
+    for group in groups:
+        entry = group._asdict()
+        entry["items"] = [item._asdict() for item in group.items]
+        h.update(json.dumps(entry).encode("utf-8") + b"\n")
+        yield group, h.hexdigest()
+
+
+def input_digests(groups: Iterable) -> List[str]:
+    """
+    Returns the digest (see with_input_digests) for each commit group.
+    """
+    return [digest for _, digest in with_input_digests(groups)]
+
+
+def groups_after(saved: dict, input_csv: str, groups: Iterable) -> Iterator:
+    """
+    Returns an iterator of (group, digest), as from with_input_digests,
+    for the groups after the datetime tag saved in a checkpoint. The
+    groups up to that tag are read, and checked, before this returns. The
+    input file must be the one the checkpoint was saved for, and the
+    groups up to the saved datetime tag must be the same, with the same
+    digest. Raises ValueError otherwise.
+    """
+    input_path = str(Path(input_csv).resolve())
+    if saved.get("input_csv") != input_path:
+        raise ValueError(
+            "The checkpoint was saved for input file '{0}', not '{1}'".format(
+                saved.get("input_csv"), input_path
+            )
+        )
+    dt_tag = saved["datetime_tag"]
+    pairs = with_input_digests(groups)
+    for group, digest in pairs:
+        if dt_tag <= group.datetime_tag:
+            break
+    else:
+        group = None
+    if (
+        group is None
+        or group.datetime_tag != dt_tag
+        or digest != saved.get("input_digest")
+    ):
+        raise ValueError(
+            f"The commits up to datetime tag {dt_tag} in '{input_path}' "
+            + "are not the same as when the checkpoint was saved"
+        )
+    return pairs
@@ -0,0 +1,223 @@
+import calendar
+import os
+import shutil
+import time
+
+from datetime import datetime
+from typing import BinaryIO, List, Optional, Tuple
+
+
+#  Mode for a regular (non-executable) file in a git tree.
+FILE_MODE = "100644"
+
+
+def raw_date(dt: datetime) -> str:
+    """
+    Returns a naive local datetime in the 'raw' date format used by
+    git fast-import ('<seconds since epoch> <+/-hhmm>'), with the UTC
+    offset in effect at that time, which is how git reads an
+    ISO format GIT_AUTHOR_DATE or GIT_COMMITTER_DATE without a time zone.
+    """
+    ts = int(dt.timestamp())
+    offset = time.localtime(ts).tm_gmtoff // 60
+    sign = "-" if offset < 0 else "+"
+    offset = abs(offset)
+    return f"{ts} {sign}{offset // 60:02d}{offset % 60:02d}"
+
+
+def raw_date_utc(dt: datetime) -> str:
+    """
+    Returns a naive UTC datetime in the 'raw' date format used by
+    git fast-import.
+    """
+    return f"{calendar.timegm(dt.timetuple())} +0000"
+
+
+def ident_name_email(ident: str) -> str:
+    """
+    Returns the 'Name <email>' part of an identity as output by
+    'git var GIT_AUTHOR_IDENT' (which ends with a timestamp and offset).
+    """
+    i = ident.rfind(">")
+    assert 0 < i, f"Invalid identity '{ident}'"
+    return ident[: i + 1]
+
+
+def cleanup_message(msg: str) -> str:
+    """
+    Cleans up a commit or tag message the way 'git commit -m' does by
+    default (cleanup mode 'whitespace'): trailing whitespace is removed
+    from each line, consecutive blank lines are collapsed, and leading
+    and trailing blank lines are removed. The result ends with a newline.
+    """
+    lines = []
+    for line in msg.splitlines():
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def pre_command_ops(args: List[str]) -> List[Tuple]:
+    """
+    Converts the arguments of a 'pre:' (or 'rename:') git command to
+    fast-import file operations. Only 'mv <old> <new>' (a rename) and
+    'rm <path>...' (delete) are supported. Raises ValueError for any
+    other command.
+    """
+    if 3 == len(args) and args[0] == "mv" and not args[1].startswith("-"):
+        return [("R", args[1], args[2])]
+    if 1 < len(args) and args[0] == "rm":
+        if not any(a.startswith("-") for a in args[1:]):
+            return [("D", a) for a in args[1:]]
+    raise ValueError(f"Not supported by fast-import: git {' '.join(args)}")
+
+
+def post_command_tag(args: List[str]) -> Tuple[str, Optional[str]]:
+    """
+    Converts the arguments of a 'post:' git command to a (tag_name,
+    message) tuple. The message is None for a lightweight tag. Only
+    'tag [-a] [-m <message>] <name>' is supported. Raises ValueError
+    for any other command.
+    """
+    err = ValueError(f"Not supported by fast-import: git {' '.join(args)}")
+    if len(args) < 2 or args[0] != "tag":
+        raise err
+    name = None
+    msg = None
+    annotate = False
+    i = 1
+    while i < len(args):
+        a = args[i]
+        if a in ("-a", "--annotate"):
+            annotate = True
+        elif a in ("-m", "--message"):
+            i += 1
+            if len(args) <= i:
+                raise err
+            msg = args[i]
+        elif a.startswith("-") or name is not None:
+            raise err
+        else:
+            name = a
+        i += 1
+    if name is None or (annotate and msg is None):
+        raise err
+    return name, msg
+
+
+class FastImportStream:
+    """
+    Writes a git fast-import stream (see 'git help fast-import') to a
+    binary file, such as the stdin of a 'git fast-import' process.
+    Commits are given marks (1, 2, ...) so later commits and tags can
+    refer to them.
+    """
+
+    def __init__(self, out: BinaryIO):
+        self._out = out
+        self.last_mark = 0
+
+    def _write(self, text: str):
+        self._out.write(text.encode("utf-8"))
+
+    def _data(self, data: bytes):
+        self._write(f"data {len(data)}\n")
+        self._out.write(data)
+        self._write("\n")
+
+    def _data_file(self, file_name):
+        #  The content of a file, copied in blocks.
+        with open(file_name, "rb") as f:
+            self._write(f"data {os.fstat(f.fileno()).st_size}\n")
+            shutil.copyfileobj(f, self._out)
+        self._write("\n")
+
+    @staticmethod
+    def quote_path(path: str) -> str:
+        s = path.replace("\\", "\\\\").replace('"', '\\"')
+        s = s.replace("\n", "\\n")
+        return f'"{s}"'
+
+    def commit(
+        self,
+        ref: str,
+        author: str,
+        committer: str,
+        message: str,
+        parent: Optional[str] = None,
+    ) -> int:
+        """
+        Starts a commit on ref. The author and committer are given as
+        'Name <email> <raw date>'. If parent (a commit id or ':mark') is
+        given, the commit is based on it. Otherwise it follows the previous
+        commit on ref in this stream. File operations are then added using
+        modify(), delete(), and rename(). Returns the commit mark.
+        """
+        self.last_mark += 1
+        self._write(f"commit {ref}\nmark :{self.last_mark}\n")
+        self._write(f"author {author}\ncommitter {committer}\n")
+        self._data(message.encode("utf-8"))
+        if parent:
+            self._write(f"from {parent}\n")
+        return self.last_mark
+
+    def blob(self, content: bytes) -> int:
+        """
+        Writes a blob, and returns its mark, for use with modify_ref().
+        Blobs must be written before the commit that refers to them.
+        """
+        self.last_mark += 1
+        self._write(f"blob\nmark :{self.last_mark}\n")
+        self._data(content)
+        return self.last_mark
+
+    def blob_file(self, file_name) -> int:
+        """
+        Writes a blob with the content of a file, copied to the stream in
+        blocks, and returns its mark.
+        """
+        self.last_mark += 1
+        self._write(f"blob\nmark :{self.last_mark}\n")
+        self._data_file(file_name)
+        return self.last_mark
+
+    def modify(self, path: str, content: bytes, mode: str = FILE_MODE):
+        self._write(f"M {mode} inline {self.quote_path(path)}\n")
+        self._data(content)
+
+    def modify_file(self, path: str, file_name, mode: str = FILE_MODE):
+        """
+        Sets the content of path to the content of a file, copied to the
+        stream in blocks.
+        """
+        self._write(f"M {mode} inline {self.quote_path(path)}\n")
+        self._data_file(file_name)
+
+    def modify_ref(self, path: str, data_ref: str, mode: str = FILE_MODE):
+        """
+        Sets the content of path to a blob given by data_ref (':mark' or
+        a blob id).
+        """
+        self._write(f"M {mode} {data_ref} {self.quote_path(path)}\n")
+
+    def delete(self, path: str):
+        self._write(f"D {self.quote_path(path)}\n")
+
+    def rename(self, old_path: str, new_path: str):
+        self._write(
+            f"R {self.quote_path(old_path)} {self.quote_path(new_path)}\n"
+        )
+
+    def lightweight_tag(self, name: str, mark: int):
+        self._write(f"reset refs/tags/{name}\nfrom :{mark}\n\n")
+
+    def annotated_tag(self, name: str, mark: int, tagger: str, message: str):
+        self._write(f"tag {name}\nfrom :{mark}\ntagger {tagger}\n")
+        self._data(message.encode("utf-8"))
+
+    def done(self):
+        self._write("done\n")
+        self._out.flush()
@@ -0,0 +1,259 @@
+import locale
+import os
+import re
+
+from typing import Callable, Dict, List, TextIO, Tuple
+
+
+#  Default for the most text (characters, or bytes when searching files)
+#  read from a file at once.
+DEFAULT_BUFFER_SIZE = 1 << 24
+
+
+def trie_pattern(strings: List[str]) -> str:
+    """
+    Returns a regular expression pattern that matches any of the strings,
+    with alternatives that share a prefix grouped together (as a trie),
+    so the regex engine tests each character once for all the strings
+    that share it, rather than once for each string.
+    """
+    trie: Dict = {}
+    for s in strings:
+        node = trie
+        for ch in s:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def pattern(node) -> str:
+        is_end = "" in node
+        alts = [
+            re.escape(ch) + pattern(sub)
+            for ch, sub in sorted(node.items())
+            if ch != ""
+        ]
+        if not alts:
+            return ""
+        if len(alts) == 1 and not is_end:
+            return alts[0]
+        s = "(?:" + "|".join(alts) + ")"
+        if is_end:
+            s += "?"
+        return s
+
+    return pattern(trie)
+
+
+class LineFilter:
+    """
+    The list of (old, new) string replacements from a filter file, with
+    all the old strings compiled into a single regular expression. A line
+    is scanned once with the regex and, if nothing matches (as for most
+    lines), is returned as is. Otherwise the replacements are applied in
+    order, each to the result of the ones before it, exactly as when
+    testing every replacement against every line.
+    """
+
+    def __init__(
+        self,
+        filter_list: List[Tuple[str, str]],
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+    ):
+        self.items = list(filter_list)
+        self.buffer_size = buffer_size
+        olds = [old for old, _ in self.items]
+        self._byte_regex = None
+        self._byte_overlap = 0
+        if not olds:
+            self._regex = None
+        elif "" in olds:
+            #  An empty string is in every line.
+            self._regex = re.compile("")
+        else:
+            self._regex = re.compile(trie_pattern(olds))
+            #  The same strings, as bytes in the encoding used to read text
+            #  files, so files can be checked without decoding them.
+            #  Latin-1 maps each byte to one character for trie_pattern.
+            encoding = locale.getpreferredencoding(False)
+            try:
+                assert "a\n".encode(encoding) == b"a\n"
+                byte_olds = [
+                    old.encode(encoding).decode("latin-1") for old in olds
+                ]
+                self._byte_regex = re.compile(
+                    trie_pattern(byte_olds).encode("latin-1")
+                )
+                #  Bytes kept from the end of each block searched, so a
+                #  match that spans two blocks is found.
+                self._byte_overlap = max(len(old) for old in byte_olds) - 1
+            except (AssertionError, UnicodeError, LookupError):
+                #  Not an ASCII-compatible encoding, so files are always
+                #  read as text.
+                pass
+
+    def __len__(self):
+        return len(self.items)
+
+    def could_match(self, text: str) -> bool:
+        """
+        Returns True if any replacement could apply to text. When False,
+        none of the replacements change it.
+        """
+        return self._regex is not None and bool(self._regex.search(text))
+
+    def could_match_file(self, file_name) -> bool:
+        """
+        Returns True if any replacement could apply to the content of the
+        file. The file is searched as bytes, in blocks of up to buffer_size,
+        without decoding it. When False, the file can be copied as is.
+        """
+        if self._regex is None:
+            return False
+        if self._byte_regex is None:
+            return True
+        if os.path.getsize(file_name) == 0:
+            return False
+        with open(file_name, "rb") as f:
+            tail = b""
+            while True:
+                block = f.read(self.buffer_size)
+                if not block:
+                    return False
+                data = tail + block if tail else block
+                if self._byte_regex.search(data) is not None:
+                    return True
+                if self._byte_overlap:
+                    tail = data[-self._byte_overlap:]
+
+    def apply(self, line: str) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        Returns the filtered line, and the replacements that were applied.
+        """
+        if not self.could_match(line):
+            return line, []
+        applied = []
+        for filter_item in self.items:
+            if filter_item[0] in line:
+                applied.append(filter_item)
+                line = line.replace(filter_item[0], filter_item[1])
+        return line, applied
+
+    def filter_file(
+        self,
+        src_file: TextIO,
+        dst_file: TextIO,
+        record: Callable[[Tuple[int, Tuple[str, str]]], None],
+    ):
+        """
+        Writes the filtered text of src_file to dst_file, calling record()
+        with (line number, filter item) for each replacement applied, the
+        same as apply() on each line. No more than buffer_size characters
+        are read at once, and the replacements applied are not kept, so
+        memory use does not depend on the size of the file, or of its
+        lines: a longer line is filtered in pieces (see _filter_long_line).
+        """
+        num = 0
+        while True:
+            line = src_file.readline(self.buffer_size)
+            if not line:
+                break
+            num += 1
+            if len(line) < self.buffer_size or line.endswith("\n"):
+                line, applied = self.apply(line)
+                dst_file.write(line)
+            else:
+                applied = self._filter_long_line(line, src_file, dst_file)
+            for filter_item in applied:
+                record((num, filter_item))
+
+    def _filter_long_line(
+        self, piece: str, src_file: TextIO, dst_file: TextIO
+    ) -> List[Tuple[str, str]]:
+        """
+        Filters the rest of a line longer than buffer_size, starting with
+        the piece already read. The pieces go through a chain of replacers,
+        one for each filter item, in order, so each replacement applies to
+        the result of the ones before it, as in apply().
+        """
+        chain = [_StreamReplace(old, new) for old, new in self.items]
+        found = [False] * len(chain)
+
+        def run_chain(text: str, start: int):
+            for i in range(start, len(chain)):
+                text, matched = chain[i].feed(text)
+                found[i] = found[i] or matched
+            dst_file.write(text)
+
+        while piece:
+            run_chain(piece, 0)
+            if len(piece) < self.buffer_size or piece.endswith("\n"):
+                break
+            piece = src_file.readline(self.buffer_size)
+
+        #  Pass the text held back by each replacer through the ones
+        #  after it.
+        for i, replacer in enumerate(chain):
+            run_chain(replacer.flush(), i + 1)
+
+        return [item for item, f in zip(self.items, found) if f]
+
+
+class _StreamReplace:
+    """
+    Replaces a string in text given in pieces, with the same result as
+    str.replace() on the whole text. The end of each piece that could be
+    the start of a match is held back, and put before the next piece.
+    """
+
+    def __init__(self, old: str, new: str):
+        self.old = old
+        self.new = new
+        self._held = ""
+        #  If no end of the string is also its start, occurrences cannot
+        #  overlap, so each one found is a match str.replace() makes.
+        self._overlaps = any(
+            old[i:] == old[:-i] for i in range(1, len(old))
+        )
+
+    def _last_match_end(self, s: str) -> int:
+        """
+        Returns the end of the last match str.replace() makes in s, or 0.
+        """
+        if not self._overlaps:
+            i = s.rfind(self.old)
+            return 0 if i < 0 else i + len(self.old)
+        pos = 0
+        while True:
+            i = s.find(self.old, pos)
+            if i < 0:
+                return pos
+            pos = i + len(self.old)
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """
+        Returns the text that is done, and whether a replacement was made.
+        """
+        if not self.old:
+            #  An empty string matches before every character (and at the
+            #  end, see flush).
+            return "".join(self.new + c for c in text), True
+        s = self._held + text
+        found = self.old in s
+        #  A match that starts after the last one that fits, and after
+        #  the end less the length of the string, could end in the next
+        #  piece. Replacing in the text before that point gives the same
+        #  matches as in the whole text.
+        end = len(s) - len(self.old) + 1
+        if found:
+            end = max(end, self._last_match_end(s))
+        self._held = s[end:]
+        return s[:end].replace(self.old, self.new), found
+
+    def flush(self) -> str:
+        """
+        Returns the text held back, at the end of the line.
+        """
+        if not self.old:
+            return self.new
+        s = self._held
+        self._held = ""
+        return s
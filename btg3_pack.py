@@ -0,0 +1,290 @@
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+
+#  Pack object type numbers.
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+
+#  Size of the blocks files are read in.
+BLOCK_SIZE = 1 << 20
+
+_TYPE_NAMES = {
+    OBJ_COMMIT: "commit",
+    OBJ_TREE: "tree",
+    OBJ_BLOB: "blob",
+    OBJ_TAG: "tag",
+}
+
+
+def object_id(obj_type: int, data: bytes) -> str:
+    """
+    Returns the git object id (SHA-1) of an object with the given type
+    and content.
+    """
+    h = hashlib.sha1(f"{_TYPE_NAMES[obj_type]} {len(data)}\0".encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+def file_object_id(obj_type: int, file_name) -> str:
+    """
+    Returns the git object id of an object with the content of a file,
+    read in blocks.
+    """
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h = hashlib.sha1(f"{_TYPE_NAMES[obj_type]} {size}\0".encode())
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tree_data(lines: List[str]) -> bytes:
+    """
+    Returns the content of a git tree object for a list of
+    'mode type id<TAB>name' entries (as given to 'git mktree'), sorted
+    the way git sorts them (a directory as if its name ended with '/').
+    """
+    entries = []
+    for line in lines:
+        info, name = line.split("\t", 1)
+        mode, kind, obj_id = info.split()
+        name_b = name.encode("utf-8")
+        key = name_b + b"/" if kind == "tree" else name_b
+        #  Git writes modes without leading zeros ('40000' for a tree).
+        entries.append((key, mode.lstrip("0"), name_b, bytes.fromhex(obj_id)))
+    entries.sort()
+    return b"".join(
+        mode.encode() + b" " + name + b"\0" + raw
+        for _, mode, name, raw in entries
+    )
+
+
+def commit_data(
+    tree_id: str,
+    parent: Optional[str],
+    author: str,
+    committer: str,
+    message: str,
+) -> bytes:
+    """
+    Returns the content of a git commit object. The author and committer
+    are given as 'Name <email> <raw date>', and the message exactly as it
+    is to be stored.
+    """
+    s = f"tree {tree_id}\n"
+    if parent:
+        s += f"parent {parent}\n"
+    s += f"author {author}\ncommitter {committer}\n\n{message}"
+    return s.encode("utf-8")
+
+
+def tag_data(target_id: str, name: str, tagger: str, message: str) -> bytes:
+    return (
+        f"object {target_id}\ntype commit\ntag {name}\n"
+        + f"tagger {tagger}\n\n{message}"
+    ).encode("utf-8")
+
+
+def _entry_header(obj_type: int, size: int) -> bytes:
+    #  Type and size, as a variable length number: the first byte has a
+    #  continuation bit, the type (3 bits), and the low 4 bits of the size.
+    b = (obj_type << 4) | (size & 0x0F)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(b | 0x80)
+        b = size & 0x7F
+        size >>= 7
+    out.append(b)
+    return bytes(out)
+
+
+def _compress(obj_type: int, data: bytes) -> bytes:
+    return _entry_header(obj_type, len(data)) + zlib.compress(data)
+
+
+class PackWriter:
+    """
+    Writes git objects (each stored whole, without deltas) to a single
+    new pack file, and its version 2 index, in the objects/pack directory
+    of a repository. An object with the same id as one already added is
+    not added again. The objects are compressed in a pool of worker
+    threads (zlib releases the GIL), while they are written to the pack
+    in the order they were added. No more than max_pending objects, or
+    max_pending_bytes of their content, wait to be written. Objects do
+    not exist in the repository until close().
+    """
+
+    def __init__(
+        self,
+        git_dir,
+        workers: int = 0,
+        max_pending: int = 64,
+        max_pending_bytes: int = 64 << 20,
+    ):
+        self._pack_dir = Path(git_dir) / "objects" / "pack"
+        self._pack_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(
+            prefix="tmp_pack_", dir=str(self._pack_dir)
+        )
+        self._tmp_path = Path(tmp_name)
+        self._file = os.fdopen(fd, "w+b")
+        self._file.write(b"PACK" + struct.pack(">II", 2, 0))
+        self._offset = 12
+        #  Object id -> (crc32, offset), for the index.
+        self._entries = {}
+        self._pending: deque = deque()
+        self._pending_bytes = 0
+        self._max_pending = max_pending
+        self._max_pending_bytes = max_pending_bytes
+        self._pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.pack_name = None
+
+    def __contains__(self, obj_id: str) -> bool:
+        return obj_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, obj_type: int, data: bytes) -> str:
+        """
+        Adds an object, and returns its id.
+        """
+        obj_id = object_id(obj_type, data)
+        if obj_id not in self._entries:
+            self._entries[obj_id] = None
+            future = self._pool.submit(_compress, obj_type, data)
+            self._pending.append((obj_id, len(data), future))
+            self._pending_bytes += len(data)
+            if (
+                self._max_pending <= len(self._pending)
+                or self._max_pending_bytes < self._pending_bytes
+            ):
+                self._write_pending(
+                    self._max_pending // 2, self._max_pending_bytes // 2
+                )
+        return obj_id
+
+    def add_file(self, obj_type: int, file_name) -> str:
+        """
+        Adds an object with the content of a file, and returns its id.
+        The file is read, and compressed, in blocks (in this thread), so
+        it is never held in memory as a whole.
+        """
+        obj_id = file_object_id(obj_type, file_name)
+        if obj_id in self._entries:
+            return obj_id
+        self._write_pending()
+        start = self._offset
+        with open(file_name, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            header = _entry_header(obj_type, size)
+            crc = zlib.crc32(header)
+            self._file.write(header)
+            self._offset += len(header)
+            z = zlib.compressobj()
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                data = z.compress(block)
+                crc = zlib.crc32(data, crc)
+                self._file.write(data)
+                self._offset += len(data)
+            data = z.flush()
+            crc = zlib.crc32(data, crc)
+            self._file.write(data)
+            self._offset += len(data)
+        self._entries[obj_id] = (crc, start)
+        return obj_id
+
+    def _write_pending(self, keep: int = 0, keep_bytes: int = 0):
+        while keep < len(self._pending) or keep_bytes < self._pending_bytes:
+            obj_id, size, future = self._pending.popleft()
+            self._pending_bytes -= size
+            entry = future.result()
+            self._entries[obj_id] = (zlib.crc32(entry), self._offset)
+            self._file.write(entry)
+            self._offset += len(entry)
+
+    def close(self) -> Optional[str]:
+        """
+        Finishes the pack, and its index, and moves them into place.
+        Returns the pack name ('pack-<checksum>'), or None if no objects
+        were added (and nothing is written).
+        """
+        self._write_pending()
+        self._pool.shutdown()
+        if not self._entries:
+            self._file.close()
+            self._tmp_path.unlink()
+            return None
+
+        #  The object count is in the header, so set it, then checksum
+        #  the whole file.
+        self._file.seek(8)
+        self._file.write(struct.pack(">I", len(self._entries)))
+        self._file.flush()
+        self._file.seek(0)
+        h = hashlib.sha1()
+        for chunk in iter(lambda: self._file.read(1 << 20), b""):
+            h.update(chunk)
+        pack_sum = h.digest()
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(pack_sum)
+        self._file.close()
+
+        name = f"pack-{pack_sum.hex()}"
+        idx_tmp = self._pack_dir / f"tmp_idx_{name}"
+        self._write_index(idx_tmp, pack_sum)
+        os.replace(self._tmp_path, self._pack_dir / f"{name}.pack")
+        os.replace(idx_tmp, self._pack_dir / f"{name}.idx")
+        self.pack_name = name
+        return name
+
+    def _write_index(self, path: Path, pack_sum: bytes):
+        ids = sorted(self._entries)
+        raw_ids = [bytes.fromhex(i) for i in ids]
+        fanout = [0] * 256
+        for raw in raw_ids:
+            fanout[raw[0]] += 1
+        total = 0
+        for i in range(256):
+            total += fanout[i]
+            fanout[i] = total
+
+        small = bytearray()
+        large = bytearray()
+        for i in ids:
+            offset = self._entries[i][1]
+            if offset < 0x80000000:
+                small += struct.pack(">I", offset)
+            else:
+                small += struct.pack(">I", 0x80000000 | (len(large) // 8))
+                large += struct.pack(">Q", offset)
+
+        data = bytearray(b"\377tOc" + struct.pack(">I", 2))
+        data += struct.pack(">256I", *fanout)
+        data += b"".join(raw_ids)
+        data += b"".join(struct.pack(">I", self._entries[i][0]) for i in ids)
+        data += small + large + pack_sum
+        data += hashlib.sha1(data).digest()
+        path.write_bytes(data)
+
+    def abort(self):
+        """
+        Stops without adding anything to the repository.
+        """
+        self._pool.shutdown()
+        self._file.close()
+        if self._tmp_path.exists():
+            self._tmp_path.unlink()
@@ -0,0 +1,41 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple
+
+
+def prefetch(
+    items: Iterable, fn: Callable, lookahead: int
+) -> Iterator[Tuple]:
+    """
+    Yields (item, fn(item)) for each item, in order. With a lookahead of
+    one or more, fn is run in a pool of that many threads for up to that
+    many items ahead of the one being used, so preparing the next items
+    overlaps with the caller's work on the current one (such as waiting
+    for git). Otherwise fn is run for each item when it is reached.
+    An exception raised by fn is raised when its item is reached.
+    """
+    if lookahead < 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    it = iter(items)
+    pending: deque = deque()
+    pool = ThreadPoolExecutor(max_workers=lookahead)
+    try:
+        for item in it:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) == lookahead:
+                break
+        while pending:
+            item, future = pending.popleft()
+            #  Keep the pool busy while the caller uses this item.
+            for next_item in it:
+                pending.append((next_item, pool.submit(fn, next_item)))
+                break
+            yield item, future.result()
+    finally:
+        #  If the caller stops early, do not start the remaining items.
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
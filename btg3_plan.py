@@ -0,0 +1,106 @@
+import json
+
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+
+#  Input files with this suffix are read as a plan instead of a CSV file.
+PLAN_SUFFIX = ".jsonl"
+
+PLAN_VERSION = 1
+
+
+def is_plan_file(file_name) -> bool:
+    return Path(file_name).suffix.lower() == PLAN_SUFFIX
+
+
+def write_plan(
+    file_name,
+    tool: str,
+    groups: Iterable,
+    input_csv: str,
+    commits: Optional[int] = None,
+):
+    """
+    Writes the commit groups (CommitGroup namedtuples, with a list of
+    CommitProps namedtuples as 'items') to a plan file in JSON Lines
+    format. The first line is a header naming the tool the plan is for.
+    Each following line is one commit, with the resolved target name
+    ('target') added to each item for review. When groups is an iterator,
+    commits must give the number of groups, as the header comes first.
+    """
+    if commits is None:
+        commits = len(groups)
+    with open(file_name, "w") as f:
+        header = {
+            "plan": tool,
+            "version": PLAN_VERSION,
+            "input_csv": str(input_csv),
+            "commits": commits,
+        }
+        f.write(json.dumps(header) + "\n")
+        for group in groups:
+            entry = group._asdict()
+            entry["items"] = [
+                dict(item._asdict(), target=Path(item.base_name).name)
+                for item in group.items
+            ]
+            f.write(json.dumps(entry) + "\n")
+
+
+def iter_plan(file_name, tool: str, group_type, props_type) -> Iterator:
+    """
+    Reads a plan file written by write_plan() for the same tool, and
+    yields the commit groups, in order, as group_type namedtuples, with
+    items as props_type namedtuples. The header is checked before this
+    returns. Raises ValueError if the file is not a plan for the tool,
+    and, when the entries are read, if an entry does not have the
+    expected fields, is out of order, or the plan is incomplete.
+    """
+    with open(file_name) as f:
+        header_line = f.readline()
+    if not header_line.strip():
+        raise ValueError(f"Empty plan file '{file_name}'")
+    header = json.loads(header_line)
+    if header.get("plan") != tool or header.get("version") != PLAN_VERSION:
+        raise ValueError(
+            f"'{file_name}' is not a version {PLAN_VERSION} plan for {tool}"
+        )
+    return _plan_entries(file_name, header, group_type, props_type)
+
+
+def _plan_entries(file_name, header, group_type, props_type) -> Iterator:
+    count = 0
+    last_tag = None
+    with open(file_name) as f:
+        f.readline()
+        for num, line in enumerate(f, start=2):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                entry["items"] = [
+                    props_type(*[item[k] for k in props_type._fields])
+                    for item in entry["items"]
+                ]
+                group = group_type(*[entry[k] for k in group_type._fields])
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(
+                    f"Invalid plan entry at '{file_name}' line {num}: {e!r}"
+                )
+            if last_tag is not None and group.datetime_tag <= last_tag:
+                raise ValueError(f"Plan commits out of order in '{file_name}'")
+            last_tag = group.datetime_tag
+            count += 1
+            yield group
+
+    if header.get("commits") != count:
+        raise ValueError(f"Incomplete plan file '{file_name}'")
+
+
+def read_plan(file_name, tool: str, group_type, props_type) -> List:
+    """
+    Returns all the commit groups in a plan file (see iter_plan) as a
+    list.
+    """
+    return list(iter_plan(file_name, tool, group_type, props_type))
@@ -0,0 +1,229 @@
+import subprocess
+import tempfile
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+
+#  Mode for a tree (directory) entry in a git tree.
+TREE_MODE = "040000"
+
+
+class _Dir:
+    def __init__(self):
+        #  Name -> (mode, blob id) for files, or _Dir for subdirectories.
+        self.entries: Dict[str, Union[Tuple[str, str], "_Dir"]] = {}
+        #  Id of the tree as last written, or None if it has changed since.
+        self.tree_id: Optional[str] = None
+
+
+class TreeBuilder:
+    """
+    In-memory tree of (mode, blob id) entries, by path, for building
+    the git tree of each commit without a working tree or index. Only
+    directories that changed since the previous write() are written
+    again, so the cost of each commit depends on the files in it, and
+    their directories, rather than the size of the whole tree.
+    """
+
+    def __init__(self):
+        self._root = _Dir()
+
+    def _dir_path(self, parts: List[str], create: bool) -> List[_Dir]:
+        """
+        Returns the list of directories from the root down to the one
+        at parts, creating them if create is True. The list is cut short
+        if a directory does not exist.
+        """
+        d = self._root
+        dirs = [d]
+        for name in parts:
+            sub = d.entries.get(name)
+            if not isinstance(sub, _Dir):
+                if not create:
+                    break
+                sub = _Dir()
+                d.entries[name] = sub
+            d = sub
+            dirs.append(d)
+        return dirs
+
+    def get(self, path: str) -> Optional[Tuple[str, str]]:
+        parts = path.split("/")
+        dirs = self._dir_path(parts[:-1], False)
+        if len(dirs) < len(parts):
+            return None
+        entry = dirs[-1].entries.get(parts[-1])
+        return None if isinstance(entry, _Dir) else entry
+
+    def set(self, path: str, mode: str, blob_id: str):
+        parts = path.split("/")
+        dirs = self._dir_path(parts[:-1], True)
+        for d in dirs:
+            d.tree_id = None
+        dirs[-1].entries[parts[-1]] = (mode, blob_id)
+
+    def remove(self, path: str) -> Tuple[str, str]:
+        """
+        Removes a file and returns its (mode, blob id). Directories left
+        empty are removed (git does not store empty trees). Raises
+        KeyError if the file is not in the tree.
+        """
+        entry = self.get(path)
+        if entry is None:
+            raise KeyError(path)
+        parts = path.split("/")
+        dirs = self._dir_path(parts[:-1], False)
+        for d in dirs:
+            d.tree_id = None
+        del dirs[-1].entries[parts[-1]]
+        for i in range(len(dirs) - 1, 0, -1):
+            if dirs[i].entries:
+                break
+            del dirs[i - 1].entries[parts[i - 1]]
+        return entry
+
+    def rename(self, old_path: str, new_path: str):
+        mode, blob_id = self.remove(old_path)
+        self.set(new_path, mode, blob_id)
+
+    def files(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Yields (path, mode, blob id) for each file in the tree.
+        """
+        stack = [("", self._root)]
+        while stack:
+            prefix, d = stack.pop()
+            for name, entry in d.entries.items():
+                if isinstance(entry, _Dir):
+                    stack.append((f"{prefix}{name}/", entry))
+                else:
+                    yield f"{prefix}{name}", entry[0], entry[1]
+
+    def write(self, make_tree) -> str:
+        """
+        Writes the trees that changed, using make_tree (a function that
+        takes a list of 'mode type id<TAB>name' entries and returns the
+        tree id), and returns the id of the root tree.
+        """
+        return self._write_dir(self._root, make_tree)
+
+    def _write_dir(self, d: _Dir, make_tree) -> str:
+        if d.tree_id is None:
+            lines = []
+            for name, entry in d.entries.items():
+                if isinstance(entry, _Dir):
+                    tree_id = self._write_dir(entry, make_tree)
+                    lines.append(f"{TREE_MODE} tree {tree_id}\t{name}")
+                else:
+                    lines.append(f"{entry[0]} blob {entry[1]}\t{name}")
+            d.tree_id = make_tree(lines)
+        return d.tree_id
+
+
+class GitObjectWriter:
+    """
+    Writes blobs and trees to a git repository through two long-running
+    processes: 'git hash-object -w --stdin-paths' and 'git mktree --batch'.
+    Blob content is passed through a temporary file, since hash-object
+    reads paths rather than content when run this way.
+    """
+
+    def __init__(self, repo_dir):
+        self._repo_dir = repo_dir
+        self._temp_dir = tempfile.TemporaryDirectory(prefix="btg3-")
+        self._num_blobs = 0
+        self._hash_object = self._start(
+            ["git", "hash-object", "-w", "--no-filters", "--stdin-paths"]
+        )
+        self._mktree = self._start(["git", "mktree", "--batch"])
+
+    def _start(self, cmds) -> subprocess.Popen:
+        return subprocess.Popen(
+            cmds,
+            cwd=self._repo_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+    @staticmethod
+    def _request(proc: subprocess.Popen, text: str) -> str:
+        proc.stdin.write(text)
+        proc.stdin.flush()
+        result = proc.stdout.readline().strip()
+        assert result, "No result from git"
+        return result
+
+    def write_blob(self, content: bytes) -> str:
+        #  Use a new file each time. Truncating a file git just read can
+        #  be slow on some file systems.
+        self._num_blobs += 1
+        p = Path(self._temp_dir.name) / f"blob-{self._num_blobs}"
+        p.write_bytes(content)
+        blob_id = self._request(self._hash_object, f"{p}\n")
+        p.unlink()
+        return blob_id
+
+    def write_blob_file(self, file_name) -> str:
+        """
+        Writes the content of a file, as is, as a blob.
+        """
+        path = Path(file_name).resolve()
+        assert "\n" not in str(path), f"Unsupported file name: {path!r}"
+        return self._request(self._hash_object, f"{path}\n")
+
+    def write_tree(self, lines: List[str]) -> str:
+        for line in lines:
+            assert "\n" not in line, f"Unsupported file name: {line!r}"
+        text = "".join(f"{s}\n" for s in lines) + "\n"
+        return self._request(self._mktree, text)
+
+    def close(self):
+        for proc in (self._hash_object, self._mktree):
+            proc.stdin.close()
+            assert proc.wait() == 0
+        self._temp_dir.cleanup()
+
+
+def load_tree(repo_dir, commit_id: str, tree: TreeBuilder):
+    """
+    Loads the files in an existing commit into tree.
+    """
+    result = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", commit_id],
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0
+    for entry in result.stdout.split("\0"):
+        if entry:
+            info, path = entry.split("\t", 1)
+            mode, _, blob_id = info.split()
+            tree.set(path, mode, blob_id)
+    #  The trees have not changed, but are not known, so are rewritten
+    #  (with the same ids) on the first write.
+
+
+def commit_tree(
+    repo_dir, tree_id: str, parent: Optional[str], message: str, git_env
+) -> str:
+    """
+    Creates a commit with 'git commit-tree', with the message given
+    exactly as is, and returns its id.
+    """
+    cmds = ["git", "commit-tree", tree_id]
+    if parent is not None:
+        cmds += ["-p", parent]
+    result = subprocess.run(
+        cmds,
+        cwd=repo_dir,
+        env=git_env,
+        input=message,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0
+    return result.stdout.strip()
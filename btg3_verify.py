@@ -0,0 +1,95 @@
+import subprocess
+
+from typing import Dict, Iterator, Optional, Tuple
+
+
+class CatFileBatch:
+    """
+    Reads objects from a git repository through one long-running
+    'git cat-file --batch' process, rather than a git process per object.
+    """
+
+    def __init__(self, repo_dir):
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=repo_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, name: str) -> Optional[Tuple[str, str, bytes]]:
+        """
+        Returns the (id, type, content) of the object with the given name
+        (an id, or any name git accepts, such as 'refs/tags/v1'), or None
+        if it is not found.
+        """
+        assert "\n" not in name, f"Unsupported object name: {name!r}"
+        self._proc.stdin.write(f"{name}\n".encode("utf-8"))
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().decode("utf-8").split()
+        assert header, "No result from git"
+        if len(header) != 3:
+            #  '<name> missing' or '<name> ambiguous'.
+            return None
+        obj_id, obj_type, size = header
+        content = self._proc.stdout.read(int(size))
+        #  Each object is followed by a newline.
+        self._proc.stdout.read(1)
+        return obj_id, obj_type, content
+
+    def commit_tree_id(self, commit_id: str) -> Optional[str]:
+        """
+        Returns the id of the tree of a commit, or None if the commit is
+        not found.
+        """
+        obj = self.read(commit_id)
+        if obj is None or obj[1] != "commit":
+            return None
+        first_line = obj[2].split(b"\n", 1)[0].decode("utf-8")
+        assert first_line.startswith("tree ")
+        return first_line[5:]
+
+    def tree_files(self, tree_id: str) -> Dict[str, Tuple[str, str]]:
+        """
+        Returns the files in a tree, and its subtrees, as path to
+        (mode, blob id).
+        """
+        files = {}
+        stack = [("", tree_id)]
+        while stack:
+            prefix, tid = stack.pop()
+            obj = self.read(tid)
+            assert obj is not None and obj[1] == "tree", f"Not a tree: {tid}"
+            for mode, name, obj_id in tree_entries(obj[2]):
+                if mode == "40000":
+                    stack.append((f"{prefix}{name}/", obj_id))
+                else:
+                    files[f"{prefix}{name}"] = (mode, obj_id)
+        return files
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.stdout.close()
+        assert self._proc.wait() == 0
+
+
+def tree_entries(data: bytes) -> Iterator[Tuple[str, str, str]]:
+    """
+    Yields (mode, name, id) for each entry in the content of a git tree
+    object. Modes are as git stores them ('40000' for a tree).
+    """
+    pos = 0
+    while pos < len(data):
+        space = data.index(b" ", pos)
+        nul = data.index(b"\0", space)
+        mode = data[pos:space].decode("ascii")
+        name = data[space + 1:nul].decode("utf-8")
+        obj_id = data[nul + 1:nul + 21].hex()
+        yield mode, name, obj_id
+        pos = nul + 21
@@ -1,5 +1,13 @@
+import csv
+import io
+import os
 import pytest
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 
 from datetime import datetime
 from pathlib import Path
@@ -9,7 +17,15 @@ import bak_to_git_2
 import bak_to_git_3
 import bak_to_fossil_3
 
-from bak_to_common import ask_to_continue, datetime_fromisoformat, split_quoted
+from bak_to_common import (
+    ask_to_continue,
+    copy_file_bytes,
+    datetime_fromisoformat,
+    split_quoted,
+)
+from btg3_checkpoint import Checkpoint, input_digests
+from btg3_fast_import import FastImportStream
+from btg3_filter import LineFilter
 
 
 def test_ask_to_continue():
@@ -63,6 +79,22 @@ def test_split_quoted():
     assert ["a", 'b "c d"'] == split_quoted(s)
 
 
+def test_copy_file_bytes(tmp_path):
+    src = tmp_path / "src.bin"
+    src.write_bytes(b"One\r\nTwo\r\n\x00\xff")
+    dst = tmp_path / "dst.bin"
+    assert copy_file_bytes(str(src), str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+
+    #  Same content, so not written again.
+    assert not copy_file_bytes(str(src), str(dst))
+
+    #  Same size, different content.
+    src.write_bytes(b"One\r\nTwo\r\n\x00\xfe")
+    assert copy_file_bytes(str(src), str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+
+
 def csv_header_row():
     return "{},{},{},{},{},{},{},{},{},{}".format(
         "row",
@@ -160,6 +192,290 @@ def test_bak_to_git_1(temp_paths_1):
     assert 8 == len(csv_lines)
 
 
+def run_bak_to_git_1(temp_path, bak_path, *extra_args):
+    """
+    Runs bak_to_git_1.main with output to a new sub-directory of temp_path
+    and returns the data rows (not separators) of the step-1 CSV as dicts.
+    """
+    out_path = temp_path / f"out_{len(list(temp_path.iterdir()))}"
+    out_path.mkdir()
+    args = [
+        "bak_to_git_1.py",
+        str(bak_path),
+        "--output-dir",
+        str(out_path),
+    ]
+    args += list(extra_args)
+    bak_to_git_1.main(args)
+    csv_file = next(out_path.iterdir()) / "step-1-files-changed.csv"
+    with open(csv_file, newline="") as f:
+        return [r for r in csv.DictReader(f) if 0 < len(r["sort_key"])]
+
+
+def test_bak_to_git_1_same_size(tmp_path):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    (bak_path / "test.txt.20211001_083010.bak").write_text("One\n")
+    #  Unchanged.
+    (bak_path / "test.txt.20211101_093011.bak").write_text("One\n")
+    #  Same size, different content.
+    (bak_path / "test.txt.20211201_103012.bak").write_text("Two\n")
+    #  Different size.
+    (bak_path / "test.txt.20211202_103012.bak").write_text("Three\n")
+
+    rows = run_bak_to_git_1(tmp_path, bak_path)
+    tags = [r["datetime_tag"] for r in rows]
+    assert ["20211001_083010", "20211201_103012", "20211202_103012"] == tags
+
+    #  The previous version of a changed file is the last changed version.
+    assert rows[1]["prev_full_name"].endswith("20211001_083010.bak")
+
+
+def record_reads(monkeypatch) -> list:
+    """
+    Records the names of the files bak_to_git_1 hashes ('digest') or
+    compares ('compare'), as (operation, names) tuples.
+    """
+    reads = []
+    real_file_digest = bak_to_git_1.file_digest
+    real_same_content = bak_to_git_1.same_content
+
+    def mock_file_digest(file_name):
+        reads.append(("digest", Path(file_name).name))
+        return real_file_digest(file_name)
+
+    def mock_same_content(file_a, file_b):
+        reads.append(("compare", Path(file_a).name, Path(file_b).name))
+        return real_same_content(file_a, file_b)
+
+    monkeypatch.setattr(bak_to_git_1, "file_digest", mock_file_digest)
+    monkeypatch.setattr(bak_to_git_1, "same_content", mock_same_content)
+    return reads
+
+
+def test_bak_to_git_1_reads(tmp_path, monkeypatch):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    t1, t2, t3, t4 = (
+        "20211001_083010",
+        "20211101_093011",
+        "20211201_103012",
+        "20211202_103012",
+    )
+    (bak_path / f"test.txt.{t1}.bak").write_text("One\n")
+    #  Same size and content.
+    (bak_path / f"test.txt.{t2}.bak").write_text("One\n")
+    #  Same size, different content.
+    (bak_path / f"test.txt.{t3}.bak").write_text("Two\n")
+    #  Different size.
+    (bak_path / f"test.txt.{t4}.bak").write_text("Three\n")
+
+    reads = record_reads(monkeypatch)
+    rows = run_bak_to_git_1(tmp_path, bak_path)
+    assert [t1, t3, t4] == [r["datetime_tag"] for r in rows]
+
+    #  Only files of the same size are compared, and only the changed
+    #  files (written to the CSV) are hashed.
+    assert [
+        ("digest", f"test.txt.{t1}.bak"),
+        ("compare", f"test.txt.{t1}.bak", f"test.txt.{t2}.bak"),
+        ("compare", f"test.txt.{t2}.bak", f"test.txt.{t3}.bak"),
+        ("digest", f"test.txt.{t3}.bak"),
+        ("digest", f"test.txt.{t4}.bak"),
+    ] == reads
+
+    #  Every row has its digest.
+    assert [
+        bak_to_git_1.file_digest(r["full_name"]) for r in rows
+    ] == [r["digest"] for r in rows]
+
+
+def test_bak_to_git_1_jobs(tmp_path):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    for n in range(1, 6):
+        tag = f"2021100{n}_083010"
+        (bak_path / f"a.txt.{tag}.bak").write_text(f"A {n // 2}\n")
+        (bak_path / f"b.txt.{tag}.bak").write_text(f"B {n // 3}\n")
+
+    rows_1 = run_bak_to_git_1(tmp_path, bak_path)
+    rows_4 = run_bak_to_git_1(tmp_path, bak_path, "--jobs", "4")
+    assert 0 < len(rows_1)
+    assert rows_1 == rows_4
+
+
+def test_bak_to_git_1_index_file(tmp_path, monkeypatch):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    (bak_path / "test.txt.20211001_083010.bak").write_text("One\n")
+    (bak_path / "test.txt.20211101_093011.bak").write_text("One\n")
+    (bak_path / "test.txt.20211201_103012.bak").write_text("Two\n")
+    index_file = str(tmp_path / "index.sqlite")
+
+    rows_1 = run_bak_to_git_1(tmp_path, bak_path, "--index-file", index_file)
+
+    reads = record_reads(monkeypatch)
+
+    #  Nothing changed, so no files should be read.
+    rows_2 = run_bak_to_git_1(tmp_path, bak_path, "--index-file", index_file)
+    assert [] == reads
+    assert rows_1 == rows_2
+
+    #  Only the new file should be read.
+    (bak_path / "test.txt.20211202_103012.bak").write_text("Two\n")
+    rows_3 = run_bak_to_git_1(tmp_path, bak_path, "--index-file", index_file)
+    assert [
+        (
+            "compare",
+            "test.txt.20211201_103012.bak",
+            "test.txt.20211202_103012.bak",
+        )
+    ] == reads
+    assert rows_1 == rows_3
+
+    #  A backup that is modified is read again, along with the change
+    #  decision for the version after it.
+    reads.clear()
+    (bak_path / "test.txt.20211101_093011.bak").write_text("Six\n")
+    rows_4 = run_bak_to_git_1(tmp_path, bak_path, "--index-file", index_file)
+    t1, t2, t3 = [
+        f"test.txt.{tag}.bak"
+        for tag in ("20211001_083010", "20211101_093011", "20211201_103012")
+    ]
+    assert [
+        ("compare", t1, t2),
+        ("digest", t2),
+        ("compare", t2, t3),
+    ] == reads
+    assert 3 == len(rows_4)
+
+
+def test_bak_to_git_1_continue_from(tmp_path):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    (bak_path / "test.txt.20211001_083010.bak").write_text("One\n")
+    (bak_path / "test.txt.20211101_093011.bak").write_text("Two\n")
+
+    run_bak_to_git_1(tmp_path, bak_path)
+    prior_csv = next(tmp_path.glob("out_*/*/step-1-files-changed.csv"))
+
+    #  Manually edit the prior CSV, as in step 2.
+    with open(prior_csv, newline="") as f:
+        reader = csv.DictReader(f)
+        flds = reader.fieldnames
+        prior_rows = list(reader)
+    prior_rows[0]["COMMIT_MESSAGE"] = "Initial commit."
+    prior_rows[2]["SKIP_Y"] = "Y"
+    with open(prior_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=flds)
+        writer.writeheader()
+        writer.writerows(prior_rows)
+
+    #  Unchanged from the last version.
+    (bak_path / "test.txt.20211201_103012.bak").write_text("Two\n")
+    #  Changed.
+    (bak_path / "test.txt.20211202_103012.bak").write_text("Three\n")
+    #  New file.
+    (bak_path / "new.txt.20211202_103012.bak").write_text("New\n")
+
+    rows = run_bak_to_git_1(
+        tmp_path, bak_path, "--continue-from", str(prior_csv)
+    )
+    assert 4 == len(rows)
+
+    #  Manual edits should be kept.
+    assert "Initial commit." == rows[0]["COMMIT_MESSAGE"]
+    assert "Y" == rows[1]["SKIP_Y"]
+
+    #  Row numbers continue after the prior rows (2 files, 2 separators),
+    #  and the separator row for the unchanged datetime_tag.
+    assert ["6", "7"] == [r["row"] for r in rows[2:]]
+    assert ["new.txt", "test.txt"] == [r["base_name"] for r in rows[2:]]
+    assert rows[3]["prev_full_name"].endswith("20211101_093011.bak")
+
+
+def test_bak_to_git_1_continue_after_unchanged(tmp_path):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    (bak_path / "test.txt.20211001_083010.bak").write_text("One\n")
+    #  The last datetime_tag has no changed files.
+    (bak_path / "test.txt.20211101_093011.bak").write_text("One\n")
+
+    run_bak_to_git_1(tmp_path, bak_path)
+    prior_csv = next(tmp_path.glob("out_*/*/step-1-files-changed.csv"))
+
+    #  The separator row records the datetime_tag, so it is not scanned
+    #  again.
+    prior = bak_to_git_1.read_prior_csv(prior_csv)
+    assert "20211101_093011" == prior.last_tag
+    assert 3 == prior.last_row
+
+
+def test_iter_bak_files(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.py.20211001_083010.bak").write_text("a")
+    (tmp_path / "src" / "b.txt.20211001_083010.bak").write_text("b")
+    (tmp_path / "src" / "notes.txt").write_text("not a backup")
+    (tmp_path / "node_modules").mkdir()
+    (tmp_path / "node_modules" / "c.js.20211001_083010.bak").write_text("c")
+
+    def scan(include_list, exclude_list):
+        return sorted(
+            e.name
+            for e in bak_to_git_1.iter_bak_files(
+                str(tmp_path), include_list, exclude_list
+            )
+        )
+
+    assert [
+        "a.py.20211001_083010.bak",
+        "b.txt.20211001_083010.bak",
+        "c.js.20211001_083010.bak",
+    ] == scan([], [])
+
+    #  Excluded directories are pruned.
+    assert [
+        "a.py.20211001_083010.bak",
+        "b.txt.20211001_083010.bak",
+    ] == scan([], ["node_modules"])
+
+    #  Patterns can match the relative path.
+    assert ["a.py.20211001_083010.bak"] == scan(["src/*.py.*"], [])
+    assert ["b.txt.20211001_083010.bak"] == scan([], ["*.py.*", "node_*"])
+
+
+def test_bak_to_git_1_write_debug(tmp_path):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    (bak_path / "a.txt.20211001_083010.bak").write_text("One\n")
+    (bak_path / "b.txt.20211001_083010.bak").write_text("One\n")
+    (bak_path / "a.txt.20211101_093011.bak").write_text("One\n")
+
+    run_bak_to_git_1(tmp_path, bak_path, "--write-debug")
+    out_path = next(tmp_path.glob("out_*/*"))
+
+    #  Header plus one line per file, base_name, or datetime_tag.
+    text = (out_path / "z-debug-1-all-files.csv").read_text()
+    assert 4 == len(text.splitlines())
+    text = (out_path / "z-debug-2-base_names.csv").read_text()
+    assert ["base_name", "a.txt", "b.txt"] == text.splitlines()
+    text = (out_path / "z-debug-3-datetime_tags.csv").read_text()
+    assert 3 == len(text.splitlines())
+
+
+def test_file_digest(tmp_path):
+    #  The digest should match 'git hash-object' for the same content.
+    p = tmp_path / "one.txt"
+    p.write_text("One\n")
+    digest = bak_to_git_1.file_digest(str(p))
+    assert "3609f20ebd357679b111783e8afaf36ec46427f3" == digest
+
+    p = tmp_path / "empty.txt"
+    p.write_text("")
+    digest = bak_to_git_1.file_digest(str(p))
+    assert "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391" == digest
+
+
 def bak_base_name(bak_name):
     """
     Takes a backup name and returns the base name.
@@ -449,3 +765,942 @@ def test_bak_to_fossil_3(temp_paths_3, monkeypatch):
 
     #  Should be 1 create-repo, 1 open-repo, 1 add, and 2 commits (1 skip).
     assert 5 == len(runs)
+
+
+def test_bak_to_fossil_3_resume(temp_paths_3, monkeypatch):
+    runs = []
+    checkout = ["abc1230000"]
+
+    def mock_run_fossil(cmds, run_dir):
+        runs.append(cmds[1])
+        if cmds[1] == "commit":
+            return f"New_Version: {checkout[0]}\n"
+        if cmds[1] == "info":
+            return f"checkout:     {checkout[0][:6]} 2021-12-01 10:30:12 UTC\n"
+        return ""
+
+    temp_path, bak_path, csv_path = temp_paths_3
+    repo_path = temp_path / "fake_fossil_resume"
+    repo_path.mkdir()
+    fake_fossil = temp_path / "fake_fossil"
+    if not fake_fossil.exists():
+        fake_fossil.write_text("Not the fossil.")
+
+    args = [
+        "bak_to_fossil_3.py",
+        str(csv_path),
+        str(repo_path),
+        "--init-date",
+        "2021-10-01T08:30:00",
+        "--fossil-exe",
+        str(fake_fossil),
+        "--log-dir",
+        str(temp_path),
+    ]
+
+    monkeypatch.setattr(bak_to_fossil_3, "run_fossil", mock_run_fossil)
+    monkeypatch.setattr(bak_to_fossil_3, "ask_to_continue", lambda p, c: "y")
+
+    bak_to_fossil_3.main(args)
+
+    #  The checkpoint is kept outside the check-out.
+    checkpoint = Checkpoint(bak_to_fossil_3.checkpoint_path(repo_path))
+    assert checkpoint.path.parent == temp_path
+    assert [p.name for p in repo_path.iterdir()] == ["test.txt"]
+    saved = checkpoint.load()
+    assert saved["datetime_tag"] == "20211201_103012"
+    assert saved["commit"] == "abc1230000"
+
+    #  Resume after the first check-in.
+    digests = input_digests(bak_to_fossil_3.read_groups(str(csv_path)))
+    checkpoint.save("20211001_083010", "abc1230000", csv_path, digests[0])
+    runs.clear()
+    bak_to_fossil_3.main(args + ["--resume"])
+    assert runs == ["info", "changes", "commit"]
+
+    #  The checkpoint is for another input file.
+    other_csv = temp_path / "other.csv"
+    shutil.copyfile(csv_path, other_csv)
+    runs.clear()
+    with pytest.raises(SystemExit):
+        bak_to_fossil_3.main([args[0], str(other_csv)] + args[2:] + [
+            "--resume"
+        ])
+    assert runs == []
+
+    #  The check-out is not the checkpoint check-in.
+    checkout[0] = "def4560000"
+    with pytest.raises(SystemExit):
+        bak_to_fossil_3.main(args + ["--resume"])
+
+
+def git_out(repo_path, *args):
+    return subprocess.run(
+        ["git"] + list(args),
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout.strip()
+
+
+def new_git_repo(repo_path):
+    repo_path.mkdir()
+    git_out(repo_path, "init", "-q")
+    git_out(repo_path, "config", "user.name", "Test User")
+    git_out(repo_path, "config", "user.email", "test@example.com")
+    return repo_path
+
+
+@pytest.fixture(scope="module")
+def temp_paths_git(tmp_path_factory):
+    """
+    Makes a step 2 CSV, and the backup files it refers to, with a rename,
+    multiple files in a commit, a lightweight tag, and an annotated tag,
+    for running bak_to_git_3 against real git repositories.
+    """
+    temp_path: Path = tmp_path_factory.mktemp("baktogit3git")
+    bak_path = temp_path / "_0_bak"
+    bak_path.mkdir()
+
+    t1, t2, t3 = "20211001_083010", "20211101_093011", "20211201_103012"
+    versions = [
+        (t1, "a.txt", "One\nTahoo\n", "Initial commit.", ""),
+        (t1, "b.txt", "Bee\n", "", "post: tag v0.1"),
+        (t2, "a.txt", "One\nTwo\n", "Fix a", ""),
+        (t3, "c.txt", "Bee\nSea\n", "Rename b", "rename: b.txt"),
+        (t3, "a.txt", "One\nTwo\nThree\n", "x", 'post: tag -a v1 -m "One"'),
+    ]
+    rows = []
+    for num, (tag, base_name, text, msg, cmd) in enumerate(versions):
+        p = bak_path / f"{base_name}.{tag}.bak"
+        p.write_text(text)
+        rows.append(
+            [num, f"{tag}:{base_name}", str(p), "", tag, base_name, "", msg]
+            + [cmd, ""]
+        )
+
+    csv_path = temp_path / "step-2.csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(csv_header_row().split(","))
+        writer.writerows(rows)
+
+    return temp_path, csv_path
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_engines(temp_paths_git, monkeypatch):
+    temp_path, csv_path = temp_paths_git
+
+    #  The worktree engine runs git without TZ in the environment, so make
+    #  this process use the same (system) local time.
+    monkeypatch.delenv("TZ", raising=False)
+    time.tzset()
+
+    results = {}
+    for engine in bak_to_git_3.ENGINES:
+        repo_path = new_git_repo(temp_path / f"repo-{engine}")
+        args = [
+            "bak_to_git_3.py",
+            str(csv_path),
+            str(repo_path),
+            "--log-dir",
+            str(temp_path),
+            "--engine",
+            engine,
+        ]
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+
+        assert "" == git_out(repo_path, "status", "--porcelain")
+        assert (repo_path / "c.txt").read_text() == "Bee\nSea\n"
+        assert not (repo_path / "b.txt").exists()
+        results[engine] = git_out(
+            repo_path, "show-ref", "--head", "--dereference"
+        )
+
+    #  Same content, messages, and dates give the same commit and tag ids.
+    for engine in bak_to_git_3.ENGINES:
+        assert results[engine] == results["worktree"]
+
+
+def test_fast_import_unsupported_command(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    text = csv_path.read_text().replace("post: tag v0.1", "post: gc")
+    bad_csv = tmp_path / "bad.csv"
+    bad_csv.write_text(text)
+    repo_path = tmp_path / "repo"
+    repo_path.mkdir()
+    (repo_path / ".git").mkdir()
+    args = [
+        "bak_to_git_3.py",
+        str(bad_csv),
+        str(repo_path),
+        "--log-dir",
+        str(tmp_path),
+        "--engine",
+        "fast-import",
+        "--what-if",
+    ]
+    with pytest.raises(SystemExit):
+        bak_to_git_3.main(args)
+
+
+def test_bak_to_fossil_3_fast_import(temp_paths_3, tmp_path, monkeypatch):
+    runs = []
+    piped = []
+
+    def mock_run_fossil(cmds, run_dir):
+        runs.append(cmds)
+        return
+
+    def mock_pipe_to_fossil(cmds, run_dir, write_input):
+        runs.append(cmds)
+        stdin = io.BytesIO()
+        result = write_input(stdin)
+        piped.append(stdin.getvalue())
+        return result
+
+    temp_path, bak_path, csv_path = temp_paths_3
+
+    repo_path = tmp_path / "fossil_repo"
+    fake_fossil = tmp_path / "fake_fossil"
+    fake_fossil.write_text("Not the fossil.")
+
+    args = [
+        "bak_to_fossil_3.py",
+        str(csv_path),
+        str(repo_path),
+        "--repo-name",
+        "test.fossil",
+        "--init-date",
+        "2021-10-01T08:30:00",
+        "--fossil-exe",
+        str(fake_fossil),
+        "--log-dir",
+        str(tmp_path),
+        "--engine",
+        "fast-import",
+    ]
+
+    monkeypatch.setattr(bak_to_fossil_3, "run_fossil", mock_run_fossil)
+    monkeypatch.setattr(bak_to_fossil_3, "pipe_to_fossil", mock_pipe_to_fossil)
+    monkeypatch.setattr(bak_to_fossil_3, "ask_to_continue", lambda p, c: "y")
+
+    bak_to_fossil_3.main(args)
+
+    #  Should be 1 import (reading the stream from stdin) and 1 open-repo.
+    assert 2 == len(runs)
+    assert runs[0][1:] == ["import", "--git", "test.fossil"]
+    assert runs[1][1:] == ["open", "test.fossil"]
+
+    #  The stream is not written to a file.
+    assert [p.name for p in tmp_path.glob("fast-export-*")] == []
+
+    #  The stream has the empty initial check-in, and 2 more (1 skip).
+    stream = piped[0]
+    assert 3 == stream.count(b"commit refs/heads/trunk\n")
+    assert b"committer " in stream
+    assert b"\ndata 22\ninitial empty check-in\n" in stream
+
+    #  The stream is also valid input for git fast-import.
+    if shutil.which("git") is not None:
+        git_repo = new_git_repo(tmp_path / "git_repo")
+        subprocess.run(
+            ["git", "fast-import", "--quiet"],
+            cwd=git_repo,
+            input=stream,
+            check=True,
+        )
+        log = git_out(
+            git_repo, "log", "--format=%ad %s", "--date=iso", "trunk"
+        )
+        assert log.splitlines() == [
+            "2021-12-01 10:30:12 +0000 Corrected Mr. Owl's typos.",
+            "2021-10-01 08:30:10 +0000 Initial commit.",
+            "2021-10-01 08:30:00 +0000 initial empty check-in",
+        ]
+        assert git_out(git_repo, "show", "trunk:test.txt").endswith("Three")
+
+    #  If the import fails, the partly made repository is removed.
+    def failed_pipe_to_fossil(cmds, run_dir, write_input):
+        (Path(run_dir) / cmds[3]).write_text("Partial")
+        raise AssertionError
+
+    monkeypatch.setattr(
+        bak_to_fossil_3, "pipe_to_fossil", failed_pipe_to_fossil
+    )
+    args[2] = str(tmp_path / "failed_repo")
+    with pytest.raises(AssertionError):
+        bak_to_fossil_3.main(args)
+    assert list((tmp_path / "failed_repo").iterdir()) == []
+
+
+def test_pipe_to_fossil(tmp_path, monkeypatch):
+    log_file = tmp_path / "log.txt"
+    monkeypatch.setattr(bak_to_fossil_3, "log_path", log_file)
+
+    #  Any command can stand in for fossil here.
+    count_cmd = [
+        sys.executable,
+        "-c",
+        "import sys; print(len(sys.stdin.buffer.read()))",
+    ]
+
+    def write_input(stdin):
+        stdin.write(b"x" * 100000)
+        return "written"
+
+    result = bak_to_fossil_3.pipe_to_fossil(count_cmd, tmp_path, write_input)
+    assert result == "written"
+    assert "STDOUT: 100000" in log_file.read_text()
+
+    def failed_write_input(stdin):
+        stdin.write(b"x")
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        bak_to_fossil_3.pipe_to_fossil(
+            count_cmd, tmp_path, failed_write_input
+        )
+
+
+@pytest.mark.skipif(shutil.which("fossil") is None, reason="requires fossil")
+def test_bak_to_fossil_3_fast_import_fossil(temp_paths_3, tmp_path):
+    temp_path, bak_path, csv_path = temp_paths_3
+    repo_path = tmp_path / "fossil_repo"
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+
+    args = [
+        "bak_to_fossil_3.py",
+        str(csv_path),
+        str(repo_path),
+        "--repo-name",
+        "test.fossil",
+        "--init-date",
+        "2021-10-01T08:30:00",
+        "--fossil-exe",
+        shutil.which("fossil"),
+        "--log-dir",
+        str(log_dir),
+        "--engine",
+        "fast-import",
+    ]
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(bak_to_fossil_3, "ask_to_continue", lambda p, c: "y")
+        bak_to_fossil_3.main(args)
+
+    #  Only the log file is written to the log directory.
+    assert [p.name for p in log_dir.iterdir()] == [
+        bak_to_fossil_3.log_path.name
+    ]
+
+    assert (repo_path / "test.txt").read_text() == "One\nTwo\nThree\n"
+    timeline = subprocess.run(
+        ["fossil", "timeline", "-n", "20", "-t", "ci"],
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert "Corrected Mr. Owl's typos." in timeline
+    assert "Initial commit." in timeline
+    assert "initial empty check-in" in timeline
+
+
+def test_bak_to_git_3_filter(tmp_path, monkeypatch):
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text(
+        '# Comment\n"secret","[REDACTED]"\n"host.local","example.com"\n'
+    )
+    src_file = tmp_path / "src.txt"
+    src_file.write_text("a secret\nplain\nhost.local secret\n")
+
+    log_file = tmp_path / "log.txt"
+    monkeypatch.setattr(bak_to_git_3, "log_path", log_file)
+    monkeypatch.setattr(bak_to_git_3, "filter_list", [])
+    monkeypatch.setattr(bak_to_git_3, "line_filter", None)
+    bak_to_git_3.load_filter_list(str(filter_file))
+
+    dst_file = tmp_path / "dst.txt"
+    bak_to_git_3.copy_filtered_content(str(src_file), str(dst_file))
+    assert dst_file.read_text() == (
+        "a [REDACTED]\nplain\nexample.com [REDACTED]\n"
+    )
+
+    log = log_file.read_text().splitlines()
+    assert log == [
+        f"FILTER {src_file} (1): ('secret', '[REDACTED]')",
+        f"FILTER {src_file} (3): ('secret', '[REDACTED]')",
+        f"FILTER {src_file} (3): ('host.local', 'example.com')",
+    ]
+
+
+def test_bak_to_git_3_copy_unfiltered(tmp_path, monkeypatch):
+    monkeypatch.setattr(bak_to_git_3, "log_path", tmp_path / "log.txt")
+    monkeypatch.setattr(
+        bak_to_git_3, "line_filter", LineFilter([("secret", "[REDACTED]")])
+    )
+    src_file = tmp_path / "src.txt"
+    dst_file = tmp_path / "dst.txt"
+
+    #  No filter matches, so the bytes (with CRLF newlines) are copied.
+    src_file.write_bytes(b"One\r\nTwo\r\n")
+    bak_to_git_3.copy_filtered_content(str(src_file), str(dst_file))
+    assert dst_file.read_bytes() == b"One\r\nTwo\r\n"
+    props = bak_to_git_3.CommitProps("", str(src_file), "", "", "", "", "")
+    assert bak_to_git_3.prepare_file(props) is None
+
+    #  A filter matches, so the file is filtered as text.
+    src_file.write_bytes(b"One\r\nsecret\r\n")
+    bak_to_git_3.copy_filtered_content(str(src_file), str(dst_file))
+    assert dst_file.read_text() == "One\n[REDACTED]\n"
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_filter_cache(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text('"One","1"\n')
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    repo_path = new_git_repo(tmp_path / "repo")
+
+    def run_step_3(name, *extra_args):
+        log_dir = tmp_path / name
+        log_dir.mkdir()
+        args = [
+            "bak_to_git_3.py",
+            str(csv_path),
+            str(repo_path),
+            "--log-dir",
+            str(log_dir),
+            "--filter-file",
+            str(filter_file),
+            "--cache-dir",
+            str(cache_dir),
+            "--engine",
+            "fast-import",
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+        return next(log_dir.glob("log-*.txt")).read_text()
+
+    #  The what-if run filters the 3 versions of a.txt into the cache.
+    log = run_step_3("what-if", "--what-if")
+    assert "Filter cache: 0 hits, 3 misses" in log
+    assert 3 == log.count("FILTER ")
+
+    #  The commit run gets them from the cache, and still logs them.
+    log = run_step_3("commit")
+    assert "Filter cache: 3 hits, 0 misses" in log
+    assert 3 == log.count("FILTER ")
+    assert (repo_path / "a.txt").read_text() == "1\nTwo\nThree\n"
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_resume(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+
+    #  Same as the good CSV, but the rename in the last tag fails. It is
+    #  fixed, in the same file, before resuming.
+    good_text = csv_path.read_text()
+    input_csv = tmp_path / "step-2.csv"
+    input_csv.write_text(
+        good_text.replace("rename: b.txt", "rename: nope.txt")
+    )
+
+    def run_step_3(input_csv, repo_path, *extra_args):
+        args = [
+            "bak_to_git_3.py",
+            str(input_csv),
+            str(repo_path),
+            "--log-dir",
+            str(tmp_path),
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+
+    full_repo = new_git_repo(tmp_path / "full")
+    run_step_3(csv_path, full_repo)
+
+    repo_path = new_git_repo(tmp_path / "repo")
+    with pytest.raises(AssertionError):
+        run_step_3(input_csv, repo_path)
+    assert 2 == len(git_out(repo_path, "log", "--format=%H").splitlines())
+    input_csv.write_text(good_text)
+
+    #  Resuming needs the input file the checkpoint was saved for.
+    with pytest.raises(SystemExit):
+        run_step_3(csv_path, repo_path, "--resume")
+
+    #  With the commits up to the checkpoint unchanged.
+    input_csv.write_text(good_text.replace("Fix a", "Fix A"))
+    with pytest.raises(SystemExit):
+        run_step_3(input_csv, repo_path, "--resume")
+    input_csv.write_text(good_text)
+
+    #  Resuming needs a clean working tree.
+    (repo_path / "stray.txt").write_text("stray\n")
+    with pytest.raises(SystemExit):
+        run_step_3(input_csv, repo_path, "--resume")
+    (repo_path / "stray.txt").unlink()
+
+    #  And HEAD at the checkpoint commit.
+    git_out(repo_path, "checkout", "-q", "HEAD~1")
+    with pytest.raises(SystemExit):
+        run_step_3(input_csv, repo_path, "--resume")
+    git_out(repo_path, "checkout", "-q", "master")
+
+    run_step_3(input_csv, repo_path, "--resume")
+
+    assert git_out(repo_path, "show-ref", "--head") == git_out(
+        full_repo, "show-ref", "--head"
+    )
+
+    #  Nothing left to do, so resuming again makes no commits.
+    run_step_3(input_csv, repo_path, "--resume")
+    assert git_out(repo_path, "rev-parse", "HEAD") == git_out(
+        full_repo, "rev-parse", "HEAD"
+    )
+
+    #  The plumbing engine leaves the repository as it was (no commits or
+    #  tags) when it stops part way, so it does not resume.
+    input_csv.write_text(
+        good_text.replace("rename: b.txt", "rename: nope.txt")
+    )
+    repo_path = new_git_repo(tmp_path / "plumbing")
+    with pytest.raises(SystemExit):
+        run_step_3(input_csv, repo_path, "--engine", "plumbing")
+    assert git_out(repo_path, "for-each-ref") == ""
+    for engine in ("fast-import", "plumbing", "pack"):
+        with pytest.raises(SystemExit):
+            run_step_3(input_csv, repo_path, "--engine", engine, "--resume")
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_out_of_order(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+
+    #  Move the last row (datetime tag t3) before the rows for t2.
+    lines = csv_path.read_text().splitlines(True)
+    input_csv = tmp_path / "out-of-order.csv"
+    input_csv.write_text("".join(lines[:3] + lines[-1:] + lines[3:-1]))
+
+    for engine in bak_to_git_3.ENGINES:
+        repo_path = new_git_repo(tmp_path / f"repo-{engine}")
+        args = [
+            "bak_to_git_3.py",
+            str(input_csv),
+            str(repo_path),
+            "--log-dir",
+            str(tmp_path),
+            "--engine",
+            engine,
+        ]
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            with pytest.raises(SystemExit):
+                bak_to_git_3.main(args)
+
+        #  Found in the first pass, so nothing was committed.
+        assert git_out(repo_path, "for-each-ref") == ""
+        assert list(repo_path.iterdir()) == [repo_path / ".git"]
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_plan(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    plan_path = tmp_path / "plan.jsonl"
+
+    def run_step_3(input_file, repo_path, *extra_args):
+        args = [
+            "bak_to_git_3.py",
+            str(input_file),
+            str(repo_path),
+            "--log-dir",
+            str(tmp_path),
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+
+    csv_repo = new_git_repo(tmp_path / "from-csv")
+    run_step_3(csv_path, csv_repo)
+
+    plan_repo = new_git_repo(tmp_path / "from-plan")
+    run_step_3(csv_path, plan_repo, "--what-if", "--plan-out", str(plan_path))
+    assert "" == git_out(plan_repo, "status", "--porcelain")
+    assert 4 == len(plan_path.read_text().splitlines())
+
+    run_step_3(plan_path, plan_repo)
+    assert git_out(plan_repo, "show-ref", "--head") == git_out(
+        csv_repo, "show-ref", "--head"
+    )
+
+    #  A plan for another tool is not used.
+    with pytest.raises(SystemExit):
+        bak_to_fossil_3.read_groups(plan_path)
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_lookahead(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text('"One","1"\n"Sea","C"\n')
+
+    def run_step_3(name, engine, *extra_args):
+        log_dir = tmp_path / name
+        log_dir.mkdir()
+        repo_path = new_git_repo(tmp_path / f"repo-{name}")
+        args = [
+            "bak_to_git_3.py",
+            str(csv_path),
+            str(repo_path),
+            "--log-dir",
+            str(log_dir),
+            "--filter-file",
+            str(filter_file),
+            "--engine",
+            engine,
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+        log = next(log_dir.glob("log-*.txt")).read_text().splitlines()
+        return (
+            git_out(repo_path, "show-ref", "--head", "--dereference"),
+            [s for s in log if s.startswith(("FILTER", "COPY"))],
+        )
+
+    for engine in bak_to_git_3.ENGINES:
+        refs, log = run_step_3(engine, engine)
+        assert 4 == sum(s.startswith("FILTER") for s in log)
+        #  Preparing ahead gives the same commits, and the same log order.
+        assert (refs, log) == run_step_3(
+            f"{engine}-lookahead", engine, "--lookahead", "2"
+        )
+
+
+@pytest.mark.parametrize("module", [bak_to_git_3, bak_to_fossil_3])
+def test_iter_commit_groups(module):
+    t1 = "20211001_083010"
+    t2 = "20211101_093011"
+
+    def props(sort_key, tag, base_name, msg):
+        return module.CommitProps(
+            sort_key, f"/bak/{base_name}.{tag}.bak", tag, base_name, msg, "",
+            "",
+        )
+
+    commit_list = [
+        props("1", t1, "a.txt", "One"),
+        props("2", t2, "b.txt", "Two b"),
+        props("3", t2, "a.txt", "Two a"),
+    ]
+    groups = list(module.iter_commit_groups(iter(commit_list)))
+    assert [g.datetime_tag for g in groups] == [t1, t2]
+    assert [p.base_name for p in groups[1].items] == ["b.txt", "a.txt"]
+    assert groups[1].commit_msg == "Two b. Two a."
+
+    #  The rows are not sorted, so rows out of order by datetime tag are
+    #  an error, found when the group after them is reached.
+    commit_list = [commit_list[1], commit_list[0], commit_list[2]]
+    groups = module.iter_commit_groups(commit_list)
+    assert next(groups).datetime_tag == t2
+    with pytest.raises(ValueError):
+        next(groups)
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_staged(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    repo_path = new_git_repo(tmp_path / "repo")
+    args = [
+        "bak_to_git_3.py",
+        str(csv_path),
+        str(repo_path),
+        "--log-dir",
+        str(tmp_path),
+        "--engine",
+        "staged",
+    ]
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+        bak_to_git_3.main(args)
+
+    log = next(tmp_path.glob("log-*.txt")).read_text()
+    #  One 'git add' for the new files in a tag, and the commit is limited
+    #  to the paths of the tag.
+    assert 1 == log.count(" add -- ")
+    assert " add -- a.txt b.txt" in log
+    assert '-m "Rename b." -i -- a.txt c.txt' in log
+    assert 1 == log.count("repack -d -q")
+
+    assert "" == git_out(repo_path, "status", "--porcelain")
+    assert "v0.1\nv1" == git_out(repo_path, "tag")
+    assert "count: 0" in git_out(repo_path, "count-objects", "-v")
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_pack(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    repo_path = new_git_repo(tmp_path / "repo")
+    args = [
+        "bak_to_git_3.py",
+        str(csv_path),
+        str(repo_path),
+        "--log-dir",
+        str(tmp_path),
+        "--engine",
+        "pack",
+    ]
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+        bak_to_git_3.main(args)
+
+    #  All the objects are in one pack, and nothing is left loose.
+    counts = git_out(repo_path, "count-objects", "-v").splitlines()
+    assert "count: 0" in counts
+    assert "packs: 1" in counts
+    git_out(repo_path, "fsck", "--strict", "--no-dangling")
+
+    assert "" == git_out(repo_path, "status", "--porcelain")
+    assert "v0.1\nv1" == git_out(repo_path, "tag")
+    assert 3 == len(git_out(repo_path, "log", "--format=%H").splitlines())
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_pack_shards(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text('"One","1"\n"Bee","B"\n')
+
+    def run_step_3(name, *extra_args):
+        log_dir = tmp_path / name
+        log_dir.mkdir()
+        repo_path = new_git_repo(tmp_path / f"repo-{name}")
+        args = [
+            "bak_to_git_3.py",
+            str(csv_path),
+            str(repo_path),
+            "--log-dir",
+            str(log_dir),
+            "--filter-file",
+            str(filter_file),
+            "--engine",
+            "pack",
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+        git_out(repo_path, "fsck", "--strict", "--no-dangling")
+        assert "" == git_out(repo_path, "status", "--porcelain")
+        counts = git_out(repo_path, "count-objects", "-v").splitlines()
+        log = next(log_dir.glob("log-*.txt")).read_text().splitlines()
+        return (
+            git_out(repo_path, "show-ref", "--head", "--dereference"),
+            [s for s in log if not s.startswith(("BEGIN", "END", "PACK"))],
+            counts,
+        )
+
+    refs, log, counts = run_step_3("serial")
+    assert "packs: 1" in counts
+
+    #  Shards are split by number of files, so with more shards than tags
+    #  each tag is in its own shard. The trees of the later shards start
+    #  from the (filtered) files of the earlier tags.
+    refs_5, log_5, counts_5 = run_step_3("shards", "--shards", "5")
+    assert "packs: 4" in counts_5
+    assert (refs_5, log_5) == (refs, log)
+
+
+def test_shard_bounds():
+    def bounds(shards, *sizes):
+        groups = (
+            bak_to_git_3.CommitGroup("", "", "", "", [], [], [None] * n)
+            for n in sizes
+        )
+        return bak_to_git_3.shard_bounds(groups, sum(sizes), shards)
+
+    assert bounds(2, 1, 1, 1, 1) == [0, 2]
+    assert bounds(3, 1, 1, 1) == [0, 1, 2]
+    assert bounds(2, 6, 1, 1, 1, 1) == [0, 1]
+    assert bounds(5, 1, 1) == [0, 1]
+    assert bounds(2, 3) == [0]
+    assert bounds(2) == [0]
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_verify(temp_paths_git, tmp_path):
+    temp_path, csv_path = temp_paths_git
+    repo_path = new_git_repo(tmp_path / "repo")
+
+    def run_step_3(name, *extra_args):
+        log_dir = tmp_path / name
+        log_dir.mkdir()
+        args = [
+            "bak_to_git_3.py",
+            str(csv_path),
+            str(repo_path),
+            "--log-dir",
+            str(log_dir),
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            result = bak_to_git_3.main(args)
+        log = next(log_dir.glob("log-*.txt")).read_text()
+        return result, log
+
+    run_step_3("import", "--engine", "pack")
+    refs = git_out(repo_path, "show-ref", "--head", "--dereference")
+
+    result, log = run_step_3("verify", "--verify")
+    assert result is None
+    assert 3 == log.count(" VERIFY OK: ")
+    assert "3 datetime tags checked, 0 differ" in log
+
+    #  Files filtered differently than when imported.
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text('"Bee","B"\n')
+    git_out(repo_path, "tag", "-d", "v1")
+    result, log = run_step_3(
+        "verify-differs", "--verify", "--filter-file", str(filter_file)
+    )
+    assert result == 1
+    assert "(20211001_083010) VERIFY DIFFERS: " in log
+    assert "  b.txt: 100644 " in log
+    assert "(20211101_093011) VERIFY DIFFERS: " in log
+    assert "(20211201_103012) VERIFY DIFFERS: " in log
+    assert "  c.txt: 100644 " in log
+    assert "  Tag v1 not found" in log
+    assert "  a.txt:" not in log
+    assert "3 datetime tags checked, 3 differ" in log
+
+    #  The repository is not changed.
+    assert "" == git_out(repo_path, "status", "--porcelain")
+    assert git_out(repo_path, "tag") == "v0.1"
+    assert git_out(repo_path, "rev-parse", "HEAD") == refs[:40]
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bak_to_git_3_filter_memory(tmp_path):
+    bak_path = tmp_path / "_0_bak"
+    bak_path.mkdir()
+    t1, t2 = "20211001_083010", "20211101_093011"
+    #  Larger than the 1 MiB limit, with a line longer than a piece (256K
+    #  characters) that has matches at the piece boundaries.
+    long_line = "".join(f"{n:07d}secret-" for n in range(40000)) + "\n"
+    text_1 = "first secret\n" + long_line + "x\n" * 300000
+    text_2 = text_1.replace("first", "second") + "last secret"
+    data = bytes(range(256)) * 8000
+    versions = [
+        (t1, "log.txt", text_1, "One.", ""),
+        (t1, "data.bin", data, "", ""),
+        (t2, "log.txt", text_2, "Two.", 'post: tag -a v1 -m "One"'),
+    ]
+    rows = []
+    for num, (tag, base_name, content, msg, cmd) in enumerate(versions):
+        p = bak_path / f"{base_name}.{tag}.bak"
+        if isinstance(content, str):
+            p.write_text(content)
+        else:
+            p.write_bytes(content)
+        rows.append(
+            [num, f"{tag}:{base_name}", str(p), "", tag, base_name, "", msg]
+            + [cmd, ""]
+        )
+    csv_path = tmp_path / "step-2.csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(csv_header_row().split(","))
+        writer.writerows(rows)
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text('"secret","S"\n"S-","s_"\n')
+
+    def run_step_3(name, *extra_args):
+        log_dir = tmp_path / name
+        log_dir.mkdir()
+        repo_path = new_git_repo(tmp_path / f"repo-{name}")
+        args = [
+            "bak_to_git_3.py",
+            str(csv_path),
+            str(repo_path),
+            "--log-dir",
+            str(log_dir),
+            "--filter-file",
+            str(filter_file),
+        ] + list(extra_args)
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(bak_to_git_3, "ask_to_continue", lambda p, c: "y")
+            bak_to_git_3.main(args)
+        assert "" == git_out(repo_path, "status", "--porcelain")
+        log = next(log_dir.glob("log-*.txt")).read_text().splitlines()
+        return (
+            git_out(repo_path, "show-ref", "--head", "--dereference"),
+            [s for s in log if s.startswith("FILTER")],
+            (repo_path / "log.txt").read_text(),
+        )
+
+    refs, log, text = run_step_3("in-memory", "--filter-memory", "16")
+    assert text == text_2.replace("secret-", "s_").replace("secret", "S")
+    assert log[:3] == [
+        f"FILTER {bak_path / f'log.txt.{t1}.bak'} (1): ('secret', 'S')",
+        f"FILTER {bak_path / f'log.txt.{t1}.bak'} (2): ('secret', 'S')",
+        f"FILTER {bak_path / f'log.txt.{t1}.bak'} (2): ('S-', 's_')",
+    ]
+
+    for engine in bak_to_git_3.ENGINES:
+        extra = ["--engine", engine, "--filter-memory", "1"]
+        assert run_step_3(engine, *extra) == (refs, log, text)
+    assert run_step_3(
+        "pack-shards", "--engine", "pack", "--shards", "2",
+        "--filter-memory", "1",
+    ) == (refs, log, text)
+
+
+def test_bak_to_fossil_3_write_blob(tmp_path, monkeypatch):
+    filter_file = tmp_path / "filter-list.txt"
+    filter_file.write_text('"secret","S"\n')
+    monkeypatch.setattr(bak_to_fossil_3, "log_path", tmp_path / "log.txt")
+    monkeypatch.setattr(bak_to_fossil_3, "filter_memory", 64)
+    temp_dir = tempfile.TemporaryDirectory(dir=tmp_path)
+    monkeypatch.setattr(bak_to_fossil_3, "temp_dir", temp_dir)
+    temp_names = []
+    real_mkstemp = tempfile.mkstemp
+
+    def mock_mkstemp(**kwargs):
+        fd, name = real_mkstemp(**kwargs)
+        temp_names.append(name)
+        return fd, name
+
+    monkeypatch.setattr(tempfile, "mkstemp", mock_mkstemp)
+    bak_to_fossil_3.load_filter_list(str(filter_file))
+
+    big = tmp_path / "big.txt"
+    big.write_text("a secret " * 20 + "\n" + "b\n" * 100)
+    plain = tmp_path / "plain.txt"
+    plain.write_bytes(b"plain\r\n" * 20)
+
+    out = io.BytesIO()
+    stream = FastImportStream(out)
+    #  Larger than filter_memory, so filtered (in pieces of 16 characters)
+    #  to a temporary file, or copied as is.
+    assert bak_to_fossil_3.write_blob(stream, big) == 1
+    assert bak_to_fossil_3.write_blob(stream, plain) == 2
+    filtered = ("a S " * 20 + "\n" + "b\n" * 100).replace("\n", os.linesep)
+    assert out.getvalue() == (
+        f"blob\nmark :1\ndata {len(filtered)}\n{filtered}\n".encode()
+        + b"blob\nmark :2\ndata 140\n" + b"plain\r\n" * 20 + b"\n"
+    )
+    assert "FILTER" in (tmp_path / "log.txt").read_text()
+
+    #  The temporary file was in temp_dir, and is removed.
+    assert [Path(temp_dir.name)] == [Path(n).parent for n in temp_names]
+    assert [] == list(Path(temp_dir.name).iterdir())
+    temp_dir.cleanup()
@@ -0,0 +1,49 @@
+import json
+import shutil
+
+import pytest
+
+import bench_bak_to_git
+
+
+def test_make_wipbak_tree(tmp_path):
+    corpus = bench_bak_to_git.make_wipbak_tree(
+        tmp_path, 4, 6, 10, 0.5, 0.2, seed=3
+    )
+    files = list(corpus.bak_path.glob("*.bak"))
+    assert len(files) == 24
+    assert corpus.n_backups == 24
+    for dt_tag, old_name, new_name in corpus.renames:
+        assert (corpus.bak_path / f"{new_name}.{dt_tag}.bak").exists()
+        assert not (corpus.bak_path / f"{old_name}.{dt_tag}.bak").exists()
+
+    #  Same seed, same tree.
+    other_path = tmp_path / "other"
+    other_path.mkdir()
+    other = bench_bak_to_git.make_wipbak_tree(
+        other_path, 4, 6, 10, 0.5, 0.2, seed=3
+    )
+    assert other.renames == corpus.renames
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_bench_main(tmp_path):
+    out_file = tmp_path / "bench.json"
+    args = [
+        "bench_bak_to_git.py",
+        "--work-dir",
+        str(tmp_path),
+        "--output",
+        str(out_file),
+        "--files",
+        "3",
+        "--tags",
+        "4",
+        "--skip-commit",
+    ]
+    bench_bak_to_git.main(args)
+    report = json.loads(out_file.read_text())
+    names = [r["name"] for r in report["results"]]
+    assert "bak_to_git_1" in names
+    assert "bak_to_git_3 what-if" in names
+    assert not any(n.startswith("bak_to_git_3 commit") for n in names)
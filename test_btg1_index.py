@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+from btg1_index import IndexEntry, ScanIndex
+
+
+def test_scan_index_roundtrip(tmp_path):
+    index_path = tmp_path / "test_index.sqlite"
+    entry = IndexEntry("abc", "a.txt.20211001_083010.bak", 4, 90, True)
+    ix1 = ScanIndex(index_path)
+    assert ix1.get("a.txt.20211101_093011.bak", 4, 100) is None
+    ix1.set("a.txt.20211101_093011.bak", 4, 100, entry)
+    ix1.close()
+    assert index_path.exists()
+
+    ix2 = ScanIndex(index_path)
+    assert entry == ix2.get("a.txt.20211101_093011.bak", 4, 100)
+
+    #  Should not match if the size or modification time changed.
+    assert ix2.get("a.txt.20211101_093011.bak", 5, 100) is None
+    assert ix2.get("a.txt.20211101_093011.bak", 4, 101) is None
+    ix2.close()
+
+
+def test_scan_index_save_rows(tmp_path):
+    index_path = tmp_path / "test_index.sqlite"
+    new_file = IndexEntry("abc", None, None, None, True)
+    ix1 = ScanIndex(index_path, save_rows=2)
+    ix1.set("a.txt.20211001_083010.bak", 4, 100, new_file)
+    ix1.set("b.txt.20211001_083010.bak", 4, 100, new_file)
+    ix1.set("c.txt.20211001_083010.bak", 4, 100, new_file)
+
+    #  Saved every 2 new entries, without closing the first index (as
+    #  when a scan is interrupted).
+    ix2 = ScanIndex(index_path)
+    assert new_file == ix2.get("b.txt.20211001_083010.bak", 4, 100)
+    assert ix2.get("c.txt.20211001_083010.bak", 4, 100) is None
+    ix2.close()
+    ix1.close()
+
+
+def test_scan_index_prune(tmp_path):
+    index_path = tmp_path / "test_index.sqlite"
+    new_file = IndexEntry("abc", None, None, None, True)
+    ix1 = ScanIndex(index_path)
+    ix1.set("a.txt.20211001_083010.bak", 4, 100, new_file)
+    ix1.set("b.txt.20211001_083010.bak", 4, 100, new_file)
+    ix1.set("c.txt.20211001_083010.bak", 4, 100, new_file)
+    assert 0 == ix1.prune()
+    ix1.close()
+
+    #  Entries that are not looked up, or set, in a run are removed.
+    ix2 = ScanIndex(index_path)
+    assert ix2.get("a.txt.20211001_083010.bak", 4, 100) is not None
+    ix2.set("c.txt.20211001_083010.bak", 5, 100, new_file)
+    assert 1 == ix2.prune()
+    ix2.close()
+
+    ix3 = ScanIndex(index_path)
+    assert ix3.get("a.txt.20211001_083010.bak", 4, 100) is not None
+    assert ix3.get("b.txt.20211001_083010.bak", 4, 100) is None
+    assert ix3.get("c.txt.20211001_083010.bak", 5, 100) is not None
+    ix3.close()
+
+
+def test_scan_index_old_version(tmp_path):
+    index_path = tmp_path / "test_index.sqlite"
+    con = sqlite3.connect(str(index_path))
+    con.execute(
+        "CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, "
+        + "mtime_ns INTEGER, digest TEXT)"
+    )
+    con.execute("INSERT INTO files VALUES ('a.txt', 4, 100, 'abc')")
+    con.commit()
+    con.close()
+
+    #  An index from an older version is started again.
+    ix = ScanIndex(index_path)
+    assert ix.get("a.txt", 4, 100) is None
+    ix.close()
+
+
+def test_scan_index_parent(tmp_path):
+    index_path = tmp_path / "NadaDir" / "test_index.sqlite"
+    with pytest.raises(FileNotFoundError) as e:
+        ScanIndex(index_path)
+    assert "NadaDir" in str(e)
@@ -0,0 +1,46 @@
+from btg1_store import BakStore
+
+
+def test_bak_store_sort():
+    t1 = "20211001_083010"
+    t2 = "20211101_093011"
+    store = BakStore()
+    store.add(f"/b/src/b.txt.{t2}.bak", "b.txt", t2, 5, 1)
+    store.add(f"/b/src/b.txt.{t1}.bak", "b.txt", t1, 4, 1)
+    store.add(f"/b/src/a.txt.{t1}.bak", "a.txt", t1, 3, 1)
+    store.add(f"/b/old/a.txt.{t1}.bak", "a.txt", t1, 3, 1)
+    store.sort()
+
+    assert [t1, t2] == store.datetime_tags()
+    assert ["a.txt", "b.txt"] == store.base_names()
+
+    groups = [(tag, list(rows)) for tag, rows in store.iter_tags()]
+    assert [(t1, [3, 2, 1]), (t2, [0])] == groups
+
+    p = store.get(3)
+    assert f"{t1}:a.txt" == p.sort_key
+    assert f"/b/old/a.txt.{t1}.bak" == p.full_name
+    assert f"a.txt.{t1}.bak" == p.file_name
+    assert 3 == p.size
+
+
+def test_bak_store_first_row():
+    store = BakStore()
+    #  Rows before first_row are kept, but not in the sorted order.
+    t1 = "20211001_083010"
+    t2 = "20211101_093011"
+    store.add(f"/b/a.txt.{t1}.bak", "a.txt", t1, None, None)
+    store.add(f"/b/a.txt.{t2}.bak", "a.txt", t2, 4, 1)
+    store.sort(first_row=1)
+    assert [1] == list(store.sorted_rows())
+    assert [t2] == store.datetime_tags()
+    assert store.size(0) is None
+
+
+def test_bak_store_digest_and_odd_name():
+    store = BakStore()
+    row = store.add("/b/odd.bak", "", "odd", 4, 1)
+    assert "odd.bak" == store.file_name(row)
+    assert store.hex_digest(row) is None
+    store.set_hex_digest(row, "3609f20ebd357679b111783e8afaf36ec46427f3")
+    assert "3609f20ebd357679b111783e8afaf36ec46427f3" == store.hex_digest(row)
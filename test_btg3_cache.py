@@ -0,0 +1,54 @@
+import pytest
+
+from btg3_cache import FilterCache, filter_fingerprint
+
+
+def test_filter_fingerprint():
+    a = filter_fingerprint([("a", "b")])
+    assert a == filter_fingerprint([("a", "b")])
+    assert a != filter_fingerprint([("a", "c")])
+    assert a != filter_fingerprint([("a", "b"), ("c", "d")])
+
+
+def test_filter_cache(tmp_path):
+    fp = filter_fingerprint([("a", "b")])
+    cache = FilterCache(tmp_path, 10)
+    k1 = cache.key("1" * 40, fp)
+    k2 = cache.key("2" * 40, fp)
+    k3 = cache.key("3" * 40, fp)
+    assert k1 != cache.key("1" * 40, filter_fingerprint([]))
+
+    assert cache.get(k1) is None
+    cache.put(k1, b"1234", [(1, ("a", "b"))])
+    cache.put(k2, b"5678", [])
+    content, applied = cache.get(k1)
+    assert content == b"1234"
+    assert applied == [(1, ("a", "b"))]
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    #  Over the size limit, so the least recently used (k2) is removed.
+    cache.put(k3, b"9012", [])
+    assert cache.total_bytes == 8
+    assert cache.get(k2) is None
+    assert cache.get(k1) is not None
+
+    #  Too large to cache.
+    cache.put(k2, b"12345678901", [])
+    assert cache.get(k2) is None
+
+    #  The cache is kept across instances.
+    cache = FilterCache(tmp_path, 10)
+    assert cache.total_bytes == 8
+    content, applied = cache.get(k3)
+    assert content == b"9012"
+
+    #  Removed by another process using the same cache directory.
+    next(tmp_path.glob(f"*/{k3}")).unlink()
+    assert cache.get(k3) is None
+    assert cache.total_bytes == 4
+
+
+def test_filter_cache_dir_not_found(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        FilterCache(tmp_path / "nope", 10)
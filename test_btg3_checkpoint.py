@@ -0,0 +1,72 @@
+from collections import namedtuple
+
+import pytest
+
+from btg3_checkpoint import (
+    Checkpoint,
+    groups_after,
+    input_digests,
+    with_input_digests,
+)
+
+
+Group = namedtuple("Group", "datetime_tag, commit_msg, items")
+Item = namedtuple("Item", "full_name, base_name")
+
+
+def test_checkpoint(tmp_path):
+    checkpoint = Checkpoint(tmp_path / "checkpoint.json")
+    assert checkpoint.load() is None
+
+    checkpoint.save("20211001_083010", "1" * 40, tmp_path / "a.csv", "d1")
+    checkpoint.save("20211101_093011", "2" * 40, tmp_path / "a.csv", "d2")
+    saved = checkpoint.load()
+    assert saved["datetime_tag"] == "20211101_093011"
+    assert saved["commit"] == "2" * 40
+    assert saved["input_csv"] == str((tmp_path / "a.csv").resolve())
+    assert saved["input_digest"] == "d2"
+    assert [p.name for p in tmp_path.iterdir()] == ["checkpoint.json"]
+
+
+def test_checkpoint_invalid(tmp_path):
+    p = tmp_path / "checkpoint.json"
+    p.write_text('{"commit": ""}\n')
+    with pytest.raises(ValueError):
+        Checkpoint(p).load()
+
+
+def test_groups_after(tmp_path):
+    groups = [
+        Group("20211001_083010", "One", [Item("a.1.bak", "a")]),
+        Group("20211101_093011", "Two", [Item("a.2.bak", "a")]),
+        Group("20211201_103012", "Three", [Item("b.3.bak", "b")]),
+    ]
+    digests = input_digests(groups)
+    assert len(set(digests)) == 3
+
+    csv_path = tmp_path / "a.csv"
+    checkpoint = Checkpoint(tmp_path / "checkpoint.json")
+    checkpoint.save("20211101_093011", "2" * 40, csv_path, digests[1])
+    saved = checkpoint.load()
+    after = groups_after(saved, csv_path, iter(groups))
+    assert list(after) == [(groups[2], digests[2])]
+
+    #  A later group may change (such as to fix a failed commit).
+    changed = groups[:2] + [groups[2]._replace(commit_msg="Fixed")]
+    after = groups_after(saved, csv_path, iter(changed))
+    assert list(after) == list(with_input_digests(changed))[2:]
+
+    #  An input file other than the one the checkpoint is for.
+    with pytest.raises(ValueError):
+        groups_after(saved, tmp_path / "b.csv", groups)
+
+    #  A group up to the checkpoint changed.
+    changed = [groups[0]._replace(commit_msg="Other")] + groups[1:]
+    with pytest.raises(ValueError):
+        groups_after(saved, csv_path, changed)
+
+    #  The checkpoint datetime tag is not in the input.
+    with pytest.raises(ValueError):
+        groups_after(saved, csv_path, groups[2:])
+    with pytest.raises(ValueError):
+        groups_after(saved, csv_path, groups[:1])
@@ -0,0 +1,110 @@
+import io
+import re
+
+import pytest
+
+from datetime import datetime
+
+from btg3_fast_import import (
+    FastImportStream,
+    cleanup_message,
+    ident_name_email,
+    post_command_tag,
+    pre_command_ops,
+    raw_date,
+    raw_date_utc,
+)
+
+
+def test_raw_date():
+    dt = datetime(2021, 10, 1, 8, 30, 10)
+    s = raw_date(dt)
+    assert re.match(r"^\d+ [+-]\d{4}$", s)
+    assert int(s.split()[0]) == int(dt.timestamp())
+
+
+def test_raw_date_utc():
+    assert raw_date_utc(datetime(2021, 10, 1, 8, 30, 0)) == "1633077000 +0000"
+
+
+def test_ident_name_email():
+    ident = "Test User <test@example.com> 1633077010 +0000"
+    assert ident_name_email(ident) == "Test User <test@example.com>"
+
+
+def test_cleanup_message():
+    assert cleanup_message("Fix a.") == "Fix a.\n"
+    assert cleanup_message("\nOne  \n\n\nTwo\n\n") == "One\n\nTwo\n"
+    assert cleanup_message("  ") == ""
+
+
+def test_pre_command_ops():
+    assert pre_command_ops(["mv", "a.txt", "b.txt"]) == [
+        ("R", "a.txt", "b.txt")
+    ]
+    assert pre_command_ops(["rm", "a.txt", "b.txt"]) == [
+        ("D", "a.txt"),
+        ("D", "b.txt"),
+    ]
+    with pytest.raises(ValueError):
+        pre_command_ops(["mv", "-f", "a.txt", "b.txt"])
+    with pytest.raises(ValueError):
+        pre_command_ops(["rm", "--cached", "a.txt"])
+    with pytest.raises(ValueError):
+        pre_command_ops(["checkout", "a.txt"])
+
+
+def test_post_command_tag():
+    assert post_command_tag(["tag", "v1"]) == ("v1", None)
+    assert post_command_tag(["tag", "-a", "v1", "-m", "One"]) == ("v1", "One")
+    assert post_command_tag(["tag", "-m", "One", "v1"]) == ("v1", "One")
+    with pytest.raises(ValueError):
+        post_command_tag(["tag", "-a", "v1"])
+    with pytest.raises(ValueError):
+        post_command_tag(["tag", "v1", "HEAD~1"])
+    with pytest.raises(ValueError):
+        post_command_tag(["gc"])
+
+
+def test_fast_import_stream():
+    out = io.BytesIO()
+    stream = FastImportStream(out)
+    ident = "A <a@b> 1633077010 +0000"
+    mark = stream.commit("refs/heads/main", ident, ident, "Msg\n", "abc")
+    stream.rename("old name.txt", 'new "name".txt')
+    stream.modify("a.txt", b"One\n")
+    stream.lightweight_tag("v1", mark)
+    stream.done()
+    assert mark == 1
+    assert out.getvalue().decode() == (
+        "commit refs/heads/main\nmark :1\n"
+        + f"author {ident}\ncommitter {ident}\n"
+        + "data 4\nMsg\n\nfrom abc\n"
+        + 'R "old name.txt" "new \\"name\\".txt"\n'
+        + 'M 100644 inline "a.txt"\ndata 4\nOne\n\n'
+        + "reset refs/tags/v1\nfrom :1\n\n"
+        + "done\n"
+    )
+
+
+def test_fast_import_stream_blob():
+    out = io.BytesIO()
+    stream = FastImportStream(out)
+    mark = stream.blob(b"One\n")
+    stream.modify_ref("a.txt", f":{mark}")
+    assert out.getvalue().decode() == (
+        "blob\nmark :1\ndata 4\nOne\n\n" + 'M 100644 :1 "a.txt"\n'
+    )
+
+
+def test_fast_import_stream_modify_file(tmp_path):
+    p = tmp_path / "a.bin"
+    p.write_bytes(b"One\r\n")
+    out = io.BytesIO()
+    stream = FastImportStream(out)
+    stream.modify_file("a.txt", p)
+    assert stream.blob_file(p) == 1
+    assert out.getvalue() == (
+        b'M 100644 inline "a.txt"\ndata 5\nOne\r\n\n'
+        + b"blob\nmark :1\ndata 5\nOne\r\n\n"
+    )
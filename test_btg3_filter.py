@@ -0,0 +1,125 @@
+import io
+import random
+import re
+
+from btg3_filter import LineFilter, trie_pattern
+
+
+def naive_filter(filter_list, line):
+    applied = []
+    for filter_item in filter_list:
+        if filter_item[0] in line:
+            applied.append(filter_item)
+            line = line.replace(filter_item[0], filter_item[1])
+    return line, applied
+
+
+def test_trie_pattern():
+    strings = ["abc", "abd", "ab", "b.c", "x"]
+    regex = re.compile(trie_pattern(strings))
+    for s in strings:
+        assert regex.fullmatch(s)
+    assert regex.search("zzbxc")[0] == "x"
+    assert regex.search("a-b-c") is None
+    assert regex.search("b.c")[0] == "b.c"
+    assert regex.search("bzc") is None
+
+
+def test_line_filter_same_as_naive():
+    rnd = random.Random(2)
+    alphabet = "abc."
+    filter_list = [
+        (
+            "".join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 4))),
+            "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 3))),
+        )
+        for _ in range(20)
+    ]
+    line_filter = LineFilter(filter_list)
+    for _ in range(500):
+        line = "".join(rnd.choice(alphabet + "xyz ") for _ in range(30))
+        assert line_filter.apply(line) == naive_filter(filter_list, line)
+
+
+def test_line_filter_chained():
+    #  A replacement can make text that a later replacement matches.
+    filter_list = [("one", "two"), ("two", "three")]
+    line_filter = LineFilter(filter_list)
+    assert line_filter.apply("one\n") == ("three\n", filter_list)
+    assert line_filter.apply("zero\n") == ("zero\n", [])
+
+
+def test_line_filter_empty():
+    line_filter = LineFilter([])
+    assert len(line_filter) == 0
+    assert not line_filter.could_match("anything")
+    assert line_filter.apply("anything") == ("anything", [])
+
+
+def test_could_match_file(tmp_path):
+    line_filter = LineFilter([("secret", "x"), ("caf\u00e9", "cafe")])
+    p = tmp_path / "a.txt"
+    p.write_text("no match\n")
+    assert not line_filter.could_match_file(p)
+    p.write_text("a secret\n")
+    assert line_filter.could_match_file(p)
+    p.write_bytes(b"")
+    assert not line_filter.could_match_file(p)
+    assert not LineFilter([]).could_match_file(p)
+
+
+def test_could_match_file_blocks(tmp_path):
+    line_filter = LineFilter([("secret", "x")], buffer_size=8)
+    p = tmp_path / "a.txt"
+    #  The match spans the first two blocks.
+    p.write_text("a b secret\n" + "-" * 40 + "\n")
+    assert line_filter.could_match_file(p)
+    p.write_text("a b secre\n" + "-" * 40 + "secre\n")
+    assert not line_filter.could_match_file(p)
+
+
+def test_filter_file_long_lines():
+    rnd = random.Random(3)
+    alphabet = "abc."
+    filter_list = [
+        (
+            "".join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 4))),
+            "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 6))),
+        )
+        for _ in range(10)
+    ]
+    lines = [
+        "".join(rnd.choice(alphabet + "xy") for _ in range(rnd.randint(0, 90)))
+        + "\n"
+        for _ in range(200)
+    ]
+    lines[-1] = lines[-1].rstrip("\n")
+    expect = [naive_filter(filter_list, line) for line in lines]
+    expect_text = "".join(line for line, _ in expect)
+    expect_applied = [
+        (num, item)
+        for num, (_, applied) in enumerate(expect, start=1)
+        for item in applied
+    ]
+
+    #  Lines longer than the buffer are filtered in pieces, and matches
+    #  that span pieces (including text made by earlier replacements)
+    #  are found.
+    for buffer_size in (1, 2, 5, 16, 1000):
+        line_filter = LineFilter(filter_list, buffer_size=buffer_size)
+        dst = io.StringIO()
+        applied = []
+        line_filter.filter_file(
+            io.StringIO("".join(lines)), dst, applied.append
+        )
+        assert dst.getvalue() == expect_text
+        assert applied == expect_applied
+
+
+def test_filter_file_empty_old():
+    line_filter = LineFilter([("", "-")], buffer_size=2)
+    dst = io.StringIO()
+    applied = []
+    line_filter.filter_file(io.StringIO("abcd\nef"), dst, applied.append)
+    assert dst.getvalue() == "abcd\n".replace("", "-") + "ef".replace("", "-")
+    assert applied == [(1, ("", "-")), (2, ("", "-"))]
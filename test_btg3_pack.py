@@ -0,0 +1,124 @@
+import shutil
+import subprocess
+
+import pytest
+
+from btg3_pack import (
+    OBJ_BLOB,
+    OBJ_COMMIT,
+    OBJ_TAG,
+    OBJ_TREE,
+    PackWriter,
+    commit_data,
+    file_object_id,
+    object_id,
+    tag_data,
+    tree_data,
+)
+
+
+def git(repo_path, *args, input=None):
+    return subprocess.run(
+        ["git"] + list(args),
+        cwd=repo_path,
+        input=input,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
+def test_object_id():
+    #  The well-known ids of the empty blob and the empty tree.
+    assert object_id(OBJ_BLOB, b"") == (
+        "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+    )
+    assert object_id(OBJ_TREE, b"") == (
+        "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+    )
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_tree_data(tmp_path):
+    git(tmp_path, "init", "-q")
+    blob_id = git(tmp_path, "hash-object", "-w", "--stdin", input=b"x\n")
+    blob_id = blob_id.decode().strip()
+    sub_id = git(
+        tmp_path, "mktree", input=f"100644 blob {blob_id}\tb.txt\n".encode()
+    )
+    sub_id = sub_id.decode().strip()
+    #  'a.b' sorts before the tree 'a' (compared as 'a/'), and after 'a-'.
+    lines = [
+        f"040000 tree {sub_id}\ta",
+        f"100644 blob {blob_id}\ta.b",
+        f"100755 blob {blob_id}\ta-",
+    ]
+    expected = git(tmp_path, "mktree", input="\n".join(lines).encode())
+    assert object_id(OBJ_TREE, tree_data(lines)) == expected.decode().strip()
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_pack_writer(tmp_path):
+    git(tmp_path, "init", "-q")
+    writer = PackWriter(tmp_path / ".git", workers=2, max_pending=2)
+    big = bytes(range(256)) * 1000
+    blob_ids = [writer.add(OBJ_BLOB, b"One\n"), writer.add(OBJ_BLOB, big)]
+    #  The same content is only added once.
+    assert writer.add(OBJ_BLOB, b"One\n") == blob_ids[0]
+    tree_id = writer.add(
+        OBJ_TREE,
+        tree_data(
+            [
+                f"100644 blob {blob_ids[0]}\ta.txt",
+                f"100644 blob {blob_ids[1]}\tbig.bin",
+            ]
+        ),
+    )
+    ident = "Test User <test@example.com> 1633077010 +0000"
+    commit_id = writer.add(
+        OBJ_COMMIT, commit_data(tree_id, None, ident, ident, "One.\n")
+    )
+    tag_id = writer.add(OBJ_TAG, tag_data(commit_id, "v1", ident, "One\n"))
+    assert 5 == len(writer)
+    name = writer.close()
+
+    pack_dir = tmp_path / ".git" / "objects" / "pack"
+    assert sorted(p.name for p in pack_dir.iterdir()) == [
+        f"{name}.idx",
+        f"{name}.pack",
+    ]
+    git(tmp_path, "verify-pack", str(pack_dir / f"{name}.idx"))
+    assert git(tmp_path, "cat-file", "blob", blob_ids[1]) == big
+    assert git(tmp_path, "rev-parse", f"{tag_id}^{{commit}}").decode() == (
+        f"{commit_id}\n"
+    )
+    assert b"big.bin" in git(tmp_path, "ls-tree", commit_id)
+
+
+def test_pack_writer_empty(tmp_path):
+    writer = PackWriter(tmp_path)
+    assert writer.close() is None
+    assert [] == list((tmp_path / "objects" / "pack").iterdir())
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_pack_writer_add_file(tmp_path):
+    git(tmp_path, "init", "-q")
+    big = bytes(range(256)) * 9000
+    p = tmp_path / "big.bin"
+    p.write_bytes(big)
+    assert file_object_id(OBJ_BLOB, p) == object_id(OBJ_BLOB, big)
+
+    #  Objects added before a file, and waiting to be compressed, are
+    #  written first. Pending objects are also limited by size.
+    writer = PackWriter(tmp_path / ".git", workers=2, max_pending_bytes=8)
+    small_ids = [writer.add(OBJ_BLOB, f"{n}\n".encode()) for n in range(9)]
+    big_id = writer.add_file(OBJ_BLOB, p)
+    assert writer.add(OBJ_BLOB, big) == big_id
+    assert writer.add_file(OBJ_BLOB, p) == big_id
+    assert 10 == len(writer)
+    name = writer.close()
+
+    pack_dir = tmp_path / ".git" / "objects" / "pack"
+    git(tmp_path, "verify-pack", str(pack_dir / f"{name}.idx"))
+    assert git(tmp_path, "cat-file", "blob", big_id) == big
+    assert git(tmp_path, "cat-file", "blob", small_ids[8]) == b"8\n"
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import pytest
+
+from btg3_pipeline import prefetch
+
+
+def test_prefetch_order():
+    def slow_square(n):
+        #  Later items finish first.
+        time.sleep((10 - n) * 0.002)
+        return n * n
+
+    for lookahead in (0, 1, 3, 20):
+        results = list(prefetch(range(10), slow_square, lookahead))
+        assert results == [(n, n * n) for n in range(10)]
+
+
+def test_prefetch_bounded():
+    started = []
+    lock = threading.Lock()
+
+    def record(n):
+        with lock:
+            started.append(n)
+        return n
+
+    for item, result in prefetch(range(10), record, 2):
+        #  No more than the item in use and the lookahead have started.
+        time.sleep(0.01)
+        with lock:
+            assert max(started) <= item + 2
+
+
+def test_prefetch_error():
+    def fail_on_3(n):
+        if n == 3:
+            raise ValueError(n)
+        return n
+
+    seen = []
+    with pytest.raises(ValueError):
+        for item, result in prefetch(range(10), fail_on_3, 2):
+            seen.append(result)
+    assert seen == [0, 1, 2]
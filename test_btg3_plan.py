@@ -0,0 +1,52 @@
+import pytest
+
+from collections import namedtuple
+
+from btg3_plan import is_plan_file, read_plan, write_plan
+
+
+Props = namedtuple("Props", "full_name, datetime_tag, base_name")
+
+Group = namedtuple("Group", "datetime_tag, commit_msg, pre_commit, items")
+
+
+def test_plan_round_trip(tmp_path):
+    groups = [
+        Group(
+            "20211001_083010",
+            "One.",
+            [],
+            [Props("/bak/a.bak", "20211001_083010", "a.txt")],
+        ),
+        Group(
+            "20211101_093011",
+            "Two.",
+            ["mv a.txt b.txt"],
+            [Props("/bak/b.bak", "20211101_093011", "b.txt")],
+        ),
+    ]
+    p = tmp_path / "plan.jsonl"
+    assert is_plan_file(p)
+    assert not is_plan_file(tmp_path / "plan.csv")
+
+    write_plan(p, "tool", groups, "input.csv")
+    assert '"target": "b.txt"' in p.read_text()
+    assert read_plan(p, "tool", Group, Props) == groups
+
+    with pytest.raises(ValueError):
+        read_plan(p, "other_tool", Group, Props)
+
+    #  A plan cut short (such as by an interrupted write) is not used.
+    p.write_text("".join(p.read_text().splitlines(True)[:-1]))
+    with pytest.raises(ValueError):
+        read_plan(p, "tool", Group, Props)
+
+
+def test_plan_invalid_entry(tmp_path):
+    p = tmp_path / "plan.jsonl"
+    p.write_text(
+        '{"plan": "tool", "version": 1, "commits": 1}\n'
+        + '{"datetime_tag": "20211001_083010", "items": []}\n'
+    )
+    with pytest.raises(ValueError):
+        read_plan(p, "tool", Group, Props)
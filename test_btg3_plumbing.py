@@ -0,0 +1,56 @@
+from btg3_plumbing import TreeBuilder
+
+
+class FakeMakeTree:
+    def __init__(self):
+        self.trees = []
+
+    def __call__(self, lines):
+        self.trees.append(sorted(lines))
+        return f"t{len(self.trees)}"
+
+
+def test_tree_builder():
+    tree = TreeBuilder()
+    tree.set("a.txt", "100644", "b1")
+    tree.set("sub/b.txt", "100644", "b2")
+    assert tree.get("sub/b.txt") == ("100644", "b2")
+    assert tree.get("sub/x.txt") is None
+    assert tree.get("x/y/z.txt") is None
+
+    make_tree = FakeMakeTree()
+    root_1 = tree.write(make_tree)
+    assert len(make_tree.trees) == 2
+    assert make_tree.trees[0] == ["100644 blob b2\tb.txt"]
+    assert make_tree.trees[1] == [
+        "040000 tree t1\tsub",
+        "100644 blob b1\ta.txt",
+    ]
+
+    #  Nothing changed, so nothing is written.
+    assert tree.write(make_tree) == root_1
+    assert len(make_tree.trees) == 2
+
+    #  Only the root changes, so the subdirectory is not written again.
+    tree.set("a.txt", "100644", "b3")
+    tree.write(make_tree)
+    assert len(make_tree.trees) == 3
+    assert "040000 tree t1\tsub" in make_tree.trees[2]
+
+    #  Moving the only file out of a directory removes the directory.
+    tree.rename("sub/b.txt", "c.txt")
+    tree.write(make_tree)
+    assert make_tree.trees[-1] == [
+        "100644 blob b2\tc.txt",
+        "100644 blob b3\ta.txt",
+    ]
+
+
+def test_tree_builder_files():
+    tree = TreeBuilder()
+    tree.set("a.txt", "100644", "b1")
+    tree.set("sub/deep/b.txt", "100755", "b2")
+    assert sorted(tree.files()) == [
+        ("a.txt", "100644", "b1"),
+        ("sub/deep/b.txt", "100755", "b2"),
+    ]
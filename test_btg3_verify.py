@@ -0,0 +1,56 @@
+import shutil
+import subprocess
+
+import pytest
+
+from btg3_pack import OBJ_BLOB, OBJ_TREE, object_id, tree_data
+from btg3_verify import CatFileBatch, tree_entries
+
+
+def test_tree_entries():
+    blob_id = object_id(OBJ_BLOB, b"x\n")
+    sub_id = object_id(OBJ_TREE, tree_data([f"100644 blob {blob_id}\tb"]))
+    data = tree_data(
+        [f"100755 blob {blob_id}\ta.sh", f"040000 tree {sub_id}\tsub"]
+    )
+    assert list(tree_entries(data)) == [
+        ("100755", "a.sh", blob_id),
+        ("40000", "sub", sub_id),
+    ]
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+def test_cat_file_batch(tmp_path):
+    def git(*args):
+        return subprocess.run(
+            ["git"] + list(args),
+            cwd=tmp_path,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+
+    git("init", "-q")
+    git("config", "user.name", "Test")
+    git("config", "user.email", "test@example.com")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.txt").write_text("A\n")
+    (tmp_path / "sub" / "b.txt").write_text("B\n")
+    git("add", "-A")
+    git("commit", "-q", "-m", "One")
+    git("tag", "v1")
+
+    commit_id = git("rev-parse", "HEAD")
+    with CatFileBatch(tmp_path) as batch:
+        obj = batch.read("refs/tags/v1")
+        assert obj[:2] == (commit_id, "commit")
+        assert obj[2].startswith(b"tree ")
+        assert batch.read("refs/tags/none") is None
+
+        tree_id = batch.commit_tree_id(commit_id)
+        assert tree_id == git("rev-parse", "HEAD^{tree}")
+        assert batch.commit_tree_id(tree_id) is None
+        assert batch.tree_files(tree_id) == {
+            "a.txt": ("100644", object_id(OBJ_BLOB, b"A\n")),
+            "sub/b.txt": ("100644", object_id(OBJ_BLOB, b"B\n")),
+        }